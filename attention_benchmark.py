@@ -0,0 +1,48 @@
+"""
+Benchmark the attention backends on the current device.
+
+Usage: python attention_benchmark.py [options]
+
+Times every backend in lib/attention.py for each (sequence length,
+channels, heads) shape, forward and backward as used by CLIP guidance, and
+records the fastest per shape in the cache that attention_backend='auto'
+reads. The default shapes are those of the 512x512 model's attention layers.
+"""
+
+import argparse
+
+import jax
+
+from lib.attention import (ATTENTION_BACKENDS, SELECTION_CACHE, benchmark_attention,
+                           select_attention_backend)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark attention backends.')
+    parser.add_argument('--shapes', default='1024:512:8,256:1024:16,64:1024:16',
+                        help='comma separated T:channels:heads')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--forward_only', action='store_true')
+    parser.add_argument('--cache', default=SELECTION_CACHE)
+    args = parser.parse_args()
+
+    device = jax.devices()[0]
+    names = [name for name in ATTENTION_BACKENDS if name != 'reference']
+    print(f'{device.platform} ({device.device_kind}), ms per call')
+    print('  shape             ' + ''.join(f'{name:>13}' for name in names))
+    for shape in args.shapes.split(','):
+        (length, channels, n_heads) = [int(n) for n in shape.split(':')]
+        timings = []
+        for name in names:
+            try:
+                seconds = benchmark_attention(name, length, channels, n_heads, args.batch_size,
+                                              args.iterations, backward=not args.forward_only)
+                timings.append(f'{1000 * seconds:13.3f}')
+            except Exception:
+                timings.append(f'{"failed":>13}')
+        print(f'  {shape:16}  ' + ''.join(timings))
+        if not args.forward_only:
+            print(f'    selected: {select_attention_backend(length, channels, n_heads, cache_path=args.cache)}')
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,7 @@ import jaxtorch
 from jaxtorch.core import Module, Context, ParamState, PRNG
 
 from lib import unet
+from lib.checkpoint import load_params
 from tqdm import tqdm
 
 with open('256x256_diffusion_uncond.cbor', 'rb') as fp:
@@ -73,10 +74,7 @@ def main():
     )
 
     new_module = unet.UNetModel(**args)
-    px = ParamState(new_module.labeled_parameters_())
-    px.initialize(rng.split())
-
-    new_module.load_state_dict(px, state_dict)
+    px = load_params(new_module, state_dict)
 
     x = jax.random.normal(key=rng.split(), shape=[1, 3, 32, 32])
     ts = jnp.array([1])
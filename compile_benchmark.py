@@ -0,0 +1,110 @@
+"""
+Measure trace and compile time of the UNet, unrolled and with ScanUNet.
+
+Usage: python compile_benchmark.py [options]
+
+For the plain UNetModel and for ScanUNet (see lib/scan_unet.py), reports
+how long jax takes to trace and lower the forward pass, and the forward and
+backward pass as used by CLIP guidance, how long XLA takes to compile them,
+and the size of the lowered program. Parameters are abstract, so nothing is
+allocated and the full size models can be measured anywhere. With --run,
+the compiled functions are also timed on random parameters.
+"""
+
+import argparse
+import time
+
+import jax
+import jax.numpy as jnp
+from jaxtorch import Context
+from jaxtorch.core import ParamState
+
+from lib.script_util import create_model_and_diffusion, model_and_diffusion_defaults
+from lib.scan_unet import ScanUNet
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure UNet compile time, unrolled and scanned.')
+    parser.add_argument('--image_size', type=int, default=512, choices=[256, 512],
+                        help='selects the model config')
+    parser.add_argument('--test_size', type=int, default=None,
+                        help='resolution of the test inputs (default: image_size)')
+    parser.add_argument('--num_channels', type=int, default=256,
+                        help='base channel count, to measure a narrower model')
+    parser.add_argument('--num_res_blocks', type=int, default=2,
+                        help='res blocks per level; deeper models have longer runs to scan')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--layout', default='NCHW', choices=['NCHW', 'NHWC'])
+    parser.add_argument('--run', action='store_true',
+                        help='also time the compiled functions on random parameters')
+    parser.add_argument('--iterations', type=int, default=3)
+    args = parser.parse_args()
+    test_size = args.test_size or args.image_size
+
+    model_config = model_and_diffusion_defaults()
+    model_config.update({
+        'attention_resolutions': '32, 16, 8',
+        'class_cond': False,
+        'diffusion_steps': 1000,
+        'rescale_timesteps': True,
+        'timestep_respacing': '1000',
+        'image_size': args.image_size,
+        'learn_sigma': True,
+        'noise_schedule': 'linear',
+        'num_channels': args.num_channels,
+        'num_head_channels': 64,
+        'num_res_blocks': args.num_res_blocks,
+        'resblock_updown': True,
+        'use_scale_shift_norm': True,
+        'layout': args.layout,
+    })
+    (model, diffusion) = create_model_and_diffusion(**model_config)
+    scan_model = ScanUNet(model)
+    print(f'{len(list(scan_model.scanned_runs()))} scanned runs covering '
+          f'{sum(length for (*_, length) in scan_model.scanned_runs())} of '
+          f'{len(scan_model.input_blocks) + len(scan_model.output_blocks)} input and output blocks')
+
+    params = ParamState(model.labeled_parameters_())
+    for (name, par) in model.named_parameters():
+        params[name] = jax.ShapeDtypeStruct(tuple(par.shape), jnp.float32)
+    # Execution form, with timestep tables, as in execute.py.
+    def prepare(px):
+        px = model.prepare_params(px)
+        return model.precompute_timestep_tables(px, diffusion.model_timesteps())
+    params = jax.eval_shape(prepare, params)
+    variants = {'unrolled': (model, params),
+                'scan': (scan_model, jax.eval_shape(scan_model.stack_params, params))}
+
+    x = jax.ShapeDtypeStruct((args.batch_size, 3, test_size, test_size), jnp.float32)
+    t = jnp.full([args.batch_size], 500.0)
+    device = jax.devices()[0]
+    print(f'{device.platform} ({device.device_kind}), {args.image_size} model at {test_size}x{test_size}')
+    print(f'  {"":10} {"":16} {"trace (s)":>10} {"compile (s)":>12} {"HLO lines":>10}'
+          + (f' {"run (ms)":>10}' if args.run else ''))
+    for (variant, (run_model, px)) in variants.items():
+        def forward(px, x):
+            return run_model(Context(px, jax.random.PRNGKey(0)), x, t)
+        def guidance(px, x):
+            return jax.grad(lambda x: forward(px, x).square().mean())(x)
+        for (name, fn) in (('forward', forward), ('forward+backward', guidance)):
+            start = time.perf_counter()
+            lowered = jax.jit(fn).lower(px, x)
+            trace = time.perf_counter() - start
+            lines = lowered.as_text().count('\n')
+            start = time.perf_counter()
+            compiled = lowered.compile()
+            compile_time = time.perf_counter() - start
+            row = f'  {variant:10} {name:16} {trace:10.2f} {compile_time:12.2f} {lines:10d}'
+            if args.run:
+                values = jax.tree_util.tree_map(
+                    lambda s: 0.02 * jax.random.normal(jax.random.PRNGKey(0), s.shape, s.dtype), px)
+                inputs = jax.random.normal(jax.random.PRNGKey(1), x.shape)
+                jax.block_until_ready(compiled(values, inputs))
+                start = time.perf_counter()
+                for _ in range(args.iterations):
+                    jax.block_until_ready(compiled(values, inputs))
+                row += f' {1000 * (time.perf_counter() - start) / args.iterations:10.1f}'
+                del values
+            print(row)
+
+if __name__ == '__main__':
+    main()
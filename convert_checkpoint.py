@@ -1,13 +1,49 @@
+"""
+Convert a checkpoint for use with jax.
+
+Usage: python convert_checkpoint.py <model> [cbor|tensors] [fp32|fp16|bf16] [shard size in MB]
+
+Reads <model>.pt (or <model>.cbor if there is no .pt) and writes
+<model>.tensors, a memory-mappable tensor archive (see lib/tensor_archive.py),
+or <model>.cbor. Conversion from .pt to .tensors is streamed one tensor at
+a time, so peak memory is bounded by the largest single tensor. With a shard
+size, the archive is split into several files plus a <model>.tensors.json
+index.
+"""
+
 import sys
-import torch
+import os
 import jaxtorch
 
+from lib.tensor_archive import save_archive
+from lib.torch_checkpoint import DTYPES, TorchStateDict, convert_state_dict
+
 model = sys.argv[1]
+output_format = sys.argv[2] if len(sys.argv) > 2 else 'tensors'
+dtype = DTYPES[sys.argv[3] if len(sys.argv) > 3 else None]
+shard_size = int(float(sys.argv[4]) * 2**20) if len(sys.argv) > 4 else None
 
-with torch.no_grad():
+if os.path.exists(f'{model}.pt'):
+    source = f'{model}.pt'
+    state_dict = TorchStateDict(source, dtype=dtype)
+else:
     print('Loading state dict...')
-    diffusion_state_dict = torch.load(f'{model}.pt', map_location=torch.device('cpu'))
-    jax_state_dict = {name : par.cpu().numpy() for (name, par) in diffusion_state_dict.items()}
+    source = f'{model}.cbor'
+    with open(source, 'rb') as fp:
+        state_dict = jaxtorch.cbor.load(fp)
+    if dtype is not None:
+        from lib.tensor_archive import dtype_from_name
+        state_dict = {name : par.astype(dtype_from_name(dtype)) for (name, par) in state_dict.items()}
 
-with open(f'{model}.cbor', 'wb') as fp:
-    jaxtorch.cbor.dump(jax_state_dict, fp)
\ No newline at end of file
+metadata = {'source': os.path.basename(source), 'dtype': dtype}
+if output_format == 'cbor':
+    # The cbor format holds float32 tensors only.
+    jax_state_dict = {name : par for (name, par) in state_dict.items()}
+    with open(f'{model}.cbor', 'wb') as fp:
+        jaxtorch.cbor.dump(jax_state_dict, fp)
+    print(f'Wrote {model}.cbor')
+elif isinstance(state_dict, TorchStateDict):
+    convert_state_dict(state_dict, f'{model}.tensors', shard_size=shard_size, metadata=metadata)
+else:
+    save_archive(f'{model}.tensors', state_dict, metadata=metadata)
+    print(f'Wrote {model}.tensors')
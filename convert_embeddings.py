@@ -0,0 +1,38 @@
+"""
+Build the memory-mapped embedding store from the data/*.npz embeddings.
+
+Usage: python convert_embeddings.py [data dir] [store dir]
+"""
+
+import sys
+import os
+from glob import glob
+
+import numpy as np
+
+from lib.embed_store import EmbedStore
+
+# name -> (positive, negative) for the derived style directions.
+DIRECTIONS = {
+    'openimages_minus_imagenet': ('openimages_512x_png_embed', 'imagenet_512x_jpg_embed'),
+    'openimages_minus_imagenet224': ('openimages_512x_png_embed224', 'imagenet_512x_jpg_embed224'),
+}
+
+def main():
+    data_dir = sys.argv[1] if len(sys.argv) > 1 else 'data'
+    store_dir = sys.argv[2] if len(sys.argv) > 2 else os.path.join(data_dir, 'embed_store')
+
+    store = EmbedStore(store_dir)
+    for path in sorted(glob(os.path.join(data_dir, '*.npz'))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        with np.load(path) as z:
+            store.add(name, z['arr_0'], source=os.path.basename(path))
+        print(f'Added {name}')
+
+    for (name, (positive, negative)) in DIRECTIONS.items():
+        if positive in store and negative in store:
+            store.add_direction(name, positive, negative)
+            print(f'Added {name}')
+
+if __name__ == '__main__':
+    main()
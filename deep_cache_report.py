@@ -0,0 +1,109 @@
+"""
+Report the speed and quality of deep feature reuse (DeepCache) in sampling.
+
+Usage: python deep_cache_report.py <checkpoint> [options]
+
+Samples from the same noise with every combination of --depths and
+--patterns (see lib/deep_cache.py), and compares each final sample with the
+one from running the whole model on every step: time per sampling step,
+speedup, RMS difference and PSNR. Sampling is unguided, so the comparison
+isolates the model; with CLIP guidance, cheap steps also save most of the
+backward pass through the UNet.
+"""
+
+import argparse
+import functools
+import time
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+from jaxtorch import Context, PRNG
+
+from lib.script_util import create_model_and_diffusion, model_and_diffusion_defaults
+from lib.checkpoint import load_params
+from lib.deep_cache import DeepCache
+from lib.tensor_archive import open_archive
+from lib.torch_checkpoint import TorchStateDict
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare DeepCache patterns with full sampling.')
+    parser.add_argument('checkpoint')
+    parser.add_argument('--image_size', type=int, default=512, choices=[256, 512],
+                        help='selects the model config')
+    parser.add_argument('--test_size', type=int, default=None,
+                        help='resolution of the samples (default: image_size)')
+    parser.add_argument('--steps', default='50', help='timestep_respacing for sampling')
+    parser.add_argument('--depths', default='3,5')
+    parser.add_argument('--patterns', default='FC,FCC,FCCC')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    test_size = args.test_size or args.image_size
+
+    model_config = model_and_diffusion_defaults()
+    model_config.update({
+        'attention_resolutions': '32, 16, 8',
+        'class_cond': False,
+        'diffusion_steps': 1000,
+        'rescale_timesteps': True,
+        'timestep_respacing': args.steps,
+        'image_size': args.image_size,
+        'learn_sigma': True,
+        'noise_schedule': 'linear',
+        'num_channels': 256,
+        'num_head_channels': 64,
+        'num_res_blocks': 2,
+        'resblock_updown': True,
+        'use_scale_shift_norm': True,
+    })
+    (model, diffusion) = create_model_and_diffusion(**model_config)
+    if args.checkpoint.endswith('.pt'):
+        state_dict = TorchStateDict(args.checkpoint)
+    else:
+        state_dict = open_archive(args.checkpoint)
+    params = model.prepare_params(load_params(model, state_dict))
+    params = model.precompute_timestep_tables(params, diffusion.model_timesteps())
+
+    @functools.partial(jax.jit, static_argnames=['depth'])
+    def exec_model(model_params, x, timesteps, depth=None, deep=None):
+        cx = Context(model_params, jax.random.PRNGKey(0))
+        return model.forward_cached(cx, x, timesteps, depth=depth, deep=deep)
+
+    shape = (args.batch_size, 3, test_size, test_size)
+    def sample(cache):
+        """Returns (the final sample, seconds per step)."""
+        if cache is None:
+            run_model = lambda x, t: exec_model(params, x, t)[0]
+        else:
+            cache.reset()
+            run_model = functools.partial(cache, functools.partial(exec_model, params, depth=cache.depth))
+            # Compile the full and cheap variants outside the timing.
+            x = jnp.zeros(shape)
+            t = jnp.zeros([args.batch_size])
+            (_, deep) = exec_model(params, x, t, depth=cache.depth)
+            jax.block_until_ready(exec_model(params, x, t, depth=cache.depth, deep=deep))
+        rng = PRNG(jax.random.PRNGKey(args.seed))
+        start = time.perf_counter()
+        for out in diffusion.p_sample_loop_progressive(run_model, shape, rng=rng, clip_denoised=True):
+            pass
+        final = np.asarray(out['sample'])
+        return final, (time.perf_counter() - start) / diffusion.num_timesteps
+
+    # Once to compile, then for the reference.
+    jax.block_until_ready(exec_model(params, jnp.zeros(shape), jnp.zeros([args.batch_size]))[0])
+    (reference, full_time) = sample(None)
+    print(f'{diffusion.num_timesteps} steps at {test_size}x{test_size}, batch size {args.batch_size}')
+    print('  depth  pattern   ms/step  speedup  rms diff   PSNR (dB)')
+    print(f'  {"-":>5}  {"F":8} {1000 * full_time:8.1f}  {1.0:6.2f}x  {0.0:8.4f}  {"inf":>9}')
+    for depth in [int(d) for d in args.depths.split(',')]:
+        for pattern in args.patterns.split(','):
+            (result, step_time) = sample(DeepCache(depth, pattern))
+            rms = np.sqrt(np.mean((result - reference) ** 2))
+            # Samples are in [-1, 1], a peak-to-peak range of 2.
+            psnr = 20 * np.log10(2 / rms) if rms > 0 else float('inf')
+            print(f'  {depth:5}  {pattern:8} {1000 * step_time:8.1f}  {full_time / step_time:6.2f}x'
+                  f'  {rms:8.4f}  {psnr:9.2f}')
+
+if __name__ == '__main__':
+    main()
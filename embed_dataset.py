@@ -0,0 +1,248 @@
+"""
+Average CLIP image embeddings over a dataset, in bounded memory.
+
+Usage: python embed_dataset.py <image dir or .tar> <output name> [options]
+
+Images are decoded and cropped in a pool of worker processes, batched
+through the CLIP image encoder, and the running sum (and optionally the sum
+of outer products) of the normalized embeddings is accumulated in float64.
+Partial sums are checkpointed to <output>.partial.npz, so an interrupted run
+resumes where it left off. The mean is written as <output>.npz and
+<output>.cbor, the same formats as data/*_embed224, and can also be added to
+the embedding store used by execute.py.
+"""
+
+import sys
+import os
+import io
+import argparse
+import itertools
+import tarfile
+import multiprocessing
+from functools import partial
+
+import numpy as np
+from PIL import Image
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+
+CLIP_MEAN = np.array([0.48145466, 0.4578275, 0.40821073], dtype=np.float32).reshape(3, 1, 1)
+CLIP_STD = np.array([0.26862954, 0.26130258, 0.27577711], dtype=np.float32).reshape(3, 1, 1)
+
+
+def is_image(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def iter_sources(path):
+    """
+    Yields (name, path or bytes) for every image under `path`, in a stable
+    order so that a resumed run can skip what has already been counted.
+    """
+    if os.path.isdir(path):
+        for (dirpath, dirnames, filenames) in os.walk(path):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if is_image(name):
+                    yield (name, os.path.join(dirpath, name))
+    else:
+        # Stream mode: members are read sequentially, the archive is never
+        # indexed or held in memory.
+        with tarfile.open(path, 'r|*') as tar:
+            for member in tar:
+                if member.isfile() and is_image(member.name):
+                    yield (member.name, tar.extractfile(member).read())
+
+
+def decode(item, crop_size=224, resize=224):
+    """
+    Decode an image, resize its short side to `resize` and center crop it to
+    `crop_size`. Runs in a worker process.
+
+    :return: a [crop_size x crop_size x 3] uint8 array, or None if the image
+             could not be decoded.
+    """
+    (name, source) = item
+    try:
+        image = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+        image = image.convert('RGB')
+    except Exception as e:
+        print(f'Skipping {name}: {e}', file=sys.stderr)
+        return None
+    (w, h) = image.size
+    scale = resize / min(w, h)
+    image = image.resize((max(crop_size, round(w * scale)), max(crop_size, round(h * scale))), Image.BICUBIC)
+    (w, h) = image.size
+    left = (w - crop_size) // 2
+    top = (h - crop_size) // 2
+    image = image.crop((left, top, left + crop_size, top + crop_size))
+    return np.asarray(image, dtype=np.uint8)
+
+
+class EmbedStats(object):
+    """
+    Running sums of normalized embeddings.
+
+    :param dim: the embedding dimension.
+    :param covariance: also accumulate the sum of outer products.
+    """
+
+    def __init__(self, dim, covariance=False):
+        self.count = 0
+        self.consumed = 0
+        self.total = np.zeros([dim], dtype=np.float64)
+        self.outer = np.zeros([dim, dim], dtype=np.float64) if covariance else None
+
+    def update(self, embeds):
+        embeds = np.asarray(embeds, dtype=np.float64)
+        embeds = embeds / np.sqrt(np.square(embeds).sum(axis=-1, keepdims=True))
+        self.count += embeds.shape[0]
+        self.total += embeds.sum(axis=0)
+        if self.outer is not None:
+            self.outer += embeds.T @ embeds
+
+    def mean(self):
+        return self.total / self.count
+
+    def covariance(self):
+        mean = self.mean()
+        return self.outer / self.count - np.outer(mean, mean)
+
+    def save(self, path):
+        tmp = path + '.tmp.npz'
+        arrays = dict(count=self.count, consumed=self.consumed, total=self.total)
+        if self.outer is not None:
+            arrays['outer'] = self.outer
+        np.savez(tmp, **arrays)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as z:
+            stats = EmbedStats(z['total'].shape[0], covariance='outer' in z.files)
+            stats.count = int(z['count'])
+            stats.consumed = int(z['consumed'])
+            stats.total = z['total']
+            if 'outer' in z.files:
+                stats.outer = z['outer']
+        return stats
+
+
+def windows(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        window = list(itertools.islice(iterator, size))
+        if not window:
+            return
+        yield window
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Average CLIP image embeddings over a dataset.')
+    parser.add_argument('source', help='a directory of images, or a (compressed) tar of images')
+    parser.add_argument('output', help='output path, without extension')
+    parser.add_argument('--clip_model', default='ViT-B/32')
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--resize', type=int, default=224, help='short side before center cropping to 224')
+    parser.add_argument('--covariance', action='store_true')
+    parser.add_argument('--checkpoint_every', type=int, default=100, help='in batches')
+    parser.add_argument('--store', default=None, help='also add the mean to this embedding store')
+    parser.add_argument('--direction_from', default=None,
+                        help='also store norm(output) - norm(this store entry) as <output name>_minus_<entry>')
+    args = parser.parse_args()
+
+    sys.path.append('./CLIP_JAX')
+    import jax
+    import jax.numpy as jnp
+    import jaxtorch
+    import clip_jax
+
+    print('Loading CLIP model...')
+    image_fn, text_fn, clip_params, _ = clip_jax.load(args.clip_model)
+    crop_size = 224
+
+    @jax.jit
+    def embed_batch(clip_params, images):
+        images = images.astype(jnp.float32).transpose(0, 3, 1, 2) / 255
+        return image_fn(clip_params, (images - CLIP_MEAN) / CLIP_STD)
+
+    partial_path = args.output + '.partial.npz'
+    if os.path.exists(partial_path):
+        stats = EmbedStats.load(partial_path)
+        print(f'Resuming after {stats.consumed} images ({stats.count} embedded)')
+    else:
+        stats = None
+
+    sources = iter_sources(args.source)
+    if stats is not None:
+        sources = itertools.islice(sources, stats.consumed, None)
+
+    batch = np.zeros([args.batch_size, crop_size, crop_size, 3], dtype=np.uint8)
+    batches_done = 0
+
+    def flush(n, consumed):
+        # The batch is always full-sized so embed_batch compiles once; padding
+        # rows are dropped before accumulating.
+        nonlocal stats, batches_done
+        embeds = np.asarray(embed_batch(clip_params, batch))[:n]
+        if stats is None:
+            stats = EmbedStats(embeds.shape[-1], covariance=args.covariance)
+        stats.update(embeds)
+        stats.consumed = consumed
+        batches_done += 1
+        if batches_done % args.checkpoint_every == 0:
+            stats.save(partial_path)
+            print(f'{stats.consumed} images, {stats.count} embedded')
+
+    # Decode one window ahead of the encoder. Only two windows of images are
+    # ever in flight, which bounds memory regardless of dataset size.
+    consumed = stats.consumed if stats is not None else 0
+    window_size = args.batch_size * 4
+    fill = 0
+    # jax is not fork-safe once initialized, so workers are spawned.
+    with multiprocessing.get_context('spawn').Pool(args.workers) as pool:
+        decode_fn = partial(decode, crop_size=crop_size, resize=args.resize)
+        pending = None
+        for window in itertools.chain(windows(sources, window_size), [None]):
+            upcoming = pool.map_async(decode_fn, window, chunksize=16) if window is not None else None
+            if pending is not None:
+                for image in pending.get():
+                    consumed += 1
+                    if image is None:
+                        continue
+                    batch[fill] = image
+                    fill += 1
+                    if fill == args.batch_size:
+                        flush(fill, consumed)
+                        fill = 0
+            pending = upcoming
+    if fill:
+        flush(fill, consumed)
+
+    if stats is None:
+        raise ValueError(f'no images found in {args.source}')
+    stats.save(partial_path)
+
+    mean = stats.mean().astype(np.float32)
+    np.savez(args.output + '.npz', mean)
+    with open(args.output + '.cbor', 'wb') as fp:
+        jaxtorch.cbor.dump(mean, fp)
+    print(f'Wrote {args.output}.npz and {args.output}.cbor ({stats.count} images)')
+    if args.covariance:
+        np.savez(args.output + '_cov.npz', stats.covariance().astype(np.float32))
+        print(f'Wrote {args.output}_cov.npz')
+
+    if args.store is not None:
+        from lib.embed_store import EmbedStore
+        store = EmbedStore(args.store)
+        name = os.path.basename(args.output)
+        store.add(name, mean, source=os.path.basename(args.output) + '.npz')
+        print(f'Added {name} to {args.store}')
+        if args.direction_from is not None:
+            store.add_direction(f'{name}_minus_{args.direction_from}', name, args.direction_from)
+            print(f'Added {name}_minus_{args.direction_from} to {args.store}')
+    os.remove(partial_path)
+
+if __name__ == '__main__':
+    main()
@@ -4,9 +4,11 @@
 
 import math
 import io
+import json
 import sys
 import time
 import os
+import shutil
 import functools
 from functools import partial
 
@@ -23,9 +25,24 @@ from tqdm import tqdm
 sys.path.append('./CLIP_JAX')
 import clip_jax
 
-from lib.script_util import create_model_and_diffusion, model_and_diffusion_defaults
+from lib.script_util import (create_model_and_diffusion, model_and_diffusion_defaults,
+                             create_classifier, classifier_defaults)
 from lib import util
 from lib.util import pil_from_tensor, pil_to_tensor
+from lib.checkpoint import load_params
+from lib.tensor_archive import open_archive, TensorArchive
+from lib.shared_params import attach_params, attach_tree, load_without_params, unshared_params
+from lib.quantize import is_quantized, load_quantized
+from lib.scan_unet import ScanUNet
+from lib.deep_cache import DeepCache
+from lib.tiled import TiledModel
+from lib.init_images import InitImages, strength_to_skip_timesteps
+from lib.animation import FrameWriter, affine_warp
+from lib.convergence import ConvergenceMonitor
+from lib.classifier_guidance import classifier_cond_fn
+from lib.result_cache import ResultCache
+from lib.text_embed import TextEmbedder
+from lib.embed_store import EmbedStore
 
 # Define necessary functions
 
@@ -139,40 +156,162 @@ model_config.update({
     'num_head_channels': 64,
     'num_res_blocks': 2,
     'resblock_updown': True,
+    # 'use_checkpoint': 'save_matmuls',
+    # 'attention_chunk_size': 256,
+    # 'attention_backend': 'auto',
+    # 'token_merge_ratio': {16: 0.5},  # by downsample rate: the 32x32 layers
     # 'use_fp16': True,
+    # 'fp16_dtype': 'bfloat16',
+    # 'layout': 'NHWC',
     'use_scale_shift_norm': True,
 })
 
+# checkpoint = '256x256_diffusion_uncond.tensors'
+checkpoint = '512x512_diffusion_uncond_finetune_008100.tensors'
+clip_model_name = 'ViT-B/32'
+
+# Under worker_pool.py, weights are mapped from shared memory, and the
+# checkpoint they came from and its model config are set by the parent.
+shared_params = os.environ.get('SHARED_PARAMS')
+if shared_params:
+    checkpoint = os.environ['CHECKPOINT']
+    model_config.update(json.loads(os.environ['MODEL_CONFIG']))
+    clip_model_name = os.environ['CLIP_MODEL']
+
 
 # Load models
 
 model, diffusion = create_model_and_diffusion(**model_config)
-model_params = ParamState(model.labeled_parameters_())
-model_params.initialize(jax.random.PRNGKey(0))
 
 print('Loading state dict...')
-# with open('256x256_diffusion_uncond.cbor', 'rb') as fp:
-with open('512x512_diffusion_uncond_finetune_008100.cbor', 'rb') as fp:
-    jax_state_dict = jaxtorch.cbor.load(fp)
-
-model.load_state_dict(model_params, jax_state_dict)
-
-def exec_model(model_params, x, timesteps, y=None):
+# Tensors are memory-mapped and streamed to the device one at a time. Create
+# the archive with `python convert_checkpoint.py <model>`.
+if shared_params:
+    archive = TensorArchive(os.path.join(shared_params, 'model.tensors'), verify=False)
+    # A shared int8 checkpoint attaches as a QuantizedParamState, as below.
+    model_params = attach_params(model, archive.path)
+else:
+    archive = open_archive(checkpoint)
+    if is_quantized(archive):
+        # int8 weights from quantize_checkpoint.py, dequantized per layer.
+        model_params = load_quantized(model, archive)
+    else:
+        model_params = load_params(model, archive)
+# Identifies the weights in result cache keys. It is computed from the archive
+# headers' per-tensor crc32s, so it costs no reads of tensor data, and a
+# shared copy under worker_pool.py has the digest of its original.
+checkpoint_digest = archive.digest()
+# Convert once here (attention layout, conv layout, half precision) rather than on every call.
+attached = dict(model_params.values)
+model_params = model.prepare_params(model_params)
+if shared_params:
+    # A converted weight would be a private copy in every worker.
+    copied = unshared_params(attached, model_params)
+    if copied:
+        raise ValueError(f'prepare_params() copies {len(copied)} shared tensors ({copied[0]}, ...) in every '
+                         'worker; under worker_pool.py use the NCHW layout, no use_fp16 and an attention '
+                         "backend in the checkpoint's qkv order")
+del attached
+# The timestep embedding of every ResBlock depends only on the timestep, so
+# compute it once for the whole schedule and look it up at each step. The
+# tables take 205 MiB for the 512x512 model; under worker_pool.py each worker
+# would build its own, so they are off there and weights stay shared.
+timestep_tables = not shared_params
+if timestep_tables:
+    model_params = model.precompute_timestep_tables(model_params, diffusion.model_timesteps())
+# Run runs of identical blocks with lax.scan (see lib/scan_unet.py). This
+# halves tracing time; with two res blocks per level, the runs are too short
+# to shorten XLA compilation much (see compile_benchmark.py).
+use_scan = False
+if use_scan:
+    model = ScanUNet(model)
+    model_params = model.stack_params(model_params)
+
+# Reuse the UNet's deep features on cheap steps (see lib/deep_cache.py),
+# running the whole model on full ones. None runs it in full every step.
+deep_cache = None # DeepCache(depth=3, pattern='FC')
+assert not (use_scan and deep_cache), 'ScanUNet has no forward_cached, use_scan and deep_cache do not combine'
+
+# Canvases larger than the model's image_size are sampled in overlapping
+# tiles of that size (see lib/tiled.py), so memory stays that of a batch of
+# tiles. None runs the model on the whole canvas.
+canvas_size = model_config['image_size']
+tiled = None # TiledModel(tile_size=model_config['image_size'], overlap=128, batch_size=2)
+assert not (tiled and deep_cache), 'deep features are per tile, tiling and deep_cache do not combine'
+
+# Stop sampling the batch once every sample's pred_xstart has stopped
+# changing (mode 'jump'), or stop guiding each sample whose pred_xstart has
+# (mode 'unguided') (see lib/convergence.py). None always runs every step
+# with guidance.
+convergence = None # ConvergenceMonitor(threshold=2e-3, patience=5, mode='jump')
+
+# Guide towards ImageNet classes with a noisy classifier instead of CLIP
+# (see lib/classifier_guidance.py): one small encoder forward and backward
+# per step rather than every cutout through the ViT. Labels are cycled over
+# the images of every batch. None guides with CLIP.
+classifier_guidance = None # dict(checkpoint='512x512_classifier.tensors', labels=[207], scale=4.0)
+if classifier_guidance:
+    classifier_model = create_classifier(**dict(classifier_defaults(), image_size=model_config['image_size']))
+    classifier_archive = open_archive(classifier_guidance['checkpoint'])
+    # Keys cached results on the weights, like checkpoint_digest.
+    classifier_digest = classifier_archive.digest()
+    classifier_params = load_params(classifier_model, classifier_archive)
+    classifier_params = classifier_model.prepare_params(classifier_params)
+    classifier_cond = classifier_cond_fn(classifier_model, classifier_params, classifier_guidance['scale'])
+
+def exec_model(model_params, x, timesteps, y=None, deep=None):
     cx = Context(model_params, jax.random.PRNGKey(0))
-    return model(cx, x, timesteps, y=y)
+    if tiled:
+        return tiled(lambda x, timesteps, y=None: model(cx, x, timesteps, y=y), x, timesteps, y=y)
+    if deep is None:
+        return model(cx, x, timesteps, y=y)
+    return model.forward_cached(cx, x, timesteps, y=y, depth=deep_cache.depth, deep=deep)[0]
 exec_model_jit = functools.partial(jax.jit(exec_model), model_params)
 
-def base_cond_fn(x, t, y, text_embed, style_embed, cur_t, key, model_params, clip_params, clip_guidance_scale, style_guidance_scale, tv_scale, sat_scale, make_cutouts, make_cutouts_style):
+# Two-stage rendering: sample with a lower resolution model, then upsample
+# the result and refine it with this one over the end of the schedule only,
+# as with an init image. Most steps then run at a fraction of the pixels.
+# None samples at canvas_size directly.
+first_stage = None # dict(checkpoint='256x256_diffusion_uncond.tensors', image_size=256, timestep_respacing='1000', skip_timesteps=700)
+if first_stage:
+    first_config = dict(model_config,
+                        image_size=first_stage['image_size'],
+                        timestep_respacing=first_stage['timestep_respacing'])
+    first_model, first_diffusion = create_model_and_diffusion(**first_config)
+    archive = open_archive(first_stage['checkpoint'])
+    # Keys cached results on the weights, like checkpoint_digest.
+    first_stage_digest = archive.digest()
+    first_params = (load_quantized if is_quantized(archive) else load_params)(first_model, archive)
+    first_params = first_model.prepare_params(first_params)
+    if timestep_tables:
+        first_params = first_model.precompute_timestep_tables(first_params, first_diffusion.model_timesteps())
+
+    def exec_first_stage(model_params, x, timesteps, y=None, deep=None):
+        return first_model(Context(model_params, jax.random.PRNGKey(0)), x, timesteps, y=y)
+    exec_first_stage_jit = functools.partial(jax.jit(exec_first_stage), first_params)
+
+# (model function, diffusion, parameters) for each stage; 0 is the final one.
+stages = [(exec_model, diffusion, model_params)]
+if first_stage:
+    stages.append((exec_first_stage, first_diffusion, first_params))
+
+def exec_model_cached(model_params, x, timesteps, y=None, deep=None):
+    cx = Context(model_params, jax.random.PRNGKey(0))
+    return model.forward_cached(cx, x, timesteps, y=y, depth=deep_cache.depth, deep=deep)
+exec_model_cached_jit = jax.jit(exec_model_cached)
+
+def base_cond_fn(x, t, y, text_embed, style_embed, cur_t, key, model_params, clip_params, clip_guidance_scale, style_guidance_scale, tv_scale, sat_scale, make_cutouts, make_cutouts_style, deep=None, stage=0):
     rng = PRNG(key)
     n = x.shape[0]
+    (stage_model, stage_diffusion, _) = stages[stage]
 
     def denoise(x):
       my_t = jnp.ones([n], dtype=jnp.int32) * cur_t
-      out = diffusion.p_mean_variance(functools.partial(exec_model,model_params),
-                                      x, my_t,
-                                      clip_denoised=False,
-                                      model_kwargs={'y': y})
-      fac = diffusion.sqrt_one_minus_alphas_cumprod[cur_t]
+      out = stage_diffusion.p_mean_variance(functools.partial(stage_model,model_params,deep=deep),
+                                            x, my_t,
+                                            clip_denoised=False,
+                                            model_kwargs={'y': y})
+      fac = stage_diffusion.sqrt_one_minus_alphas_cumprod[cur_t]
       x_in = out['pred_xstart'] * fac + x * (1 - fac)
       return x_in
     (x_in, backward) = jax.vjp(denoise, x)
@@ -216,27 +355,37 @@ def base_cond_fn(x, t, y, text_embed, style_embed, cur_t, key, model_params, cli
     main_clip_grad += sat_grad
 
     return (-backward(main_clip_grad)[0], tv_grad_512, tv_grad_256, tv_grad_128, sat_grad)
-base_cond_fn = jax.jit(base_cond_fn, static_argnames=['make_cutouts', 'make_cutouts_style'])
+base_cond_fn = jax.jit(base_cond_fn, static_argnames=['make_cutouts', 'make_cutouts_style', 'stage'])
 
 print('Loading CLIP model...')
-image_fn, text_fn, clip_params, _ = clip_jax.load('ViT-B/32') #, "cpu")
+if shared_params:
+    # Only the parent holds CLIP weights: load() is traced, so the ones it
+    # creates are abstract, and the shared copy takes their place.
+    image_fn, text_fn, clip_shapes, _ = load_without_params(clip_jax.load, clip_model_name)
+    clip_params = attach_tree(os.path.join(shared_params, 'clip.tensors'), like=clip_shapes)
+else:
+    image_fn, text_fn, clip_params, _ = clip_jax.load(clip_model_name) #, "cpu")
 clip_size = 224
 normalize = Normalize(mean=[0.48145466, 0.4578275, 0.40821073],
                       std=[0.26862954, 0.26130258, 0.27577711])
 
 
-def txt(prompt):
-  """Returns normalized embedding."""
-  text = clip_jax.tokenize([prompt])
-  text_embed = text_fn(clip_params, text)
-  return norm1(text_embed.reshape(512))
+text_embedder = TextEmbedder(text_fn, clip_params, clip_jax.tokenize, clip_model_name)
 
 def emb_image(image, clip_params=None):
     return norm1(image_fn(clip_params, image))
 
+def clip_score(images, text_embed):
+    """Cosine similarity of CLIP embeddings of images in [-1, 1] to a prompt's."""
+    [n, c, h, w] = images.shape
+    clip_in = jax.image.resize(images.add(1).div(2), [n, c, clip_size, clip_size], method='linear')
+    return (emb_image(normalize(clip_in), clip_params) * norm1(text_embed)).sum(axis=-1)
+
 title = ['sigil of the knight of time. trending on ArtStation']
-prompt = [txt(t) for t in title]
-style_embed = norm1(jnp.array(cborfile('data/openimages_512x_png_embed224.cbor'))) - norm1(jnp.array(cborfile('data/imagenet_512x_jpg_embed224.cbor')))
+prompt = [jnp.array(e) for e in text_embedder.embed(title)]
+# Precomputed norm(openimages) - norm(imagenet), see convert_embeddings.py.
+embed_store = EmbedStore('data/embed_store')
+style_embed = jnp.asarray(embed_store['openimages_minus_imagenet224'])
 batch_size = 1
 clip_guidance_scale = 2000
 style_guidance_scale = 300
@@ -246,52 +395,149 @@ cutn = 32 # effective cutn is 4x this because we do 4 iterations in base_cond_fn
 cut_pow = 0.5
 style_cutn = 32
 n_batches = 4
-init_image = None
-skip_timesteps = 0
+# Image-to-image: paths or URLs, cycled over the images of every batch.
+# Strength 1 samples from noise as without init images; lower strengths
+# skip that fraction of the schedule, start from the noised init image and
+# cost only the remaining steps.
+init_images = None # ['init.png']
+init_strength = 0.5
 seed = 1
 
+# Animation: after a batch's sample, render further frames, each from the
+# previous one zoomed, rotated (degrees) and panned (pixels) on the device,
+# re-noised to skip_timesteps and denoised from there. Each image's frames
+# go to output, formatted with its index: a directory of PNGs, or a video
+# file such as 'zoom_{:05}.mp4'.
+animation = None # dict(frames=120, zoom=1.02, angle=0.5, translate=(0.0, 0.0), skip_timesteps=850, output='frames_{:05}', fps=24)
+
+if classifier_guidance:
+    # The classifier's attention pooling is fixed to its image size.
+    assert canvas_size == model_config['image_size'] and not first_stage, \
+        'classifier guidance needs the whole canvas at the model image size'
+
+if init_images:
+    assert not first_stage, 'first_stage supplies its own init images'
+    # Decoding starts now, in the background.
+    init_loader = InitImages(init_images, fetch)
+    skip_timesteps = strength_to_skip_timesteps(init_strength, diffusion.num_timesteps)
+else:
+    skip_timesteps = 0
+
+# Set by worker_pool.py: this process renders every num_workers-th batch.
+worker_index = int(os.environ.get('WORKER_INDEX', 0))
+num_workers = int(os.environ.get('NUM_WORKERS', 1))
+
+# Finished samples are stored by a hash of everything that affects them, so
+# repeated requests are served without sampling.
+result_cache = ResultCache('cache/results', max_bytes=10 * 2**30)
+
 # Actually do the run
 print('Starting run...')
 
-def run():
-    rng = PRNG(jax.random.PRNGKey(seed))
+def cache_inputs(i, this_title, text_embed):
+    """Everything that affects the output of batch `i`."""
+    return dict(title=this_title,
+                text_embed=text_embed,
+                style_embed=style_embed,
+                seed=seed,
+                batch=i,
+                batch_size=batch_size,
+                clip_guidance_scale=clip_guidance_scale,
+                style_guidance_scale=style_guidance_scale,
+                tv_scale=tv_scale,
+                sat_scale=sat_scale,
+                cutn=cutn,
+                cut_pow=cut_pow,
+                style_cutn=style_cutn,
+                init_images=init_loader.digests() if init_images else None,
+                skip_timesteps=skip_timesteps,
+                model_config=model_config,
+                deep_cache=(deep_cache.depth, deep_cache.pattern) if deep_cache else None,
+                canvas_size=canvas_size,
+                first_stage=dict(first_stage, checkpoint=first_stage_digest) if first_stage else None,
+                tiled=(tiled.tile_size, tiled.overlap) if tiled else None,
+                classifier_guidance=(dict(classifier_guidance, checkpoint=classifier_digest)
+                                     if classifier_guidance else None),
+                convergence=((convergence.threshold, convergence.patience, convergence.mode)
+                             if convergence else None),
+                checkpoint=checkpoint_digest,
+                clip_model=clip_model_name)
 
+def run():
     text_embed = prompt
 
-    init = None
-    # if init_image is not None:
-    #     init = Image.open(fetch(init_image)).convert('RGB')
-    #     init = init.resize((model_config['image_size'], model_config['image_size']), Image.LANCZOS)
-    #     init = TF.to_tensor(init).to(device).unsqueeze(0).mul(2).sub(1)
-
     cur_t = None
+    stage = 0
 
     make_cutouts = MakeCutouts(clip_size, cutn, cut_pow=cut_pow)
     make_cutouts_style = StaticCutouts(clip_size, style_cutn, size=224)
 
     def cond_fn(x, t, y=None):
+        if convergence and convergence.converged:
+            return jnp.zeros_like(x)
         # Triggers recompilation if cutout parameters have changed (cutn or cut_pow).
         grad = base_cond_fn(x, jnp.array(t), y,
                             text_embed=text_embed,
                             style_embed=style_embed,
                             cur_t=jnp.array(cur_t),
                             key=rng.split(),
-                            model_params=model_params,
+                            model_params=stages[stage][2],
                             clip_params=clip_params,
                             clip_guidance_scale = clip_guidance_scale,
                             style_guidance_scale = style_guidance_scale,
                             tv_scale = tv_scale,
                             sat_scale = sat_scale,
                             make_cutouts=make_cutouts,
-                            make_cutouts_style=make_cutouts_style)
+                            make_cutouts_style=make_cutouts_style,
+                            deep=deep_cache.current() if deep_cache and stage == 0 else None,
+                            stage=stage)
         (grad, tv1, tv2, tv4, sat) = grad
         if int(t)%10 == 0:
           print(t, rms(tv1), rms(tv2), rms(tv4), rms(sat))
         magnitude = grad.square().mean().sqrt()
         grad = grad / magnitude * magnitude.clamp(max=0.1)
+        if convergence:
+            # Converged samples go on unguided ('unguided' mode).
+            grad = convergence.mask(grad)
         return grad
 
-    for i in range(n_batches):
+    def classifier_fn(x, t, y=None):
+        if convergence and convergence.converged:
+            return jnp.zeros_like(x)
+        grad = classifier_cond(x, t, y=batch_labels)
+        return convergence.mask(grad) if convergence else grad
+
+    def render_animation(i, frame):
+        """Render the frames after `frame`, batch i's sample."""
+        nonlocal cur_t
+        skip = animation['skip_timesteps']
+        writers = [FrameWriter(animation['output'].format(i * batch_size + k), fps=animation['fps'])
+                   for k in range(batch_size)]
+        for (writer, image) in zip(writers, frame):
+            writer.write(image)
+        for _ in tqdm(range(1, animation['frames'])):
+            frame = affine_warp(frame, animation['zoom'], animation['angle'], animation['translate'])
+            cur_t = diffusion.num_timesteps - skip - 1
+            if deep_cache:
+                deep_cache.reset()
+            for sample in diffusion.p_sample_loop_progressive(
+                    sample_model,
+                    frame.shape,
+                    rng=rng,
+                    clip_denoised=False,
+                    model_kwargs={},
+                    cond_fn=batch_cond_fn,
+                    skip_timesteps=skip,
+                    init_image=frame):
+                cur_t -= 1
+            frame = jnp.array(sample['pred_xstart'])
+            # Encoding overlaps with sampling the next frame.
+            for (writer, image) in zip(writers, frame):
+                writer.write(image)
+        for writer in writers:
+            writer.close()
+
+    for i in range(worker_index, n_batches, num_workers):
         if type(prompt) is list:
           text_embed = prompt[i % len(prompt)]
           this_title = title[i % len(prompt)]
@@ -299,23 +545,75 @@ def run():
           text_embed = prompt
           this_title = title
 
-        cur_t = diffusion.num_timesteps - skip_timesteps - 1
-
+        key = result_cache.key(**cache_inputs(i, this_title, text_embed))
+        hit = result_cache.get(key)
+        if hit is not None and not animation:
+            for k, cached in enumerate(hit[0]):
+                filename = f'progress_{i * batch_size + k:05}.png'
+                shutil.copyfile(cached, filename)
+                print(f'Wrote {filename} (cached {key[:12]})')
+            continue
+
+        # Each batch gets its own key, so that a cached batch can be skipped
+        # without changing the random stream of the ones after it.
+        rng = PRNG(jax.random.fold_in(jax.random.PRNGKey(seed), i))
+        stage_times = []
+        if classifier_guidance:
+            labels = classifier_guidance['labels']
+            batch_labels = jnp.array([labels[(i * batch_size + k) % len(labels)] for k in range(batch_size)])
+            batch_cond_fn = classifier_fn
+        else:
+            batch_cond_fn = cond_fn
+        batch_init = None
+        if init_images:
+            batch_init = init_loader.batch(range(i * batch_size, (i + 1) * batch_size), canvas_size)
+        batch_skip_timesteps = skip_timesteps
+        if first_stage:
+            start = time.perf_counter()
+            stage = 1
+            cur_t = first_diffusion.num_timesteps - 1
+            size = first_stage['image_size']
+            for sample in first_diffusion.p_sample_loop_progressive(
+                    exec_first_stage_jit,
+                    (batch_size, 3, size, size),
+                    rng=rng,
+                    clip_denoised=False,
+                    model_kwargs={},
+                    cond_fn=cond_fn,
+                    progress=tqdm):
+                cur_t -= 1
+            batch_init = jax.image.resize(sample['pred_xstart'], (batch_size, 3, canvas_size, canvas_size),
+                                          method='lanczos3').clamp(-1, 1)
+            batch_skip_timesteps = first_stage['skip_timesteps']
+            stage = 0
+            stage_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        cur_t = diffusion.num_timesteps - batch_skip_timesteps - 1
+
+        if deep_cache:
+            deep_cache.reset()
+            sample_model = functools.partial(deep_cache, exec_model_cached_jit, model_params)
+        else:
+            sample_model = exec_model_jit
         samples = diffusion.p_sample_loop_progressive(
-            exec_model_jit,
-            (batch_size, 3, model_config['image_size'], model_config['image_size']),
+            sample_model,
+            (batch_size, 3, canvas_size, canvas_size),
             rng=rng,
             clip_denoised=False,
             model_kwargs={},
-            cond_fn=cond_fn,
+            cond_fn=batch_cond_fn,
             progress=tqdm,
-            skip_timesteps=skip_timesteps,
-            init_image=init,
+            skip_timesteps=batch_skip_timesteps,
+            init_image=batch_init,
         )
 
+        if convergence:
+            convergence.reset()
         for j, sample in enumerate(samples):
             cur_t -= 1
-            if j % 100 == 0 or cur_t == -1:
+            stop = bool(convergence and convergence.update(sample['pred_xstart']) and convergence.mode == 'jump')
+            if j % 100 == 0 or cur_t == -1 or stop:
                 print()
                 for k, image in enumerate(sample['pred_xstart']):
                     filename = f'progress_{i * batch_size + k:05}.png'
@@ -324,6 +622,27 @@ def run():
                     image = pil_from_tensor(jnp.array(image).add(1).div(2))
                     image.save(filename)
                     print(f'Wrote {filename}')
+            if stop:
+                break
+
+        if convergence:
+            print(convergence.report(diffusion.num_timesteps - batch_skip_timesteps))
+            convergence.reset()
+        stage_times.append(time.perf_counter() - start)
+        # Compare settings (such as first_stage) by time and CLIP similarity.
+        scores = clip_score(jnp.array(sample['pred_xstart']), text_embed)
+        print(f'Batch {i}: {" + ".join(f"{t:.1f}" for t in stage_times)} s, '
+              f'CLIP similarity {", ".join(f"{float(score):.4f}" for score in scores)}')
+
+        final = [pil_from_tensor(jnp.array(image).add(1).div(2)) for image in sample['pred_xstart']]
+        result_cache.put(key, final, metadata={'title': this_title,
+                                               'seed': seed,
+                                               'batch': i,
+                                               'model_config': model_config,
+                                               'checkpoint': checkpoint_digest})
+
+        if animation:
+            render_animation(i, jnp.array(sample['pred_xstart']))
 
         # for k in range(batch_size):
         #     filename = f'progress_{i * batch_size + k:05}.png'
@@ -3,4 +3,5 @@ git clone https://github.com/kingoflolz/CLIP_JAX
 
 # Download checkpoint
 test -a 256x256_diffusion_uncond.pt || curl -OL 'https://openaipublic.blob.core.windows.net/diffusion/jul-2021/256x256_diffusion_uncond.pt'
-test -a 256x256_diffusion_uncond.cbor || python convert_checkpoint.py
\ No newline at end of file
+test -a 256x256_diffusion_uncond.cbor || python convert_checkpoint.py 256x256_diffusion_uncond cbor
+test -a 256x256_diffusion_uncond.tensors || python convert_checkpoint.py 256x256_diffusion_uncond tensors
\ No newline at end of file
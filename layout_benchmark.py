@@ -0,0 +1,101 @@
+"""
+Compare the NCHW and NHWC layouts of the UNet on the current device.
+
+Usage: python layout_benchmark.py [options]
+
+Builds the model in both layouts (see UNetModel's layout option) with the
+same random parameters, and reports the time per forward pass, and per
+forward and backward pass as used by CLIP guidance, along with the largest
+difference between the two layouts' outputs. Parameters are random, so no
+checkpoint is needed; the timings do not depend on the weights.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+from jaxtorch import Context
+from jaxtorch.core import ParamState
+
+from lib.script_util import create_model_and_diffusion, model_and_diffusion_defaults
+
+def time_fn(fn, *args, iterations):
+    jax.block_until_ready(fn(*args))
+    start = time.perf_counter()
+    for _ in range(iterations):
+        jax.block_until_ready(fn(*args))
+    return (time.perf_counter() - start) / iterations
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the UNet in NCHW and NHWC layouts.')
+    parser.add_argument('--image_size', type=int, default=512, choices=[256, 512],
+                        help='selects the model config')
+    parser.add_argument('--test_size', type=int, default=None,
+                        help='resolution of the test inputs (default: image_size)')
+    parser.add_argument('--num_channels', type=int, default=256,
+                        help='base channel count, to benchmark a narrower model')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--use_fp16', action='store_true')
+    parser.add_argument('--forward_only', action='store_true')
+    args = parser.parse_args()
+    test_size = args.test_size or args.image_size
+
+    device = jax.devices()[0]
+    x = jax.random.normal(jax.random.PRNGKey(1), [args.batch_size, 3, test_size, test_size])
+    t = jnp.full([args.batch_size], 500)
+    params = None
+    outputs = {}
+    print(f'{device.platform} ({device.device_kind}), {args.image_size} model at {test_size}x{test_size}, '
+          f'batch size {args.batch_size}, ms per call')
+    for layout in ('NCHW', 'NHWC'):
+        model_config = model_and_diffusion_defaults()
+        model_config.update({
+            'attention_resolutions': '32, 16, 8',
+            'class_cond': False,
+            'diffusion_steps': 1000,
+            'rescale_timesteps': True,
+            'timestep_respacing': '1000',
+            'image_size': args.image_size,
+            'learn_sigma': True,
+            'noise_schedule': 'linear',
+            'num_channels': args.num_channels,
+            'num_head_channels': 64,
+            'num_res_blocks': 2,
+            'resblock_updown': True,
+            'use_fp16': args.use_fp16,
+            'use_scale_shift_norm': True,
+            'layout': layout,
+        })
+        (model, _) = create_model_and_diffusion(**model_config)
+        if params is None:
+            params = ParamState(model.labeled_parameters_())
+            params.initialize(jax.random.PRNGKey(0))
+            # Zero-initialized layers (such as the output convolution) would
+            # make both layouts' outputs trivially equal.
+            for (i, (name, par)) in enumerate(model.named_parameters()):
+                if not params[name].any():
+                    params[name] = 0.02 * jax.random.normal(jax.random.PRNGKey(i), par.shape)
+        else:
+            model.labeled_parameters_()
+        # Both layouts start from the same checkpoint-form parameters.
+        px = model.prepare_params(jax.tree_util.tree_map(lambda p: p, params))
+
+        def forward(px, x):
+            return model(Context(px, jax.random.PRNGKey(0)), x, t)
+        def guidance(px, x):
+            return jax.grad(lambda x: forward(px, x).astype(jnp.float32).square().mean())(x)
+
+        outputs[layout] = np.asarray(jax.jit(forward)(px, x), dtype=np.float32)
+        timings = f'forward {1000 * time_fn(jax.jit(forward), px, x, iterations=args.iterations):10.1f}'
+        if not args.forward_only:
+            timings += f'   forward+backward {1000 * time_fn(jax.jit(guidance), px, x, iterations=args.iterations):10.1f}'
+        print(f'  {layout}  {timings}')
+        del px
+
+    print(f'max |NCHW - NHWC|: {np.abs(outputs["NCHW"] - outputs["NHWC"]).max():.3g}')
+
+if __name__ == '__main__':
+    main()
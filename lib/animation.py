@@ -0,0 +1,126 @@
+"""
+Frame sequences for zoom, pan and rotate animations.
+
+Each frame after the first is sampled from the previous frame, warped by a
+small affine transform on the device and used as the init image for a
+short, partial denoise (see InitImages for the same idea applied to
+files). Finished frames are encoded on a background thread, to a directory
+of PNGs or, through ffmpeg, to a video file, while the next frame samples.
+"""
+
+import os
+import queue
+import subprocess
+import threading
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+from PIL import Image
+
+VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.mov', '.webm')
+
+
+@jax.jit
+def affine_warp(images, zoom=1.0, angle=0.0, translate=(0.0, 0.0)):
+    """
+    Zoom, rotate and translate images about their centres, sampling
+    bilinearly and reflecting at the edges.
+
+    :param images: an [N x C x H x W] Tensor.
+    :param zoom: the scale factor; above 1 zooms in.
+    :param angle: the counterclockwise rotation, in degrees.
+    :param translate: the (x, y) shift of the content, in pixels.
+    :return: the warped Tensor, shaped like `images`.
+    """
+    (n, c, h, w) = images.shape
+    theta = jnp.deg2rad(angle)
+    (cos, sin) = (jnp.cos(theta), jnp.sin(theta))
+    (ys, xs) = jnp.meshgrid(jnp.arange(h, dtype=jnp.float32), jnp.arange(w, dtype=jnp.float32), indexing='ij')
+    # Each output pixel samples the input at the inverse transform of its
+    # position relative to the centre.
+    xs = xs - (w - 1) / 2 - translate[0]
+    ys = ys - (h - 1) / 2 - translate[1]
+    src_x = (cos * xs - sin * ys) / zoom + (w - 1) / 2
+    src_y = (sin * xs + cos * ys) / zoom + (h - 1) / 2
+
+    def warp(channel):
+        return jax.scipy.ndimage.map_coordinates(channel, [src_y, src_x], order=1, mode='reflect')
+    return jax.vmap(jax.vmap(warp))(images)
+
+
+@jax.jit
+def _to_pixels(image):
+    """A [3 x H x W] image in [-1, 1] to [H x W x 3] uint8."""
+    return (image.transpose(1, 2, 0) * 127.5 + 127.5).round().clip(0, 255).astype(jnp.uint8)
+
+
+class FrameWriter(object):
+    """
+    Encodes frames on a background thread, in the order written.
+
+    :param path: a video file, by extension (see VIDEO_EXTENSIONS), encoded
+                 with ffmpeg; otherwise a directory for numbered PNGs.
+    :param fps: the video frame rate.
+    :param max_pending: how many frames may wait for encoding before write()
+                        blocks.
+    """
+
+    def __init__(self, path, fps=24, max_pending=8):
+        self.path = path
+        self.fps = fps
+        self.video = path.lower().endswith(VIDEO_EXTENSIONS)
+        if not self.video:
+            os.makedirs(path, exist_ok=True)
+        self.frames = 0
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, image):
+        """
+        Queue a frame, a [3 x H x W] Tensor in [-1, 1]. Returns once the
+        frame is queued; it is converted to uint8 on the device and its
+        copy to the host is started here.
+        """
+        if self.error is not None:
+            raise self.error
+        pixels = _to_pixels(image)
+        pixels.copy_to_host_async()
+        self.queue.put(pixels)
+
+    def close(self):
+        """Wait for every queued frame to be encoded."""
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        encoder = None
+        while True:
+            pixels = self.queue.get()
+            if pixels is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                pixels = np.asarray(pixels)
+                if not self.video:
+                    Image.fromarray(pixels).save(os.path.join(self.path, f'{self.frames:05}.png'))
+                else:
+                    if encoder is None:
+                        (h, w, _) = pixels.shape
+                        encoder = subprocess.Popen(
+                            ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                             '-s', f'{w}x{h}', '-r', str(self.fps), '-i', '-', '-pix_fmt', 'yuv420p', self.path],
+                            stdin=subprocess.PIPE)
+                    encoder.stdin.write(pixels.tobytes())
+                self.frames += 1
+            except Exception as e:
+                self.error = e
+        if encoder is not None:
+            encoder.stdin.close()
+            if encoder.wait() and self.error is None:
+                self.error = RuntimeError(f'ffmpeg failed writing {self.path}')
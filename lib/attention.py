@@ -0,0 +1,314 @@
+"""
+QKV attention backends for AttentionBlock.
+
+Every backend takes the output of the qkv projection, an [N x (H * 3 * C) x T]
+tensor, and returns an [N x (H * C) x T] tensor. Backends differ in how they
+expect the qkv channels to be ordered (see ORDERS) and in how they compute
+attention. Since the order is only a permutation of the qkv projection's
+output channels, any backend can run any checkpoint: the projection weights
+are permuted once when parameters are prepared (see
+AttentionBlock.prepare_params()).
+"""
+
+import os
+import json
+import math
+import tempfile
+import time
+
+import jax
+import jax.numpy as jnp
+from jaxtorch.core import Module, ParamState
+
+# 'legacy': channels are grouped by head, then by q/k/v.
+# 'new': channels are grouped by q/k/v, then by head.
+ORDERS = ('legacy', 'new')
+
+
+def chunked_attention(q, k, v, chunk_size):
+    """
+    Attention computed over blocks of queries and keys with an online softmax,
+    so that no [T x T] weight matrix is ever materialized. Each block of
+    queries scans over the blocks of keys, keeping a running maximum and sum
+    of the exponentiated weights; the per-block computation is
+    rematerialized in the backward pass, so memory grows linearly in T.
+
+    :param q: an [N x C x T] tensor of queries, already scaled.
+    :param k: an [N x C x T] tensor of keys, already scaled.
+    :param v: an [N x C x T] tensor of values.
+    :param chunk_size: the number of queries and keys per block.
+    :return: an [N x C x T] tensor after attention.
+    """
+    bs, ch, length = q.shape
+    n_chunks = -(-length // chunk_size)
+    pad = n_chunks * chunk_size - length
+    if pad:
+        q, k, v = [jnp.pad(a, [(0, 0), (0, 0), (0, pad)]) for a in (q, k, v)]
+    # Padding keys are masked out; every block holds at least one real key.
+    bias = jnp.where(jnp.arange(n_chunks * chunk_size) < length, 0.0, -jnp.inf)
+    bias = bias.reshape(n_chunks, chunk_size)
+
+    def blocks(a):
+        return a.reshape(bs, ch, n_chunks, chunk_size).transpose(2, 0, 1, 3)
+
+    def attend(q):
+        def step(carry, kv):
+            (acc, m, l) = carry
+            (k, v, bias) = kv
+            weight = jnp.einsum("bct,bcs->bts", q, k).astype(jnp.float32) + bias
+            m_new = jnp.maximum(m, weight.max(axis=-1))
+            p = jnp.exp(weight - m_new[..., None])
+            correction = jnp.exp(m - m_new)
+            l = l * correction + p.sum(axis=-1)
+            acc = acc * correction[:, None, :] + jnp.einsum("bts,bcs->bct", p.astype(v.dtype), v).astype(jnp.float32)
+            return (acc, m_new, l), None
+        init = (jnp.zeros([bs, ch, chunk_size], jnp.float32),
+                jnp.full([bs, chunk_size], -jnp.inf, jnp.float32),
+                jnp.zeros([bs, chunk_size], jnp.float32))
+        (acc, m, l), _ = jax.lax.scan(step, init, (blocks(k), blocks(v), bias))
+        return (acc / l[:, None, :]).astype(v.dtype)
+
+    a = jax.lax.map(jax.checkpoint(attend), blocks(q))
+    return a.transpose(1, 2, 0, 3).reshape(bs, ch, n_chunks * chunk_size)[..., :length]
+
+
+def scaled_attention(q, k, v, chunk_size=None):
+    """
+    Attention over [N x C x T] queries, keys and values, with the softmax in
+    float32. Scales q and k by 1/sqrt(sqrt(C)) each, which is more stable
+    with f16 than dividing afterwards.
+    """
+    ch = q.shape[1]
+    scale = 1 / math.sqrt(math.sqrt(ch))
+    if chunk_size is not None and q.shape[-1] > chunk_size:
+        return chunked_attention(q * scale, k * scale, v, chunk_size)
+    weight = jnp.einsum("bct,bcs->bts", q * scale, k * scale)
+    weight = jax.nn.softmax(weight.astype(jnp.float32), axis=-1).astype(weight.dtype)
+    return jnp.einsum("bts,bcs->bct", weight, v)
+
+
+def check_chunk_size(backend, chunk_size):
+    """Refuse a chunk size a backend would otherwise silently ignore."""
+    if chunk_size is not None:
+        raise ValueError(f'attention backend {backend!r} does not attend in chunks, '
+                         f'but attention_chunk_size={chunk_size} was given')
+
+
+class QKVAttentionLegacy(Module):
+    """
+    A module which performs QKV attention. Matches legacy QKVAttention + input/ouput heads shaping
+
+    :param chunk_size: if specified, sequences longer than this are attended
+                       in blocks of this many queries and keys (see
+                       chunked_attention()).
+    """
+
+    order = 'legacy'
+    chunked = True
+
+    def __init__(self, n_heads, chunk_size=None):
+        super().__init__()
+        self.n_heads = n_heads
+        self.chunk_size = chunk_size
+
+    def forward(self, cx, qkv):
+        """
+        Apply QKV attention.
+
+        :param qkv: an [N x (H * 3 * C) x T] tensor of Qs, Ks, and Vs.
+        :return: an [N x (H * C) x T] tensor after attention.
+        """
+        bs, width, length = qkv.shape
+        assert width % (3 * self.n_heads) == 0
+        ch = width // (3 * self.n_heads)
+        q, k, v = qkv.reshape(bs * self.n_heads, ch * 3, length).split(3, axis=1)
+        a = scaled_attention(q, k, v, self.chunk_size)
+        return a.reshape(bs, width//3, length)
+
+
+class QKVAttention(Module):
+    """
+    A module which performs QKV attention and splits in a different order.
+
+    :param chunk_size: as for QKVAttentionLegacy.
+    """
+
+    order = 'new'
+    chunked = True
+
+    def __init__(self, n_heads, chunk_size=None):
+        super().__init__()
+        self.n_heads = n_heads
+        self.chunk_size = chunk_size
+
+    def forward(self, cx, qkv):
+        """
+        Apply QKV attention.
+
+        :param qkv: an [N x (3 * H * C) x T] tensor of Qs, Ks, and Vs.
+        :return: an [N x (H * C) x T] tensor after attention.
+        """
+        bs, width, length = qkv.shape
+        assert width % (3 * self.n_heads) == 0
+        ch = width // (3 * self.n_heads)
+        q, k, v = qkv.split(3, axis=1)
+        a = scaled_attention(q.reshape(bs * self.n_heads, ch, length),
+                             k.reshape(bs * self.n_heads, ch, length),
+                             v.reshape(bs * self.n_heads, ch, length),
+                             self.chunk_size)
+        return a.reshape(bs, -1, length)
+
+
+class QKVAttentionDotProduct(Module):
+    """
+    QKV attention using jax.nn.dot_product_attention, which may dispatch to a
+    fused kernel (such as cuDNN flash attention) where one is available.
+    Takes qkv in the new order. Does not attend in chunks.
+    """
+
+    order = 'new'
+    chunked = False
+
+    def __init__(self, n_heads, chunk_size=None):
+        super().__init__()
+        check_chunk_size('dot_product', chunk_size)
+        self.n_heads = n_heads
+
+    def forward(self, cx, qkv):
+        bs, width, length = qkv.shape
+        assert width % (3 * self.n_heads) == 0
+        ch = width // (3 * self.n_heads)
+        # [N x T x H x C] for each of q, k, v.
+        q, k, v = qkv.reshape(bs, 3, self.n_heads, ch, length).transpose(1, 0, 4, 2, 3)
+        a = jax.nn.dot_product_attention(q, k, v)
+        return a.transpose(0, 2, 3, 1).reshape(bs, width//3, length)
+
+
+class QKVAttentionReference(Module):
+    """
+    A straightforward float32 einsum implementation of QKV attention, to check
+    the other backends against. Takes qkv in the legacy order. Does not
+    attend in chunks.
+    """
+
+    order = 'legacy'
+    chunked = False
+
+    def __init__(self, n_heads, chunk_size=None):
+        super().__init__()
+        check_chunk_size('reference', chunk_size)
+        self.n_heads = n_heads
+
+    def forward(self, cx, qkv):
+        bs, width, length = qkv.shape
+        assert width % (3 * self.n_heads) == 0
+        ch = width // (3 * self.n_heads)
+        q, k, v = qkv.astype(jnp.float32).reshape(bs, self.n_heads, 3, ch, length).transpose(2, 0, 1, 3, 4)
+        weight = jnp.einsum("nhct,nhcs->nhts", q, k) / math.sqrt(ch)
+        weight = jax.nn.softmax(weight, axis=-1)
+        a = jnp.einsum("nhts,nhcs->nhct", weight, v)
+        return a.reshape(bs, width//3, length).astype(qkv.dtype)
+
+
+ATTENTION_BACKENDS = {
+    'legacy': QKVAttentionLegacy,
+    'new_order': QKVAttention,
+    'reference': QKVAttentionReference,
+}
+if hasattr(jax.nn, 'dot_product_attention'):
+    ATTENTION_BACKENDS['dot_product'] = QKVAttentionDotProduct
+
+
+def permute_qkv(tensor, n_heads, from_order, to_order):
+    """
+    Permute the output channels of a qkv projection weight or bias between
+    channel orders.
+    """
+    if from_order == to_order:
+        return tensor
+    shape = tensor.shape
+    ch = shape[0] // (3 * n_heads)
+    if from_order == 'legacy':
+        tensor = tensor.reshape(n_heads, 3, ch, *shape[1:])
+    else:
+        tensor = tensor.reshape(3, n_heads, ch, *shape[1:])
+    return tensor.swapaxes(0, 1).reshape(shape)
+
+
+SELECTION_CACHE = 'cache/attention_backends.json'
+
+
+def benchmark_attention(backend, length, channels, n_heads, batch_size=1, iterations=5,
+                        chunk_size=None, backward=True, device=None, dtype=jnp.float32):
+    """
+    Time one backend on random inputs of `dtype`.
+
+    :param backward: also time the gradient with respect to qkv, as CLIP
+                     guidance does.
+    :return: seconds per call.
+    """
+    module = ATTENTION_BACKENDS[backend](n_heads, chunk_size=chunk_size)
+    px = ParamState([])
+    if backward:
+        fn = jax.jit(jax.value_and_grad(lambda qkv: module(px, qkv).square().sum()))
+    else:
+        fn = jax.jit(lambda qkv: module(px, qkv))
+    qkv = jax.random.normal(jax.random.PRNGKey(0), [batch_size, 3 * channels, length]).astype(dtype)
+    qkv = jax.device_put(qkv, device)
+    jax.block_until_ready(fn(qkv))
+    start = time.perf_counter()
+    for _ in range(iterations):
+        jax.block_until_ready(fn(qkv))
+    return (time.perf_counter() - start) / iterations
+
+
+def select_attention_backend(length, channels, n_heads, chunk_size=None, device=None,
+                             cache_path=SELECTION_CACHE, candidates=None, dtype=jnp.float32):
+    """
+    Returns the name of the fastest backend for a given sequence length,
+    channel count, head count, dtype and device, benchmarking each candidate
+    the first time and remembering the result in `cache_path`. With a chunk
+    size, only backends that attend in chunks are candidates.
+
+    :raises RuntimeError: if every candidate fails.
+    """
+    device = device or jax.devices()[0]
+    candidates = candidates or [name for name in ATTENTION_BACKENDS if name != 'reference']
+    if chunk_size is not None:
+        candidates = [name for name in candidates if ATTENTION_BACKENDS[name].chunked]
+    key = f'{device.platform}:{device.device_kind}:T={length}:C={channels}:H={n_heads}'
+    if jnp.dtype(dtype) != jnp.float32:
+        # float32 keys keep their earlier form, so existing caches stay valid.
+        key += f':{jnp.dtype(dtype).name}'
+    if chunk_size is not None:
+        key += f':chunk={chunk_size}'
+    cache = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path, 'r') as fp:
+            cache = json.load(fp)
+    if key in cache and cache[key]['backend'] in candidates:
+        return cache[key]['backend']
+
+    timings = {}
+    for name in candidates:
+        try:
+            timings[name] = benchmark_attention(name, length, channels, n_heads,
+                                                chunk_size=chunk_size, device=device, dtype=dtype)
+        except Exception as e:
+            # Not every backend supports every device or dtype.
+            print(f'Attention backend {name} failed for {key}: {e}')
+    if not timings:
+        raise RuntimeError(f'every attention backend failed for {key} (tried {", ".join(candidates)})')
+    best = min(timings, key=timings.get)
+    cache[key] = {'backend': best, 'timings': timings}
+    if cache_path is not None:
+        # Workers under worker_pool.py may select at the same time: write
+        # a whole file and rename it over the cache, so none reads it half
+        # written. Concurrent selections may still overwrite each other.
+        directory = os.path.dirname(cache_path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(cache, fp, indent=1, sort_keys=True)
+        os.replace(tmp, cache_path)
+    return best
@@ -0,0 +1,71 @@
+"""
+Build model parameters directly from checkpoint tensors.
+"""
+
+import numpy as np
+import jax
+from jaxtorch import ParamState
+
+
+def describe(state_dict, name):
+    """
+    Returns the (shape, dtype) of a state dict entry. Lazy mappings such as
+    TensorArchive answer this without reading the tensor data.
+    """
+    if hasattr(state_dict, 'describe'):
+        return state_dict.describe(name)
+    tensor = state_dict[name]
+    return tuple(tensor.shape), np.dtype(tensor.dtype)
+
+
+def validate_state_dict(model, state_dict, strict=True):
+    """
+    Check that `state_dict` matches the parameters of `model`.
+
+    :param strict: if True, unexpected names in the state dict are an error.
+    :raises ValueError: listing every missing, unexpected, misshapen or
+                        non-floating tensor.
+    """
+    errors = []
+    expected = dict(model.named_parameters())
+    for (name, par) in expected.items():
+        if name not in state_dict:
+            errors.append(f'missing parameter: {name}')
+            continue
+        (shape, dtype) = describe(state_dict, name)
+        if shape != tuple(par.shape):
+            errors.append(f'incompatible shape for {name}: expected {tuple(par.shape)}, got {shape}')
+        if not (np.issubdtype(dtype, np.floating) or dtype.name == 'bfloat16'):
+            errors.append(f'non-floating dtype for {name}: {dtype}')
+    if strict:
+        for name in state_dict:
+            if name not in expected:
+                errors.append(f'unexpected parameter: {name}')
+    if errors:
+        raise ValueError('cannot load state dict:\n  ' + '\n  '.join(errors))
+
+
+def load_params(model, state_dict, dtype=np.float32, device=None, strict=True):
+    """
+    Build a ParamState for `model` straight from checkpoint tensors.
+
+    Unlike ParamState.initialize() followed by model.load_state_dict(), this
+    never generates random initial values, and each tensor is transferred to
+    the device exactly once.
+
+    :param model: the jaxtorch Module the parameters belong to.
+    :param state_dict: a mapping from parameter names to numpy arrays. Values
+                       are read one at a time, so a lazy mapping keeps only a
+                       single tensor in host memory.
+    :param dtype: the dtype parameters are stored in on the device.
+    :param device: the device to place parameters on (default: jax's default).
+    :return: a ParamState.
+    """
+    model_params = ParamState(model.labeled_parameters_())
+    validate_state_dict(model, state_dict, strict=strict)
+    for (name, par) in model.named_parameters():
+        tensor = np.asarray(state_dict[name])
+        if dtype is not None and tensor.dtype != dtype:
+            tensor = tensor.astype(dtype)
+        model_params[par] = jax.device_put(tensor, device)
+    return model_params
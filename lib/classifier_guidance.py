@@ -0,0 +1,37 @@
+"""
+Classifier guidance (Dhariwal and Nichol, 2021) with a noisy ImageNet
+classifier (see EncoderUNetModel and script_util.create_classifier()).
+
+Each sampling step is steered by the gradient of the classifier's log
+probability of the target class with respect to the noisy image: one
+forward and backward pass through a small encoder, rather than CLIP
+cutouts through a ViT.
+"""
+
+import jax
+import jax.numpy as jnp
+from jaxtorch import Context
+
+
+def classifier_cond_fn(classifier, classifier_params, scale=1.0):
+    """
+    Make a cond_fn for GaussianDiffusion sampling.
+
+    :param classifier: an EncoderUNetModel.
+    :param classifier_params: its prepared parameters.
+    :param scale: the classifier scale, multiplying the gradient.
+    :return: cond_fn(x, t, y), giving scale * grad_x log p(y | x, t) for an
+             [N] Tensor of class labels y.
+    """
+    @jax.jit
+    def log_prob_grad(params, x, t, y):
+        def log_prob(x):
+            logits = classifier(Context(params, jax.random.PRNGKey(0)), x, t)
+            log_probs = jax.nn.log_softmax(logits.astype(jnp.float32), axis=-1)
+            return jnp.take_along_axis(log_probs, y[:, None], axis=-1).sum()
+        return jax.grad(log_prob)(x)
+
+    def cond_fn(x, t, y=None):
+        assert y is not None, 'classifier guidance needs target labels y'
+        return log_prob_grad(classifier_params, x, t, jnp.asarray(y)) * scale
+    return cond_fn
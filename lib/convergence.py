@@ -0,0 +1,111 @@
+"""
+Convergence monitoring for the sampling loop.
+
+Late in sampling, the model's prediction of the final image (pred_xstart)
+barely changes from step to step, while every step still costs a model
+evaluation and a guidance gradient. A ConvergenceMonitor tracks the
+per-sample RMS change of pred_xstart on the device, and marks a sample as
+converged once it has changed less than a threshold for a number of
+consecutive steps. In 'unguided' mode, each converged sample finishes its
+remaining steps without guidance while the others are still guided. In
+'jump' mode the whole batch stops together, once every sample has
+converged, and pred_xstart is taken as the result, since sampling cannot
+stop for only part of a batch.
+"""
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+
+# What the sampler does once samples have converged.
+MODES = ('jump', 'unguided')
+
+
+@jax.jit
+def _update(previous, current, counts, threshold, patience, done, done_at, step):
+    delta = jnp.sqrt(jnp.mean(jnp.square(current - previous), axis=tuple(range(1, current.ndim))))
+    counts = jnp.where(delta < threshold, counts + 1, 0)
+    newly = (counts >= patience) & ~done
+    return counts, delta, done | newly, jnp.where(newly, step, done_at)
+
+
+class ConvergenceMonitor(object):
+    """
+    :param threshold: the RMS change of pred_xstart (in [-1, 1] units)
+                      below which a step counts as converged.
+    :param patience: the number of consecutive converged steps required.
+    :param mode: 'jump' to stop sampling and return pred_xstart once every
+                 sample has converged, or 'unguided' to finish sampling
+                 each converged sample without guidance (see `done`).
+    """
+
+    def __init__(self, threshold=2e-3, patience=5, mode='jump'):
+        if mode not in MODES:
+            raise ValueError(f'unknown convergence mode {mode!r}, expected one of {MODES}')
+        self.threshold = threshold
+        self.patience = patience
+        self.mode = mode
+        self.reset()
+
+    def reset(self):
+        """Start a new sampling run."""
+        self.previous = None
+        self.counts = None
+        self.delta = None
+        # An [N] bool Tensor of the samples that have converged, which stay
+        # so, and the step at which each did.
+        self.done = None
+        self.done_at = None
+        self.steps = 0
+        self.converged_at = None
+
+    @property
+    def converged(self):
+        """Whether every sample has converged (at once, in 'jump' mode)."""
+        return self.converged_at is not None
+
+    def update(self, pred_xstart):
+        """
+        Record one step's pred_xstart, an [N x ...] Tensor, and update `done`.
+        Returns whether the whole batch has now converged. Only a scalar
+        leaves the device.
+        """
+        self.steps += 1
+        pred_xstart = jnp.asarray(pred_xstart)
+        if self.previous is None:
+            self.counts = jnp.zeros([pred_xstart.shape[0]], jnp.int32)
+            self.done = jnp.zeros([pred_xstart.shape[0]], bool)
+            self.done_at = jnp.zeros([pred_xstart.shape[0]], jnp.int32)
+        else:
+            (self.counts, self.delta, self.done, self.done_at) = _update(
+                self.previous, pred_xstart, self.counts, self.threshold, self.patience,
+                self.done, self.done_at, self.steps)
+            everything = self.counts >= self.patience if self.mode == 'jump' else self.done
+            if not self.converged and bool(everything.all()):
+                self.converged_at = self.steps
+        self.previous = pred_xstart
+        return self.converged
+
+    def mask(self, grad):
+        """
+        Zero the guidance gradient `grad`, an [N x ...] Tensor, of the samples
+        that have converged, in 'unguided' mode.
+        """
+        if self.mode != 'unguided' or self.done is None:
+            return grad
+        return jnp.where(self.done.reshape((-1,) + (1,) * (grad.ndim - 1)), 0, grad)
+
+    def report(self, total_steps):
+        """A line summarizing the run, given the number of steps it had."""
+        if self.mode == 'unguided' and self.done is not None:
+            done_at = np.asarray(self.done_at)[np.asarray(self.done)]
+            if len(done_at):
+                saved = int((total_steps - done_at).sum())
+                total = total_steps * len(self.done)
+                return (f'{len(done_at)} of {len(self.done)} samples converged, '
+                        f'{saved} of {total} sample steps ({100 * saved / total:.0f}%) unguided')
+        if not self.converged:
+            return f'Not converged in {total_steps} steps'
+        saved = total_steps - self.converged_at
+        return (f'Converged after {self.converged_at} of {total_steps} steps, '
+                f'{saved} ({100 * saved / total_steps:.0f}%) skipped')
@@ -0,0 +1,61 @@
+"""
+Reuse of the UNet's deep features across sampling steps, as in DeepCache
+(Ma et al., 2023).
+
+The deep, low resolution blocks of the UNet change little from one
+sampling step to the next. On "full" steps the whole model runs and its
+deep features (see UNetModel.forward_cached()) are kept; on "cheap" steps
+only the shallow, high resolution blocks at either end run, and the kept
+features stand in for the rest. Guidance gradients on cheap steps flow
+through the shallow blocks only.
+"""
+
+FULL = 'F'
+CHEAP = 'C'
+
+
+class DeepCache(object):
+    """
+    Decides, step by step, whether the model runs in full or reuses its deep
+    features, and keeps the features between steps.
+
+    :param depth: the number of shallow blocks at each end of the UNet,
+                  which run on every step.
+    :param pattern: the full/cheap pattern, a string of 'F' and 'C' repeated
+                    over the sampling steps; e.g. 'FCC' runs the whole model
+                    every third step. The first step is always full.
+    """
+
+    def __init__(self, depth=3, pattern='FC'):
+        if not pattern or set(pattern) - {FULL, CHEAP}:
+            raise ValueError(f'invalid deep cache pattern {pattern!r}, expected a string of {FULL!r} and {CHEAP!r}')
+        self.depth = depth
+        self.pattern = pattern
+        self.reset()
+
+    def reset(self):
+        """Start a new sampling run."""
+        self.step = 0
+        self.full = True
+        self.features = None
+
+    def __call__(self, fn, *args, **kwargs):
+        """
+        Take one step's model evaluation, full or cheap per the pattern.
+
+        :param fn: called as fn(*args, deep=features, **kwargs), with
+                   features None on full steps, and returning (output, deep
+                   features) like UNetModel.forward_cached().
+        :return: the output.
+        """
+        self.full = self.features is None or self.pattern[self.step % len(self.pattern)] == FULL
+        (output, self.features) = fn(*args, deep=None if self.full else self.features, **kwargs)
+        self.step += 1
+        return output
+
+    def current(self):
+        """
+        The deep features for other evaluations in the current step (such as
+        the guidance gradient), or None if it is a full step.
+        """
+        return None if self.full else self.features
@@ -0,0 +1,101 @@
+"""
+A memory-mapped store of named embedding vectors and matrices.
+
+The store is a directory of .npy files plus an `index.json` describing them.
+Normalized copies and derived vectors (such as style directions) are computed
+once, when they are added, so that lookups are a read-only np.memmap of the
+stored file: no parsing, no copies and no arithmetic at startup.
+"""
+
+import json
+import os
+import tempfile
+
+import numpy as np
+
+INDEX_NAME = 'index.json'
+
+
+def normalized(x):
+    """Normalize to the unit sphere along the last axis."""
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.sqrt(np.square(x).sum(axis=-1, keepdims=True))
+
+
+def norm_name(name):
+    """The name under which the normalized copy of `name` is stored."""
+    return name + '.norm'
+
+
+class EmbedStore(object):
+    """
+    A directory of named, memory-mapped embeddings.
+
+    :param root: the store directory. It is created on the first add().
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.index = {}
+        self._maps = {}
+        index_path = os.path.join(self.root, INDEX_NAME)
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as fp:
+                self.index = json.load(fp)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getitem__(self, name):
+        """
+        Look up an embedding.
+
+        :return: a read-only np.memmap of the stored array.
+        """
+        if name not in self._maps:
+            if name not in self.index:
+                raise KeyError(f'no embedding named {name!r} in {self.root}')
+            path = os.path.join(self.root, self.index[name]['file'])
+            self._maps[name] = np.load(path, mmap_mode='r')
+        return self._maps[name]
+
+    def names(self):
+        return sorted(self.index)
+
+    def _write_index(self):
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(self.index, fp, indent=1, sort_keys=True)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, os.path.join(self.root, INDEX_NAME))
+
+    def _put(self, name, array, **info):
+        os.makedirs(self.root, exist_ok=True)
+        array = np.ascontiguousarray(array, dtype=np.float32)
+        filename = name.replace('/', '_') + '.npy'
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fp:
+            np.save(fp, array)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, os.path.join(self.root, filename))
+        self._maps.pop(name, None)
+        self.index[name] = dict(file=filename, shape=list(array.shape), dtype=str(array.dtype), **info)
+
+    def add(self, name, array, source=None):
+        """
+        Add an embedding vector ([D]) or matrix ([N x D]) and its normalized copy.
+
+        :param source: where the embedding came from, recorded in the index.
+        """
+        self._put(name, array, source=source)
+        self._put(norm_name(name), normalized(array), derived_from=[name], op='normalize')
+        self._write_index()
+
+    def add_direction(self, name, positive, negative):
+        """
+        Add the direction norm(positive) - norm(negative) between two stored
+        embeddings, e.g. the openimages-minus-imagenet style direction.
+        """
+        direction = np.asarray(self[norm_name(positive)]) - np.asarray(self[norm_name(negative)])
+        self._put(name, direction, derived_from=[positive, negative], op='direction')
+        self._write_index()
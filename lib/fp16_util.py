@@ -0,0 +1,57 @@
+"""
+Helpers for mixed precision inference and training.
+"""
+
+import jax
+import jax.numpy as jnp
+import jaxtorch.nn as nn
+
+HALF_DTYPES = {
+    'bfloat16': jnp.bfloat16,
+    'float16': jnp.float16,
+}
+
+INITIAL_LG_LOSS_SCALE = 20.0
+FP16_SCALE_GROWTH = 1e-3
+
+
+def convert_module_to_f16(module, px, dtype=jnp.bfloat16):
+    """
+    Cast the convolution weights and biases of `module` and its descendants
+    to `dtype`, in place in `px`.
+    """
+    for m in [module] + [m for (_, m) in module.named_modules()]:
+        if isinstance(m, (nn.Conv1d, nn.Conv2d)):
+            for par in (m.weight, m.bias):
+                if par is not None:
+                    cast_param(px, par, dtype)
+
+
+def cast_param(px, par, dtype):
+    if hasattr(px, 'cast'):
+        # Parameter containers that store weights in another form (such as
+        # QuantizedParamState) convert them on read.
+        px.cast(par, dtype)
+    else:
+        px[par] = px[par].astype(dtype)
+
+
+def uses_loss_scaling(model):
+    """float16 gradients underflow without loss scaling; bfloat16 ones do not."""
+    return model.use_fp16 and model.dtype == jnp.float16
+
+
+def unscale_grads(grads, lg_loss_scale):
+    """
+    Undo loss scaling of `grads`.
+
+    :return: (the unscaled grads, whether they are all finite).
+    """
+    grads = jax.tree_util.tree_map(lambda g: g * 2 ** -lg_loss_scale, grads)
+    finite = jnp.all(jnp.stack([jnp.isfinite(g).all() for g in jax.tree_util.tree_leaves(grads)]))
+    return grads, finite
+
+
+def update_lg_loss_scale(lg_loss_scale, finite):
+    """Dynamic loss scaling: back off on overflow, grow slowly otherwise."""
+    return lg_loss_scale + FP16_SCALE_GROWTH if finite else lg_loss_scale - 1
@@ -365,6 +365,13 @@ class GaussianDiffusion:
             return t.float() * (1000.0 / self.num_timesteps)
         return t
 
+    def model_timesteps(self):
+        """
+        The timesteps the model is called with, one for each step of the
+        process, as used by UNetModel.precompute_timestep_tables().
+        """
+        return self._scale_timesteps(jnp.arange(self.num_timesteps))
+
     def condition_mean(self, cond_fn, p_mean_var, x, t, model_kwargs=None):
         """
         Compute the mean for the previous step, given a function cond_fn that
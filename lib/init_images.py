@@ -0,0 +1,88 @@
+"""
+Init images for image-to-image sampling.
+
+Images are fetched and decoded on background threads as soon as they are
+requested, so that decoding overlaps with sampling, and are resized on the
+device. Sampling from an init image starts part of the way through the
+diffusion schedule, from the init image noised to that point, so a
+variation costs only the steps that remain.
+"""
+
+import hashlib
+import io
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+from PIL import Image
+
+
+def strength_to_skip_timesteps(strength, num_timesteps):
+    """
+    The number of initial timesteps to skip for a given init strength.
+
+    :param strength: how much the result may depart from the init image,
+                     from 0 (none: every step is skipped) to 1 (entirely:
+                     sampling starts from pure noise, as without one).
+    :param num_timesteps: the number of sampling steps of the diffusion.
+    """
+    if not 0 <= strength <= 1:
+        raise ValueError(f'init strength must be between 0 and 1, got {strength}')
+    return min(int(round((1 - strength) * num_timesteps)), num_timesteps - 1)
+
+
+@partial(jax.jit, static_argnums=1)
+def _to_tensor(image, size):
+    """
+    A [H x W x 3] uint8 image to a [3 x size x size] Tensor in [-1, 1],
+    center-cropped to a square first so that it is not stretched.
+    """
+    (h, w, _) = image.shape
+    side = min(h, w)
+    top = (h - side) // 2
+    left = (w - side) // 2
+    image = image[top:top + side, left:left + side]
+    image = image.astype(jnp.float32).transpose(2, 0, 1) / 127.5 - 1
+    return jax.image.resize(image, (3, size, size), method='lanczos3').clip(-1, 1)
+
+
+class InitImages(object):
+    """
+    Init images, decoded in the background and batched for sampling.
+
+    :param sources: a list of file paths or URLs.
+    :param fetch: opens a source, returning a file object.
+    :param max_workers: the number of decoding threads.
+    """
+
+    def __init__(self, sources, fetch, max_workers=4):
+        self.sources = list(sources)
+        self.fetch = fetch
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.decoded = [self.executor.submit(self._decode, source) for source in self.sources]
+
+    def _decode(self, source):
+        """:return: (the [H x W x 3] uint8 pixels, a sha256 of the fetched bytes)."""
+        with self.fetch(source) as fp:
+            data = fp.read()
+        return np.asarray(Image.open(io.BytesIO(data)).convert('RGB')), hashlib.sha256(data).hexdigest()
+
+    def digests(self):
+        """
+        A sha256 of the contents of each image, in order. Unlike the sources,
+        these change whenever the file behind a path or URL does.
+        """
+        return [decoded.result()[1] for decoded in self.decoded]
+
+    def batch(self, indices, size):
+        """
+        The images with the given indices (taken modulo the number of
+        images), center-cropped and resized to `size` x `size`.
+
+        :return: an [N x 3 x size x size] Tensor in [-1, 1].
+        """
+        # Images go to the device as uint8, a quarter of the bytes of float32.
+        return jnp.stack([_to_tensor(jnp.asarray(self.decoded[i % len(self.sources)].result()[0]), size)
+                          for i in indices])
@@ -0,0 +1,223 @@
+"""
+Weight-only int8 quantization of UNet checkpoints.
+
+The weights of every Conv1d, Conv2d and Linear layer are stored as int8 with
+one float32 scale per output channel (symmetric, scale = max|w| / 127).
+Biases, normalization parameters and embeddings stay in float32. Quantized
+weights stay int8 on the device and are dequantized where each layer reads
+them, inside the jitted forward pass, so weight memory and checkpoint I/O
+are about 4x smaller than float32. Under gradient checkpointing (see
+unet.checkpoint()) weights also enter each rematerialized block quantized,
+so the backward pass of CLIP guidance saves int8 weights, not float ones.
+
+A quantized checkpoint is a tensor archive (see lib/tensor_archive.py) with
+metadata {'quantization': 'int8'}, holding each quantized weight as `name`
+(int8) and `name`.scale (float32, one entry per output channel).
+"""
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+import jaxtorch.nn as nn
+from jaxtorch.core import Param
+
+from .checkpoint import describe, validate_state_dict
+from .tensor_archive import TensorArchiveWriter
+
+QUANTIZATION = 'int8'
+QUANTIZED_MODULES = (nn.Conv1d, nn.Conv2d, nn.Linear)
+SCALE_SUFFIX = '.scale'
+
+
+def quantized_names(model):
+    """Returns the names of the weights of `model` that are quantized."""
+    names = set()
+    for (module_name, module) in model.named_modules():
+        if isinstance(module, QUANTIZED_MODULES):
+            names.add(f'{module_name}.weight')
+    return names
+
+
+def quantize_weight(weight):
+    """
+    Quantize a weight to int8 with a scale per output channel (axis 0).
+
+    :return: (an int8 array shaped like `weight`, a float32 [out] array).
+    """
+    weight = np.asarray(weight, dtype=np.float32)
+    absmax = np.abs(weight.reshape(weight.shape[0], -1)).max(axis=1)
+    scale = (absmax / 127).astype(np.float32)
+    # All-zero channels (such as zero-initialized output convolutions) get
+    # scale 0 and quantize exactly.
+    divisor = np.where(scale > 0, scale, 1).reshape((-1,) + (1,) * (weight.ndim - 1))
+    quantized = np.clip(np.round(weight / divisor), -127, 127).astype(np.int8)
+    return quantized, scale
+
+
+def dequantize_weight(quantized, scale, dtype=jnp.float32, axis=0):
+    """
+    :param axis: the output channel axis of `quantized`, which `scale` runs along.
+    """
+    shape = [1] * quantized.ndim
+    shape[axis] = -1
+    scale = scale.reshape(shape)
+    return quantized.astype(dtype) * scale.astype(dtype)
+
+
+def save_quantized(model, state_dict, path, metadata=None):
+    """
+    Quantize a float state dict of `model` and write it as an archive, one
+    tensor at a time.
+
+    :param state_dict: a mapping from parameter names to arrays; may be lazy.
+    """
+    validate_state_dict(model, state_dict)
+    names = quantized_names(model)
+    specs = []
+    for name in state_dict.keys():
+        (shape, _) = describe(state_dict, name)
+        if name in names:
+            specs.append((name, np.int8, shape))
+            specs.append((name + SCALE_SUFFIX, np.float32, shape[:1]))
+        else:
+            specs.append((name, np.float32, shape))
+    metadata = dict(metadata or {}, quantization=QUANTIZATION)
+    with TensorArchiveWriter(path, specs, metadata=metadata) as writer:
+        for name in state_dict.keys():
+            tensor = np.asarray(state_dict[name], dtype=np.float32)
+            if name in names:
+                (quantized, scale) = quantize_weight(tensor)
+                writer.write(name, quantized)
+                writer.write(name + SCALE_SUFFIX, scale)
+            else:
+                writer.write(name, tensor)
+
+
+def is_quantized(archive):
+    return getattr(archive, 'metadata', {}).get('quantization') == QUANTIZATION
+
+
+@jax.tree_util.register_pytree_node_class
+class QuantizedParamState(object):
+    """
+    A drop-in replacement for ParamState holding some weights as int8.
+
+    Reading a quantized weight (cx[self.weight]) returns it dequantized, to
+    float32 unless cast() says otherwise, so modules need no changes.
+
+    :param values: a dict from parameter names to arrays.
+    :param scales: a dict from quantized parameter names to their scales.
+    :param axes: a dict from quantized parameter names to their output
+                 channel axis, for weights stored transposed (default 0).
+    """
+
+    mode = 'eval'
+
+    def __init__(self, values, scales, dtypes=None, axes=None):
+        self.values = values
+        self.scales = scales
+        self.dtypes = dict(dtypes or {})
+        self.axes = dict(axes or {})
+
+    def __getitem__(self, par):
+        name = par.name if isinstance(par, Param) else par
+        if name in self.scales:
+            return dequantize_weight(self.values[name], self.scales[name],
+                                     self.dtypes.get(name, jnp.float32),
+                                     self.axes.get(name, 0))
+        return self.values[name]
+
+    def __setitem__(self, par, value):
+        name = par.name if isinstance(par, Param) else par
+        assert name not in self.scales, f'{name} is quantized'
+        self.values[name] = value
+
+    def cast(self, par, dtype):
+        """Dequantize a weight to `dtype` rather than float32 from now on."""
+        name = par.name if isinstance(par, Param) else par
+        if name in self.scales:
+            self.dtypes[name] = dtype
+        else:
+            self.values[name] = self.values[name].astype(dtype)
+
+    def transform(self, par, fn):
+        """
+        Apply `fn` to a parameter as stored. `fn` may only rearrange output
+        channels (axis 0), which are also the axis of the scales.
+        """
+        name = par.name if isinstance(par, Param) else par
+        assert self.axes.get(name, 0) == 0
+        self.values[name] = fn(self.values[name])
+        if name in self.scales:
+            self.scales[name] = fn(self.scales[name])
+
+    def transpose(self, par, axes):
+        """Transpose a parameter as stored, keeping track of its scale axis."""
+        name = par.name if isinstance(par, Param) else par
+        self.values[name] = self.values[name].transpose(axes)
+        if name in self.scales:
+            self.axes[name] = list(axes).index(self.axes.get(name, 0))
+
+    def __contains__(self, par):
+        return (par.name if isinstance(par, Param) else par) in self.values
+
+    def subset(self, pars):
+        """A QuantizedParamState of just the parameters `pars`, still quantized."""
+        names = [par.name if isinstance(par, Param) else par for par in pars]
+        return QuantizedParamState({n: self.values[n] for n in names},
+                                   {n: self.scales[n] for n in names if n in self.scales},
+                                   {n: self.dtypes[n] for n in names if n in self.dtypes},
+                                   {n: self.axes[n] for n in names if n in self.axes})
+
+    # Allows a QuantizedParamState to be used directly as a cx, like ParamState.
+    @property
+    def px(self):
+        return self
+
+    def nbytes(self):
+        return sum(v.nbytes for v in self.values.values()) + sum(s.nbytes for s in self.scales.values())
+
+    def tree_flatten(self):
+        names = sorted(self.values)
+        scale_names = sorted(self.scales)
+        dtypes = tuple(sorted((n, jnp.dtype(d).name) for (n, d) in self.dtypes.items()))
+        axes = tuple(sorted(self.axes.items()))
+        return ([self.values[n] for n in names] + [self.scales[n] for n in scale_names],
+                (tuple(names), tuple(scale_names), dtypes, axes))
+
+    @classmethod
+    def tree_unflatten(cls, aux, leaves):
+        (names, scale_names, dtypes, axes) = aux
+        return cls(dict(zip(names, leaves[:len(names)])),
+                   dict(zip(scale_names, leaves[len(names):])),
+                   {n: jnp.dtype(d) for (n, d) in dtypes},
+                   dict(axes))
+
+
+def load_quantized(model, archive, device=None):
+    """
+    Build a QuantizedParamState for `model` from a quantized archive.
+    """
+    if not is_quantized(archive):
+        raise ValueError(f'{archive.path} is not an {QUANTIZATION} quantized checkpoint')
+    # Names the model's Params, as ParamState(model.labeled_parameters_())
+    # does in load_params(), so that modules can look them up.
+    model.labeled_parameters_()
+    names = quantized_names(model)
+    values = {}
+    scales = {}
+    errors = []
+    for (name, par) in model.named_parameters():
+        if name not in archive:
+            errors.append(f'missing parameter: {name}')
+            continue
+        (shape, dtype) = describe(archive, name)
+        if shape != tuple(par.shape):
+            errors.append(f'incompatible shape for {name}: expected {tuple(par.shape)}, got {shape}')
+            continue
+        values[name] = jax.device_put(np.asarray(archive[name]), device)
+        if name in names:
+            scales[name] = jax.device_put(np.asarray(archive[name + SCALE_SUFFIX]), device)
+    if errors:
+        raise ValueError('cannot load state dict:\n  ' + '\n  '.join(errors))
+    return QuantizedParamState(values, scales)
@@ -102,6 +102,10 @@ class SpacedDiffusion(GaussianDiffusion):
     def condition_score(self, cond_fn, *args, **kwargs):
         return super().condition_score(self._wrap_model(cond_fn), *args, **kwargs)
 
+    def model_timesteps(self):
+        # The wrapped model maps and rescales timesteps.
+        return self._wrap_model(lambda x, ts: ts)(None, jnp.arange(self.num_timesteps))
+
     def _wrap_model(self, model):
         if isinstance(model, _WrappedModel):
             return model
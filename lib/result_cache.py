@@ -0,0 +1,198 @@
+"""
+A content-addressed on-disk store for rendered samples.
+
+Every entry is keyed by a canonical hash of all inputs that affect the
+output of a run (prompt, seed, guidance scales, step counts, model config,
+checkpoint digest, ...). An entry is a directory holding the rendered images
+and a `meta.json` sidecar with the inputs that produced them. The store is
+bounded in size and evicts the least recently used entries first.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+# Bump this whenever the sampler changes in a way that changes outputs for
+# identical inputs, so that stale entries are never served.
+CACHE_VERSION = 1
+
+META_NAME = 'meta.json'
+
+
+def _canonical(value):
+    """
+    Convert a value into a JSON-serializable canonical form.
+
+    Arrays are replaced by a digest of their dtype, shape and contents, so
+    that embeddings and init images can be part of a key without storing them.
+    """
+    if isinstance(value, dict):
+        return {str(k): _canonical(v) for (k, v) in sorted(value.items(), key=lambda kv: str(kv[0]))}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, (bool, str)) or value is None:
+        return value
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        # repr() round-trips exactly, unlike str() on older pythons.
+        return {'float': repr(float(value))}
+    if hasattr(value, 'shape') and hasattr(value, 'dtype'):
+        arr = np.ascontiguousarray(np.asarray(value))
+        digest = hashlib.sha256(arr.tobytes()).hexdigest()
+        return {'array': digest, 'dtype': str(arr.dtype), 'shape': list(arr.shape)}
+    if hasattr(value, 'key') and callable(value.key):
+        # MakeCutouts and friends identify themselves by key().
+        return {'type': type(value).__name__, 'key': _canonical(value.key())}
+    raise TypeError(f'cannot canonicalize value of type {type(value).__name__}')
+
+
+def hash_inputs(inputs):
+    """
+    Compute the canonical hash of a dict of run inputs.
+
+    :param inputs: a dict of everything that affects the output.
+    :return: a hex sha256 digest.
+    """
+    doc = {'version': CACHE_VERSION, 'inputs': _canonical(inputs)}
+    blob = json.dumps(doc, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+def file_digest(path, memo_path=None, chunk_size=1 << 24):
+    """
+    Compute the sha256 digest of a (possibly very large) file.
+
+    Digests are memoized in `memo_path`, keyed by the file's absolute path,
+    size and modification time, so that a multi-gigabyte checkpoint is only
+    hashed once.
+    """
+    st = os.stat(path)
+    memo_key = f'{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}'
+    memo = {}
+    if memo_path is not None and os.path.exists(memo_path):
+        with open(memo_path, 'r') as fp:
+            memo = json.load(fp)
+        if memo_key in memo:
+            return memo[memo_key]
+    h = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        while True:
+            chunk = fp.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    digest = h.hexdigest()
+    if memo_path is not None:
+        memo[memo_key] = digest
+        _atomic_write_json(memo_path, memo)
+    return digest
+
+
+def _atomic_write_json(path, doc):
+    dirname = os.path.dirname(os.path.abspath(path))
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    with os.fdopen(fd, 'w') as fp:
+        json.dump(doc, fp, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+class ResultCache(object):
+    """
+    A size-bounded, content-addressed store of rendered images.
+
+    :param root: directory holding the store.
+    :param max_bytes: the total size of all entries is kept under this
+                      bound by evicting least recently used entries.
+    """
+
+    def __init__(self, root, max_bytes=10 * 2**30):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+
+    def key(self, **inputs):
+        return hash_inputs(inputs)
+
+    def entry_dir(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        """
+        Look up an entry.
+
+        :return: a (filenames, metadata) tuple, or None on a miss. A hit marks
+                 the entry as recently used.
+        """
+        path = self.entry_dir(key)
+        meta_path = os.path.join(path, META_NAME)
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, 'r') as fp:
+            meta = json.load(fp)
+        filenames = [os.path.join(path, name) for name in meta['files']]
+        if not all(os.path.exists(f) for f in filenames):
+            return None
+        now = time.time()
+        os.utime(meta_path, (now, now))
+        return filenames, meta
+
+    def put(self, key, images, metadata=None):
+        """
+        Store a list of PIL images under `key`, replacing any existing entry.
+
+        :param images: the rendered PIL images.
+        :param metadata: a JSON-serializable dict, written to the sidecar.
+        :return: the list of stored filenames.
+        """
+        final = self.entry_dir(key)
+        os.makedirs(os.path.dirname(final), exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(final), suffix='.tmp')
+        files = []
+        for (i, image) in enumerate(images):
+            name = f'{i:05}.png'
+            image.save(os.path.join(tmp, name))
+            files.append(name)
+        meta = {'key': key,
+                'version': CACHE_VERSION,
+                'created': time.time(),
+                'files': files,
+                'inputs': metadata or {}}
+        with open(os.path.join(tmp, META_NAME), 'w') as fp:
+            json.dump(meta, fp, indent=1, sort_keys=True, default=str)
+        if os.path.exists(final):
+            shutil.rmtree(final)
+        os.replace(tmp, final)
+        self.evict()
+        return [os.path.join(final, name) for name in files]
+
+    def entries(self):
+        """Yields (last_used, size_in_bytes, path) for every entry."""
+        for prefix in os.listdir(self.root):
+            prefix_dir = os.path.join(self.root, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                path = os.path.join(prefix_dir, name)
+                meta_path = os.path.join(path, META_NAME)
+                if name.endswith('.tmp') or not os.path.exists(meta_path):
+                    continue
+                size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+                yield (os.path.getmtime(meta_path), size, path)
+
+    def evict(self):
+        """Remove least recently used entries until the store fits in max_bytes."""
+        entries = sorted(self.entries())
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, path) in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+        return total
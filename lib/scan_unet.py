@@ -0,0 +1,192 @@
+"""
+A compile-efficient way to run a UNetModel.
+
+UNetModel unrolls every block, so tracing it (and its VJP, for CLIP
+guidance) builds one copy of the HLO per block. ScanUNet instead runs each
+run of consecutive, structurally identical input or output blocks with
+jax.lax.scan over their stacked parameters, so each run is traced and
+compiled once, whatever its length.
+
+The parameters are those of the wrapped UNetModel, converted with
+stack_params(): the blocks of a run are stored under the names of its first
+block, stacked along a new leading axis, and the other blocks' names are
+dropped. Everything else keeps its standard name.
+"""
+
+import jax
+import jax.numpy as jnp
+from jaxtorch.core import Context, ParamState
+
+from .unet import ResBlock, TIMESTEP_TABLE, channel_axis
+
+SCALARS = (bool, int, float, str, type(None))
+
+
+def block_signature(block):
+    """
+    Everything that determines what a block computes other than its
+    parameter values: the types and settings of its modules and the shapes
+    of its parameters. Blocks with equal signatures can share one trace.
+    """
+    signature = []
+    for (name, module) in [('', block)] + list(block.named_modules()):
+        settings = tuple(sorted((k, v) for (k, v) in vars(module).items()
+                                if k != 'name' and isinstance(v, SCALARS)))
+        signature.append((name, type(module), settings))
+    signature.extend((name, tuple(par.shape)) for (name, par) in block.named_parameters())
+    return tuple(signature)
+
+
+def find_runs(blocks, carried):
+    """
+    Split `blocks` into runs of consecutive blocks with equal signatures.
+
+    :param carried: for each block, whether its output has the shape of the
+                    activations it is passed (and so can be a scan carry).
+    :return: a list of (start, length).
+    """
+    signatures = [block_signature(block) for block in blocks]
+    runs = []
+    start = 0
+    while start < len(blocks):
+        end = start + 1
+        while (end < len(blocks) and carried[start] and carried[end]
+               and signatures[end] == signatures[start]):
+            end += 1
+        runs.append((start, end - start))
+        start = end
+    return runs
+
+
+class ScanUNet(object):
+    """
+    Runs a UNetModel with runs of identical blocks scanned rather than
+    unrolled. Called like the model, with parameters from stack_params().
+
+    :param model: the UNetModel to run.
+    :param min_length: the shortest run of blocks worth a scan.
+    """
+
+    def __init__(self, model, min_length=2):
+        self.model = model
+        self.min_length = min_length
+        self.input_blocks = list(model.input_blocks)
+        self.output_blocks = list(model.output_blocks)
+        # Input blocks only follow identical blocks if those preserved their
+        # channel count, so any run of them can carry its activations.
+        self.input_runs = find_runs(self.input_blocks, [True] * len(self.input_blocks))
+        # An output block takes the previous output concatenated with a skip
+        # connection; it can carry if its output has the previous one's width.
+        carried = []
+        ch = model.middle_block.modules[-1].out_channels
+        for block in self.output_blocks:
+            out_ch = block.modules[0].out_channels
+            carried.append(out_ch == ch)
+            ch = out_ch
+        self.output_runs = find_runs(self.output_blocks, carried)
+
+    def scanned_runs(self):
+        """Yields (blocks name, blocks, start, length) for each scanned run."""
+        for (attr, blocks, runs) in (('input_blocks', self.input_blocks, self.input_runs),
+                                     ('output_blocks', self.output_blocks, self.output_runs)):
+            for (start, length) in runs:
+                if length >= self.min_length:
+                    yield (attr, blocks, start, length)
+
+    def stack_params(self, px):
+        """
+        Map parameters of the wrapped model, in standard (state dict) names,
+        into stacked form. `px` may already be prepared and hold timestep
+        tables (see UNetModel.prepare_params() and
+        precompute_timestep_tables()); int8 weights are dequantized.
+
+        :return: a new ParamState.
+        """
+        names = [name for (name, _) in self.model.named_parameters()]
+        if TIMESTEP_TABLE in px:
+            names.append(TIMESTEP_TABLE)
+            names.extend(module.emb_table_name for (_, module) in self.model.named_modules()
+                         if isinstance(module, ResBlock))
+        # The run each scanned block belongs to, by block name prefix.
+        runs = {}
+        for (attr, _, start, length) in self.scanned_runs():
+            for j in range(length):
+                runs[f'{attr}.{start + j}.'] = (attr, start, j, length)
+
+        result = ParamState([])
+        for name in names:
+            prefix = '.'.join(name.split('.')[:2]) + '.'
+            if prefix not in runs:
+                result[name] = px[name]
+                continue
+            (attr, start, j, length) = runs[prefix]
+            if j == 0:
+                rest = name[len(prefix):]
+                result[name] = jnp.stack([px[f'{attr}.{start + k}.{rest}'] for k in range(length)])
+        return result
+
+    def run(self, cx, blocks, start, length, h, emb, skips=None):
+        """
+        Apply blocks[start:start + length] to `h` with a scan over their
+        stacked parameters, concatenating each with its skip connection from
+        `skips` first if given. Returns (the final output, every output).
+        """
+        template = blocks[start]
+        params = template.parameters()
+        names = [par.name for par in params]
+        if TIMESTEP_TABLE in cx.px:
+            names.extend(module.emb_table_name for (_, module) in template.named_modules()
+                         if isinstance(module, ResBlock))
+        axis = channel_axis(self.model.layout)
+
+        def step(h, xs):
+            (values, key, skip) = xs
+            px = ParamState(params)
+            for (name, value) in zip(names, values):
+                px[name] = value
+            if skip is not None:
+                h = jnp.concatenate([h, skip], axis=axis)
+            h = template(Context(px, key), h, emb)
+            return h, h
+
+        keys = jax.random.split(cx.rng.split(), length)
+        return jax.lax.scan(step, h, ([cx.px[name] for name in names], keys, skips))
+
+    def __call__(self, cx, x, timesteps, y=None):
+        """
+        Apply the model to an input batch, as UNetModel.forward().
+        """
+        model = self.model
+        assert (y is not None) == (
+            model.num_classes is not None
+        ), "must specify y if and only if the model is class-conditional"
+
+        hs = []
+        emb = model.embedding(cx, timesteps, y)
+        axis = channel_axis(model.layout)
+
+        h = x.astype(model.dtype)
+        if model.layout == 'NHWC':
+            h = h.transpose(0, 2, 3, 1)
+        for (start, length) in self.input_runs:
+            if length >= self.min_length:
+                (h, outputs) = self.run(cx, self.input_blocks, start, length, h, emb)
+                hs.extend(outputs[j] for j in range(length))
+            else:
+                for block in self.input_blocks[start:start + length]:
+                    h = block(cx, h, emb)
+                    hs.append(h)
+        h = model.middle_block(cx, h, emb)
+        for (start, length) in self.output_runs:
+            if length >= self.min_length:
+                skips = jnp.stack([hs.pop() for _ in range(length)])
+                (h, _) = self.run(cx, self.output_blocks, start, length, h, emb, skips)
+            else:
+                for block in self.output_blocks[start:start + length]:
+                    h = jnp.concatenate([h, hs.pop()], axis=axis)
+                    h = block(cx, h, emb)
+        (out_norm, _, out_conv) = model.out.modules
+        h = out_conv(cx, out_norm.silu(cx, h.astype(x.dtype)))
+        if model.layout == 'NHWC':
+            h = h.transpose(0, 3, 1, 2)
+        return h
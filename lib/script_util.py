@@ -2,7 +2,7 @@ import argparse
 import inspect
 
 from . import gaussian_diffusion as gd
-from .unet import UNetModel
+from .unet import EncoderUNetModel, UNetModel
 from .respace import SpacedDiffusion, space_timesteps
 
 NUM_CLASSES = 1000
@@ -58,7 +58,12 @@ def model_and_diffusion_defaults():
         use_scale_shift_norm=True,
         resblock_updown=False,
         use_fp16=False,
+        fp16_dtype="bfloat16",
         use_new_attention_order=False,
+        attention_chunk_size=None,
+        attention_backend=None,
+        token_merge_ratio=None,
+        layout="NCHW",
     )
     res.update(diffusion_defaults())
     return res
@@ -93,7 +98,12 @@ def create_model_and_diffusion(
     use_scale_shift_norm,
     resblock_updown,
     use_fp16,
+    fp16_dtype,
     use_new_attention_order,
+    attention_chunk_size,
+    attention_backend,
+    token_merge_ratio,
+    layout,
 ):
     model = create_model(
         image_size,
@@ -111,7 +121,12 @@ def create_model_and_diffusion(
         dropout=dropout,
         resblock_updown=resblock_updown,
         use_fp16=use_fp16,
+        fp16_dtype=fp16_dtype,
         use_new_attention_order=use_new_attention_order,
+        attention_chunk_size=attention_chunk_size,
+        attention_backend=attention_backend,
+        token_merge_ratio=token_merge_ratio,
+        layout=layout,
     )
     diffusion = create_gaussian_diffusion(
         steps=diffusion_steps,
@@ -142,7 +157,12 @@ def create_model(
     dropout=0,
     resblock_updown=False,
     use_fp16=False,
+    fp16_dtype="bfloat16",
     use_new_attention_order=False,
+    attention_chunk_size=None,
+    attention_backend=None,
+    token_merge_ratio=None,
+    layout="NCHW",
 ):
     if channel_mult == "":
         if image_size == 512:
@@ -174,16 +194,103 @@ def create_model(
         num_classes=(NUM_CLASSES if class_cond else None),
         use_checkpoint=use_checkpoint,
         use_fp16=use_fp16,
+        fp16_dtype=fp16_dtype,
         num_heads=num_heads,
         num_head_channels=num_head_channels,
         num_heads_upsample=num_heads_upsample,
         use_scale_shift_norm=use_scale_shift_norm,
         resblock_updown=resblock_updown,
         use_new_attention_order=use_new_attention_order,
+        attention_chunk_size=attention_chunk_size,
+        attention_backend=attention_backend,
+        token_merge_ratio=token_merge_ratio,
+        layout=layout,
     )
 
 
 
+def create_classifier_and_diffusion(
+    image_size,
+    classifier_use_fp16,
+    classifier_width,
+    classifier_depth,
+    classifier_attention_resolutions,
+    classifier_use_scale_shift_norm,
+    classifier_resblock_updown,
+    classifier_pool,
+    learn_sigma,
+    diffusion_steps,
+    noise_schedule,
+    timestep_respacing,
+    use_kl,
+    predict_xstart,
+    rescale_timesteps,
+    rescale_learned_sigmas,
+):
+    classifier = create_classifier(
+        image_size,
+        classifier_use_fp16,
+        classifier_width,
+        classifier_depth,
+        classifier_attention_resolutions,
+        classifier_use_scale_shift_norm,
+        classifier_resblock_updown,
+        classifier_pool,
+    )
+    diffusion = create_gaussian_diffusion(
+        steps=diffusion_steps,
+        learn_sigma=learn_sigma,
+        noise_schedule=noise_schedule,
+        use_kl=use_kl,
+        predict_xstart=predict_xstart,
+        rescale_timesteps=rescale_timesteps,
+        rescale_learned_sigmas=rescale_learned_sigmas,
+        timestep_respacing=timestep_respacing,
+    )
+    return classifier, diffusion
+
+
+def create_classifier(
+    image_size,
+    classifier_use_fp16,
+    classifier_width,
+    classifier_depth,
+    classifier_attention_resolutions,
+    classifier_use_scale_shift_norm,
+    classifier_resblock_updown,
+    classifier_pool,
+):
+    if image_size == 512:
+        channel_mult = (0.5, 1, 1, 2, 2, 4, 4)
+    elif image_size == 256:
+        channel_mult = (1, 1, 2, 2, 4, 4)
+    elif image_size == 128:
+        channel_mult = (1, 1, 2, 3, 4)
+    elif image_size == 64:
+        channel_mult = (1, 2, 3, 4)
+    else:
+        raise ValueError(f"unsupported image size: {image_size}")
+
+    attention_ds = []
+    for res in classifier_attention_resolutions.split(","):
+        attention_ds.append(image_size // int(res))
+
+    return EncoderUNetModel(
+        image_size=image_size,
+        in_channels=3,
+        model_channels=classifier_width,
+        out_channels=NUM_CLASSES,
+        num_res_blocks=classifier_depth,
+        attention_resolutions=tuple(attention_ds),
+        channel_mult=channel_mult,
+        use_fp16=classifier_use_fp16,
+        num_head_channels=64,
+        use_scale_shift_norm=classifier_use_scale_shift_norm,
+        resblock_updown=classifier_resblock_updown,
+        pool=classifier_pool,
+    )
+
+
 def create_gaussian_diffusion(
     *,
     steps=1000,
@@ -0,0 +1,147 @@
+"""
+Share model weights between processes through a memory-mapped file.
+
+A parent process writes its parameters once into a tensor archive on a
+shared-memory filesystem (/dev/shm). Workers map that archive read-only and
+build their parameters from it. On the CPU backend jax.device_put aliases
+aligned host buffers instead of copying them, so every worker's parameters
+point at the same physical pages and memory scales with activations per
+worker rather than with weights x workers. On accelerators each process
+still needs its own device copy, but host memory stays shared.
+
+Memory stays shared only while workers use the attached tensors as they are.
+UNetModel.prepare_params() replaces, and so copies per worker, the weights
+it converts. That happens with the NHWC layout, with use_fp16, and for qkv
+projections when the attention backend's channel order differs from the
+checkpoint's. Under worker_pool.py, execute.py refuses those settings (see
+unshared_params()). Int8
+checkpoints (see lib/quantize.py) are shared as they are, int8 weights with
+their scales, and attached as a QuantizedParamState.
+"""
+
+import os
+import pickle
+
+import numpy as np
+import jax
+
+from .checkpoint import describe, load_params
+from .quantize import QUANTIZATION, SCALE_SUFFIX, is_quantized, load_quantized
+from .tensor_archive import save_archive, TensorArchive, TensorArchiveWriter
+
+SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+def share_state_dict(state_dict, path, dtype=np.float32):
+    """
+    Write a (possibly lazy) state dict to `path` for workers to attach to,
+    one tensor at a time. Tensors are stored in the dtype workers compute in,
+    so that attaching never needs a converted copy. If `state_dict` is an
+    archive, its digest is recorded so the copy identifies as the original.
+    The int8 weights of a quantized archive stay int8, next to their scales.
+    """
+    metadata = {'shared': True}
+    if hasattr(state_dict, 'digest'):
+        metadata['source_digest'] = state_dict.digest()
+    quantized = set()
+    if is_quantized(state_dict):
+        metadata['quantization'] = QUANTIZATION
+        quantized = {name[:-len(SCALE_SUFFIX)] for name in state_dict.keys() if name.endswith(SCALE_SUFFIX)}
+    dtypes = {}
+    specs = []
+    for name in state_dict.keys():
+        (shape, stored) = describe(state_dict, name)
+        dtypes[name] = stored if name in quantized else dtype
+        specs.append((name, dtypes[name], shape))
+    with TensorArchiveWriter(path, specs, metadata=metadata) as writer:
+        for name in state_dict.keys():
+            writer.write(name, np.asarray(state_dict[name]).astype(dtypes[name], copy=False))
+
+
+def attach_params(model, path):
+    """
+    Build a ParamState for `model` from parameters shared with share_state_dict().
+    Tensors keep their stored dtype so they can be aliased rather than copied.
+
+    :return: a ParamState, or a QuantizedParamState if the shared state dict
+             was an int8 checkpoint.
+    """
+    archive = TensorArchive(path, verify=False)
+    if is_quantized(archive):
+        return load_quantized(model, archive)
+    return load_params(model, archive, dtype=None)
+
+
+def unshared_params(attached, px):
+    """
+    The names of parameters that no longer alias the shared tensors, such as
+    weights converted by prepare_params().
+
+    :param attached: a copy of the values dict of `px` as attach_params()
+                     returned it.
+    """
+    return sorted(name for (name, value) in attached.items() if px.values.get(name) is not value)
+
+
+def share_tree(tree, path):
+    """
+    Write an arbitrary pytree of arrays (such as CLIP parameters) to `path`.
+    The tree structure is pickled next to it, in `path`.treedef.
+    """
+    (leaves, treedef) = jax.tree_util.tree_flatten(tree)
+    save_archive(path, {str(i) : np.asarray(leaf) for (i, leaf) in enumerate(leaves)},
+                 metadata={'shared': True})
+    with open(path + '.treedef', 'wb') as fp:
+        pickle.dump(treedef, fp)
+
+
+def attach_tree(path, like=None):
+    """
+    Rebuild a pytree shared with share_tree(), aliasing the shared buffers.
+
+    :param like: if given, a pytree of arrays or ShapeDtypeStructs (as from
+                 load_without_params()) that the shared tree must match in
+                 structure and shapes.
+    """
+    archive = TensorArchive(path, verify=False)
+    with open(path + '.treedef', 'rb') as fp:
+        treedef = pickle.load(fp)
+    if like is not None:
+        (expected, expected_treedef) = jax.tree_util.tree_flatten(like)
+        shapes = [archive.describe(str(i))[0] for i in range(len(archive))]
+        if expected_treedef != treedef or shapes != [tuple(leaf.shape) for leaf in expected]:
+            raise ValueError(f'the tree shared in {path} does not match the model')
+    leaves = [jax.device_put(archive[str(i)]) for i in range(len(archive))]
+    return jax.tree_util.tree_unflatten(treedef, leaves)
+
+
+def load_without_params(load, *args, **kwargs):
+    """
+    Call a loader that returns apply functions together with parameters,
+    such as clip_jax.load(), without keeping the parameters. The call is
+    traced under jax.eval_shape, so the arrays it creates are abstract and
+    never take device memory, and are returned as ShapeDtypeStructs; any
+    host copies the loader reads from disk are freed when it returns.
+
+    :return: the loader's result, with every array replaced by its
+             ShapeDtypeStruct.
+    """
+    traced = {}
+
+    def arrays():
+        (leaves, treedef) = jax.tree_util.tree_flatten(load(*args, **kwargs))
+        is_array = [isinstance(leaf, (jax.Array, np.ndarray)) for leaf in leaves]
+        # Functions and other non-array leaves are kept as they are.
+        traced.update(treedef=treedef, is_array=is_array,
+                      others=[None if a else leaf for (leaf, a) in zip(leaves, is_array)])
+        return [leaf for (leaf, a) in zip(leaves, is_array) if a]
+    shapes = iter(jax.eval_shape(arrays))
+    leaves = [next(shapes) if a else leaf for (leaf, a) in zip(traced['others'], traced['is_array'])]
+    return jax.tree_util.tree_unflatten(traced['treedef'], leaves)
+
+
+def remove_shared(*paths):
+    for path in paths:
+        for p in (path, path + '.treedef'):
+            if os.path.exists(p):
+                os.remove(p)
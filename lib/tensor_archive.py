@@ -0,0 +1,285 @@
+"""
+A header-indexed, memory-mappable archive of named tensors.
+
+Layout of an archive file:
+
+    magic      8 bytes   b'JGDTARC1'
+    length     8 bytes   little-endian uint64, length of the JSON header
+    header     `length` bytes of JSON, space padded
+    data       each tensor's raw little-endian bytes, starting at an offset
+               aligned to ALIGNMENT
+
+The header maps each tensor name to its dtype, shape, absolute offset,
+size in bytes and crc32. Reading an archive parses only the header; tensor
+data is exposed as read-only views of a single np.memmap, so tensors are
+paged in one at a time as they are used and never parsed.
+"""
+
+import hashlib
+import json
+import os
+import struct
+import zlib
+
+import numpy as np
+
+MAGIC = b'JGDTARC1'
+ALIGNMENT = 64
+# crc32s are written as fixed-width hex so that the header can be patched in
+# place once all data is written, without changing its length.
+CRC_PLACEHOLDER = '00000000'
+
+
+def _align(n, alignment=ALIGNMENT):
+    return -(-n // alignment) * alignment
+
+
+def dtype_name(dtype):
+    return np.dtype(dtype).name
+
+
+def dtype_from_name(name):
+    if name == 'bfloat16':
+        import jax.numpy as jnp
+        return np.dtype(jnp.bfloat16)
+    return np.dtype(name)
+
+
+def as_bytes(array):
+    """A flat uint8 view of an array's data."""
+    return np.asarray(array, order='C').reshape(-1).view(np.uint8)
+
+
+def crc32(array):
+    return f'{zlib.crc32(as_bytes(array)) & 0xffffffff:08x}'
+
+
+def _digest(tensors, metadata):
+    """
+    A sha256 digest of an archive's header: each tensor's dtype, shape and
+    crc32, and the metadata. It changes with any tensor's contents but is
+    computed without reading tensor data.
+    """
+    doc = {'metadata': metadata,
+           'tensors': {name: [info['dtype'], info['shape'], info['crc32']]
+                       for (name, info) in tensors.items()}}
+    blob = json.dumps(doc, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+class TensorArchiveWriter(object):
+    """
+    Writes an archive whose tensor names, dtypes and shapes are known up front,
+    accepting the tensor data one at a time.
+
+    :param path: the output file.
+    :param specs: a list of (name, dtype, shape), in storage order.
+    :param metadata: a JSON-serializable dict stored in the header.
+    """
+
+    def __init__(self, path, specs, metadata=None):
+        self.path = path
+        self.tensors = {}
+        offset = 0
+        for (name, dtype, shape) in specs:
+            shape = [int(d) for d in shape]
+            nbytes = int(np.prod(shape, dtype=np.int64)) * dtype_from_name(dtype_name(dtype)).itemsize
+            self.tensors[name] = dict(dtype=dtype_name(dtype), shape=shape, offset=offset,
+                                      nbytes=nbytes, crc32=CRC_PLACEHOLDER)
+            offset = _align(offset + nbytes)
+        self.metadata = metadata or {}
+        self.data_size = offset
+
+        # The data offsets depend on the header length and vice versa; the
+        # header is padded so that data starts at an aligned offset.
+        base = _align(len(MAGIC) + 8 + len(self._encode_header()) + 16 * len(self.tensors))
+        for info in self.tensors.values():
+            info['offset'] += base
+        self.header_length = base - len(MAGIC) - 8
+        self.fp = open(path, 'wb')
+        self._write_header()
+        self.fp.truncate(base + self.data_size)
+        self.written = set()
+
+    def _encode_header(self, pad_to=0):
+        header = json.dumps({'alignment': ALIGNMENT,
+                             'metadata': self.metadata,
+                             'tensors': self.tensors}, sort_keys=True).encode('utf-8')
+        return header.ljust(pad_to, b' ')
+
+    def _write_header(self):
+        self.fp.seek(0)
+        self.fp.write(MAGIC)
+        self.fp.write(struct.pack('<Q', self.header_length))
+        header = self._encode_header(self.header_length)
+        assert len(header) == self.header_length
+        self.fp.write(header)
+
+    def write(self, name, array):
+        info = self.tensors[name]
+        array = np.asarray(array, order='C')
+        if dtype_name(array.dtype) != info['dtype'] or list(array.shape) != info['shape']:
+            raise ValueError(f'tensor {name} is {dtype_name(array.dtype)}{list(array.shape)}, '
+                             f'expected {info["dtype"]}{info["shape"]}')
+        array = array.astype(array.dtype.newbyteorder('<'), copy=False)
+        info['crc32'] = crc32(array)
+        self.fp.seek(info['offset'])
+        self.fp.write(as_bytes(array))
+        self.written.add(name)
+
+    def close(self):
+        missing = set(self.tensors) - self.written
+        if missing:
+            raise ValueError(f'tensors never written: {sorted(missing)}')
+        self._write_header()
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.fp.close()
+
+
+def save_archive(path, tensors, metadata=None):
+    """
+    Write a dict of numpy arrays as an archive.
+    """
+    specs = [(name, np.asarray(t).dtype, np.shape(t)) for (name, t) in tensors.items()]
+    with TensorArchiveWriter(path, specs, metadata=metadata) as writer:
+        for (name, t) in tensors.items():
+            writer.write(name, np.asarray(t))
+
+
+class TensorArchive(object):
+    """
+    A read-only, lazily loaded mapping from names to tensors in an archive.
+
+    :param path: the archive file.
+    :param verify: if True, check each tensor's crc32 the first time it is
+                   accessed.
+    """
+
+    def __init__(self, path, verify=True):
+        self.path = path
+        self.verify = verify
+        with open(path, 'rb') as fp:
+            magic = fp.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError(f'{path} is not a tensor archive')
+            (length,) = struct.unpack('<Q', fp.read(8))
+            header = json.loads(fp.read(length).decode('utf-8'))
+        self.tensors = header['tensors']
+        self.metadata = header['metadata']
+        self.mmap = np.memmap(path, dtype=np.uint8, mode='r')
+        self.verified = set()
+
+    def __len__(self):
+        return len(self.tensors)
+
+    def __iter__(self):
+        return iter(self.tensors)
+
+    def __contains__(self, name):
+        return name in self.tensors
+
+    def keys(self):
+        return self.tensors.keys()
+
+    def items(self):
+        return ((name, self[name]) for name in self.tensors)
+
+    def describe(self, name):
+        """Returns the (shape, dtype) of a tensor without touching its data."""
+        info = self.tensors[name]
+        return tuple(info['shape']), dtype_from_name(info['dtype'])
+
+    def digest(self):
+        """
+        A digest of the archive's contents, from its header alone. An archive
+        copied from another (see shared_params.share_state_dict) records and
+        returns the digest of the original.
+        """
+        if 'source_digest' in self.metadata:
+            return self.metadata['source_digest']
+        return _digest(self.tensors, self.metadata)
+
+    def __getitem__(self, name):
+        info = self.tensors[name]
+        (shape, dtype) = self.describe(name)
+        data = self.mmap[info['offset']:info['offset'] + info['nbytes']]
+        array = data.view(dtype.newbyteorder('<')).reshape(shape)
+        if self.verify and name not in self.verified:
+            if crc32(data) != info['crc32']:
+                raise ValueError(f'checksum mismatch for tensor {name} in {self.path}')
+            self.verified.add(name)
+        return array
+
+
+def write_shard_index(path, weight_map):
+    """
+    Write the index of a sharded archive: a JSON file mapping each tensor
+    name to the (relative) archive file holding it.
+    """
+    with open(path, 'w') as fp:
+        json.dump({'weight_map': weight_map}, fp, indent=1, sort_keys=True)
+
+
+class ShardedTensorArchive(object):
+    """
+    A read-only mapping over the shards listed in a shard index.
+
+    :param path: the index file, <model>.tensors.json.
+    :param verify: passed on to each TensorArchive.
+    """
+
+    def __init__(self, path, verify=True):
+        self.path = path
+        with open(path, 'r') as fp:
+            self.weight_map = json.load(fp)['weight_map']
+        dirname = os.path.dirname(path)
+        self.shards = {filename: TensorArchive(os.path.join(dirname, filename), verify=verify)
+                       for filename in sorted(set(self.weight_map.values()))}
+
+    def __len__(self):
+        return len(self.weight_map)
+
+    def __iter__(self):
+        return iter(self.weight_map)
+
+    def __contains__(self, name):
+        return name in self.weight_map
+
+    def keys(self):
+        return self.weight_map.keys()
+
+    def items(self):
+        return ((name, self[name]) for name in self.weight_map)
+
+    def describe(self, name):
+        return self.shards[self.weight_map[name]].describe(name)
+
+    def digest(self):
+        """A digest of the contents of all shards, as for TensorArchive.digest()."""
+        tensors = {name: self.shards[filename].tensors[name]
+                   for (name, filename) in self.weight_map.items()}
+        metadata = {filename: shard.metadata for (filename, shard) in self.shards.items()}
+        return _digest(tensors, metadata)
+
+    def __getitem__(self, name):
+        return self.shards[self.weight_map[name]][name]
+
+
+def open_archive(path, verify=True):
+    """
+    Open a single archive, or a sharded one given either its index or the
+    .tensors name it was written under.
+    """
+    if path.endswith('.json'):
+        return ShardedTensorArchive(path, verify=verify)
+    if not os.path.exists(path) and os.path.exists(path + '.json'):
+        return ShardedTensorArchive(path + '.json', verify=verify)
+    return TensorArchive(path, verify=verify)
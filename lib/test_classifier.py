@@ -0,0 +1,140 @@
+import numpy as np
+import jax
+import jax.numpy as jnp
+from jaxtorch.core import Context, ParamState, PRNG
+
+from lib import unet
+from lib.classifier_guidance import classifier_cond_fn
+from lib.script_util import NUM_CLASSES, classifier_defaults, create_classifier
+
+
+class RecordingParamState(ParamState):
+    """A ParamState remembering which parameters were read."""
+
+    def __getitem__(self, par):
+        self.read.add(getattr(par, 'name', par))
+        return super().__getitem__(par)
+
+
+def random_params(model, key, std=0.1):
+    # Zero-initialized layers are randomized too, so every one of them
+    # affects the output.
+    rng = PRNG(key)
+    px = ParamState(model.labeled_parameters_())
+    for (_, par) in model.named_parameters():
+        px[par] = std * jax.random.normal(rng.split(), par.shape)
+    return px
+
+
+def test_create_classifier_defaults():
+    # The 64x64 noisy ImageNet classifier, as released with guided-diffusion.
+    model = create_classifier(**classifier_defaults())
+    shapes = {name: tuple(par.shape) for (name, par) in model.named_parameters()}
+    expected = {
+        'time_embed.0.weight': (512, 128),
+        'time_embed.2.weight': (512, 512),
+        'input_blocks.0.0.weight': (128, 3, 3, 3),
+        'input_blocks.1.0.in_layers.0.weight': (128,),
+        'input_blocks.1.0.emb_layers.1.weight': (256, 512),
+        'input_blocks.3.0.op.weight': None,
+        'input_blocks.3.0.out_layers.3.weight': (128, 128, 3, 3),
+        'input_blocks.4.0.skip_connection.weight': (256, 128, 1, 1),
+        'input_blocks.11.0.out_layers.3.weight': (512, 512, 3, 3),
+        'input_blocks.11.1.qkv.weight': (1536, 512, 1),
+        'input_blocks.11.1.proj_out.weight': (512, 512, 1),
+        'middle_block.1.norm.weight': (512,),
+        'middle_block.2.skip_connection.weight': None,
+        'out.0.weight': (512,),
+        'out.2.positional_embedding': (512, 65),
+        'out.2.qkv_proj.weight': (1536, 512, 1),
+        'out.2.c_proj.weight': (NUM_CLASSES, 512, 1),
+        'out.2.c_proj.bias': (NUM_CLASSES,),
+    }
+    for (name, shape) in expected.items():
+        if shape is None:
+            assert name not in shapes, name
+        else:
+            assert shapes.get(name) == shape, (name, shapes.get(name))
+    assert 'input_blocks.12.0.in_layers.0.weight' not in shapes
+
+    # Every parameter is read by the forward pass.
+    px = random_params(model, jax.random.PRNGKey(0))
+    recording = RecordingParamState(model.labeled_parameters_())
+    recording.values = px.values
+    recording.read = set()
+    x = jax.random.normal(jax.random.PRNGKey(1), [2, 3, 64, 64])
+    logits = model(Context(recording, jax.random.PRNGKey(2)), x, jnp.array([10, 900]))
+    assert logits.shape == (2, NUM_CLASSES)
+    assert np.isfinite(logits).all()
+    assert recording.read == set(shapes)
+
+
+def test_GroupNorm32_flat():
+    # The spatial_v2 head normalizes [N x 2048] features, with no spatial axes.
+    norm = unet.normalization(2048)
+    px = ParamState(norm.labeled_parameters_())
+    px.initialize(jax.random.PRNGKey(0))
+    px[norm.weight] = jax.random.normal(jax.random.PRNGKey(1), [2048])
+    px[norm.bias] = jax.random.normal(jax.random.PRNGKey(2), [2048])
+    x = 3 + 2 * jax.random.normal(jax.random.PRNGKey(3), [4, 2048])
+    out = norm(Context(px, None), x)
+
+    groups = np.asarray(x).reshape(4, 32, 64)
+    mean = groups.mean(axis=-1, keepdims=True)
+    var = groups.var(axis=-1, keepdims=True)
+    expected = ((groups - mean) / np.sqrt(var + 1e-5)).reshape(4, 2048)
+    expected = expected * np.asarray(px[norm.weight]) + np.asarray(px[norm.bias])
+    assert out.shape == (4, 2048)
+    np.testing.assert_allclose(out, expected, rtol=1e-4, atol=1e-4)
+
+
+def test_EncoderUNetModel_spatial_v2():
+    model = unet.EncoderUNetModel(image_size=32, in_channels=3, model_channels=32, out_channels=10,
+                                  num_res_blocks=1, attention_resolutions=(4,), channel_mult=(1, 2),
+                                  num_head_channels=32, pool='spatial_v2')
+    px = random_params(model, jax.random.PRNGKey(4))
+    x = jax.random.normal(jax.random.PRNGKey(5), [2, 3, 32, 32])
+    logits = model(Context(px, jax.random.PRNGKey(6)), x, jnp.array([1, 500]))
+    assert logits.shape == (2, 10)
+    assert np.isfinite(logits).all()
+
+
+def test_classifier_cond_fn():
+    model = unet.EncoderUNetModel(image_size=32, in_channels=3, model_channels=32, out_channels=10,
+                                  num_res_blocks=1, attention_resolutions=(2,), channel_mult=(1, 2),
+                                  num_head_channels=32, use_scale_shift_norm=True,
+                                  resblock_updown=True, pool='attention')
+    px = model.prepare_params(random_params(model, jax.random.PRNGKey(0)))
+    x = jax.random.normal(jax.random.PRNGKey(1), [2, 3, 32, 32])
+    t = jnp.array([100.0, 700.0])
+    y = jnp.array([3, 7])
+
+    def log_prob(x):
+        logits = model(Context(px, jax.random.PRNGKey(0)), x, t)
+        return jnp.take_along_axis(jax.nn.log_softmax(logits, axis=-1), y[:, None], axis=-1).sum()
+
+    cond_fn = classifier_cond_fn(model, px, scale=3.0)
+    grad = cond_fn(x, t, y=y)
+    assert grad.shape == x.shape
+
+    # Central differences of log p(y | x, t) along random directions.
+    eps = 1e-2
+    for seed in range(3):
+        v = jax.random.normal(jax.random.PRNGKey(10 + seed), x.shape)
+        v = v / jnp.sqrt(jnp.square(v).sum())
+        numeric = (log_prob(x + eps * v) - log_prob(x - eps * v)) / (2 * eps)
+        np.testing.assert_allclose((grad * v).sum() / 3.0, numeric, rtol=2e-2, atol=1e-4)
+
+
+def test_EncoderUNetModel_use_checkpoint():
+    args = dict(image_size=32, in_channels=3, model_channels=32, out_channels=10, num_res_blocks=1,
+                attention_resolutions=(2,), channel_mult=(1, 2), num_head_channels=32)
+    try:
+        unet.EncoderUNetModel(use_checkpoint='attn', **args)
+    except ValueError:
+        pass
+    else:
+        assert False, 'expected a ValueError'
+    model = unet.EncoderUNetModel(use_checkpoint='attention', **args)
+    blocks = [m for (_, m) in model.named_modules() if isinstance(m, (unet.ResBlock, unet.AttentionBlock))]
+    assert all(m.use_checkpoint == isinstance(m, unet.AttentionBlock) for m in blocks)
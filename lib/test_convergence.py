@@ -0,0 +1,38 @@
+import numpy as np
+import jax.numpy as jnp
+
+from lib.convergence import ConvergenceMonitor
+
+
+def run(monitor, moving, steps=10):
+    # Sample k's pred_xstart keeps changing while moving[k], else is still.
+    x = jnp.zeros([len(moving), 3, 4, 4])
+    results = []
+    for step in range(steps):
+        x = x + jnp.array(moving, jnp.float32)[:, None, None, None] * (step + 1)
+        results.append(monitor.update(x))
+    return results
+
+
+def test_unguided_per_sample():
+    monitor = ConvergenceMonitor(threshold=1e-3, patience=3, mode='unguided')
+    results = run(monitor, [False, True])
+    assert not any(results)
+    np.testing.assert_array_equal(monitor.done, [True, False])
+    grad = jnp.ones([2, 3, 4, 4])
+    masked = monitor.mask(grad)
+    assert (masked[0] == 0).all() and (masked[1] == 1).all()
+    assert monitor.report(10).startswith('1 of 2 samples converged')
+
+
+def test_jump_whole_batch():
+    monitor = ConvergenceMonitor(threshold=1e-3, patience=3, mode='jump')
+    run(monitor, [False, True])
+    assert not monitor.converged
+    # Only 'unguided' mode acts on single samples.
+    grad = jnp.ones([2, 3, 4, 4])
+    assert (monitor.mask(grad) == grad).all()
+    monitor.reset()
+    results = run(monitor, [False, False])
+    assert results.index(True) == 3
+    assert monitor.report(10) == 'Converged after 4 of 10 steps, 6 (60%) skipped'
@@ -0,0 +1,34 @@
+import numpy as np
+import jax
+import jax.numpy as jnp
+from jaxtorch.core import Context, ParamState
+
+from lib.script_util import create_model_and_diffusion, model_and_diffusion_defaults
+
+
+def test_timestep_tables():
+    config = model_and_diffusion_defaults()
+    config.update(image_size=64, num_channels=32, num_head_channels=16, num_res_blocks=1,
+                  attention_resolutions='16', learn_sigma=True, use_scale_shift_norm=True,
+                  resblock_updown=True, rescale_timesteps=True, timestep_respacing='50')
+    (model, diffusion) = create_model_and_diffusion(**config)
+    px = ParamState(model.labeled_parameters_())
+    px.initialize(jax.random.PRNGKey(0))
+    # Randomize the zero-initialized output layers, so that they matter.
+    for (_, par) in model.named_parameters():
+        px[par] = px[par] + 0.02 * jax.random.normal(jax.random.PRNGKey(1), par.shape)
+    plain = ParamState(model.labeled_parameters_())
+    plain.values = dict(px.values)
+    tables = model.precompute_timestep_tables(px, diffusion.model_timesteps())
+
+    x = jax.random.normal(jax.random.PRNGKey(2), [3, 3, 64, 64])
+    ts = diffusion.model_timesteps()[jnp.array([0, 20, 49])]
+
+    @jax.jit
+    def run(params, ts):
+        return model(Context(params, jax.random.PRNGKey(0)), x, ts)
+
+    # Timesteps in the tables are looked up, others embedded in full, also
+    # within one batch.
+    for timesteps in (ts, ts + 7, ts.at[1].add(7)):
+        np.testing.assert_allclose(run(tables, timesteps), run(plain, timesteps), rtol=1e-4, atol=1e-5)
@@ -51,6 +51,23 @@ def test_QKVAttentionLegacy():
     difference = np.abs(new_result - old_result).max()
     assert difference < 1e-6, difference
 
+@torch.no_grad()
+def test_QKVAttentionLegacy_chunked():
+    H = 4
+    C = 4
+    T = 100
+    new_module = unet.QKVAttentionLegacy(n_heads=H, chunk_size=32)
+    old_module = old_unet.QKVAttentionLegacy(n_heads=H)
+
+    x = jax.random.normal(key=jax.random.PRNGKey(0), shape=[2, (H * 3 * C), T])
+    x_torch = torch.tensor(np.array(x))
+    cx = Context(ParamState([]), jax.random.PRNGKey(1))
+
+    new_result = np.array(new_module(cx, x))
+    old_result = np.array(old_module(x_torch))
+    difference = np.abs(new_result - old_result).max()
+    assert difference < 1e-5, difference
+
 @torch.no_grad()
 def test_Upsample2D():
     rng = PRNG(jax.random.PRNGKey(0))
@@ -183,6 +200,36 @@ def test_ResBlock():
     old_result = old_module(x_torch, emb_torch)
     check(old_result, new_result)
 
+def test_group_norm_silu():
+    rng = PRNG(jax.random.PRNGKey(0))
+
+    C = 64
+    x = jax.random.normal(key=rng.split(), shape=[2, C, 8, 8])
+    weight = jax.random.normal(key=rng.split(), shape=[C])
+    bias = jax.random.normal(key=rng.split(), shape=[C])
+    scale = jax.random.normal(key=rng.split(), shape=[2, C])
+    shift = jax.random.normal(key=rng.split(), shape=[2, C])
+    dy = jax.random.normal(key=rng.split(), shape=[2, C, 8, 8])
+
+    old_args = [totorch(a).requires_grad_() for a in (x, weight, bias, scale, shift)]
+    (x_torch, weight_torch, bias_torch, scale_torch, shift_torch) = old_args
+    old_result = torch.nn.functional.group_norm(x_torch, 32, weight_torch, bias_torch)
+    old_result = old_result * (1 + scale_torch[..., None, None]) + shift_torch[..., None, None]
+    old_result = torch.nn.functional.silu(old_result)
+    old_result.backward(totorch(dy))
+
+    # The custom VJP matches autograd, in either layout.
+    for layout in unet.LAYOUTS:
+        def fn(x, weight, bias, scale, shift):
+            if layout == 'NHWC':
+                x = x.transpose(0, 2, 3, 1)
+            y = unet.group_norm_silu(x, weight, bias, 32, scale=scale, shift=shift, layout=layout)
+            return y.transpose(0, 3, 1, 2) if layout == 'NHWC' else y
+        (new_result, vjp) = jax.vjp(fn, x, weight, bias, scale, shift)
+        check(old_result.detach(), new_result)
+        for (old_grad, new_grad) in zip(old_args, vjp(dy)):
+            check(old_grad.grad, new_grad)
+
 @torch.no_grad()
 def test_AttentionBlock():
     rng = PRNG(jax.random.PRNGKey(0))
@@ -201,6 +248,44 @@ def test_AttentionBlock():
     old_result = old_module(x_torch)
     check(old_result, new_result)
 
+@torch.no_grad()
+def test_QKVAttention():
+    H = 4
+    C = 4
+    T = 2
+    new_module = unet.QKVAttention(n_heads=H)
+    old_module = old_unet.QKVAttention(n_heads=H)
+
+    x = jax.random.normal(key=jax.random.PRNGKey(0), shape=[2, (H * 3 * C), T])
+    x_torch = torch.tensor(np.array(x))
+    cx = Context(ParamState([]), jax.random.PRNGKey(1))
+
+    new_result = np.array(new_module(cx, x))
+    old_result = np.array(old_module(x_torch))
+    difference = np.abs(new_result - old_result).max()
+    assert difference < 1e-6, difference
+
+@torch.no_grad()
+def test_AttentionBlock_backends():
+    rng = PRNG(jax.random.PRNGKey(0))
+
+    C = 64
+    old_module = old_unet.AttentionBlock(C, num_head_channels=16)
+    x = jax.random.normal(key=rng.split(), shape=[1, C, 8, 8])
+    x_torch = totorch(x)
+    old_result = old_module(x_torch)
+
+    # The same (legacy order) checkpoint runs on every backend.
+    for backend in unet.ATTENTION_BACKENDS:
+        new_module = unet.AttentionBlock(C, num_head_channels=16, attention_backend=backend)
+        px = ParamState(new_module.labeled_parameters_())
+        px.initialize(rng.split())
+        new_module.load_state_dict(px, {name : par.cpu().numpy() for (name, par) in old_module.state_dict().items()})
+        new_module.prepare_params(px)
+
+        new_result = new_module(px, x)
+        check(old_result, new_result)
+
 @torch.no_grad()
 def test_UNetModel():
     rng = PRNG(jax.random.PRNGKey(0))
@@ -277,3 +362,57 @@ def test_UNetModel():
     new_result = new_module(Context(px, rng.split()), x, ts)
     old_result = old_module(x_torch, ts_torch)
     check(old_result, new_result)
+
+@torch.no_grad()
+def test_AttentionPool2d():
+    rng = PRNG(jax.random.PRNGKey(0))
+
+    C = 64
+    new_module = unet.AttentionPool2d(8, C, 16, output_dim=10)
+    old_module = old_unet.AttentionPool2d(8, C, 16, output_dim=10)
+    px = ParamState(new_module.labeled_parameters_())
+    px.initialize(rng.split())
+    old_module.load_state_dict(torch_state_dict(new_module, px))
+
+    x = jax.random.normal(key=rng.split(), shape=[2, C, 8, 8])
+    x_torch = totorch(x)
+
+    new_result = new_module(Context(px, rng.split()), x)
+    old_result = old_module(x_torch)
+    check(old_result, new_result)
+
+@torch.no_grad()
+def test_EncoderUNetModel():
+    rng = PRNG(jax.random.PRNGKey(0))
+
+    for pool in ('attention', 'adaptive', 'spatial', 'spatial_v2'):
+        args = dict(
+            image_size=32,
+            in_channels=3,
+            model_channels=64,
+            out_channels=10,
+            num_res_blocks=1,
+            attention_resolutions=(2, 4),
+            channel_mult=(1, 2, 2),
+            num_head_channels=32,
+            use_scale_shift_norm=True,
+            resblock_updown=True,
+            pool=pool,
+        )
+        new_module = unet.EncoderUNetModel(**args)
+        old_module = old_unet.EncoderUNetModel(**args)
+        px = ParamState(new_module.labeled_parameters_())
+        px.initialize(rng.split())
+        # Randomize the zero-initialized layers too, so they are compared.
+        for (name, par) in new_module.named_parameters():
+            px[par] = 0.1 * jax.random.normal(rng.split(), par.shape)
+        old_module.load_state_dict(torch_state_dict(new_module, px))
+
+        x = jax.random.normal(key=rng.split(), shape=[2, 3, 32, 32])
+        ts = jnp.array([1, 500])
+        x_torch = totorch(x)
+        ts_torch = totorch(ts)
+
+        new_result = new_module(Context(px, rng.split()), x, ts)
+        old_result = old_module(x_torch, ts_torch)
+        check(old_result, new_result)
@@ -0,0 +1,129 @@
+"""
+Batched, memoized CLIP text embeddings.
+
+Prompts are embedded in padded batches through the CLIP text encoder and the
+normalized results are memoized twice: in an in-process LRU, and in an
+on-disk store keyed by (CLIP model, prompt). A prompt that has been seen
+before never touches the text encoder again.
+"""
+
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+
+def _slug(model_name):
+    return model_name.replace('/', '-').replace(' ', '_')
+
+
+class TextEmbedder(object):
+    """
+    A memoizing front end to a CLIP text encoder.
+
+    :param text_fn: the CLIP text encoder, as returned by clip_jax.load().
+    :param clip_params: the CLIP parameters passed to text_fn.
+    :param tokenize: the CLIP tokenizer, taking a list of strings.
+    :param model_name: the CLIP model name, part of every cache key.
+    :param cache_dir: directory of the on-disk store, or None to only
+                      memoize in memory.
+    :param max_memory: the number of embeddings kept in the in-process LRU.
+    :param batch_size: prompts are encoded in batches padded to a multiple of
+                       this size, so the encoder only ever sees one shape.
+    """
+
+    def __init__(self, text_fn, clip_params, tokenize, model_name,
+                 cache_dir='cache/text', max_memory=4096, batch_size=16):
+        self.text_fn = text_fn
+        self.clip_params = clip_params
+        self.tokenize = tokenize
+        self.model_name = model_name
+        self.cache_dir = cache_dir
+        self.max_memory = max_memory
+        self.batch_size = batch_size
+        self.memory = OrderedDict()
+        self.encoded = 0
+        if self.cache_dir is not None:
+            os.makedirs(self._model_dir(), exist_ok=True)
+
+    def _model_dir(self):
+        return os.path.join(self.cache_dir, _slug(self.model_name))
+
+    def _path(self, prompt):
+        digest = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        return os.path.join(self._model_dir(), digest[:2], digest + '.npy')
+
+    def _remember(self, prompt, embed):
+        self.memory[prompt] = embed
+        self.memory.move_to_end(prompt)
+        while len(self.memory) > self.max_memory:
+            self.memory.popitem(last=False)
+
+    def _lookup(self, prompt):
+        if prompt in self.memory:
+            self.memory.move_to_end(prompt)
+            return self.memory[prompt]
+        if self.cache_dir is not None:
+            path = self._path(prompt)
+            if os.path.exists(path):
+                embed = np.load(path)
+                self._remember(prompt, embed)
+                return embed
+        return None
+
+    def _store(self, prompt, embed):
+        self._remember(prompt, embed)
+        if self.cache_dir is None:
+            return
+        path = self._path(prompt)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fp:
+            np.save(fp, embed)
+        os.replace(tmp, path)
+
+    def _encode(self, prompts):
+        """Run the text encoder over `prompts` in padded batches."""
+        tokens = np.asarray(self.tokenize(prompts))
+        n = tokens.shape[0]
+        padded = -(-n // self.batch_size) * self.batch_size
+        if padded != n:
+            tokens = np.concatenate([tokens, np.zeros([padded - n, *tokens.shape[1:]], dtype=tokens.dtype)])
+        embeds = []
+        for i in range(0, padded, self.batch_size):
+            out = np.asarray(self.text_fn(self.clip_params, tokens[i:i+self.batch_size]), dtype=np.float32)
+            embeds.append(out)
+        embeds = np.concatenate(embeds)[:n]
+        self.encoded += n
+        return embeds / np.sqrt(np.square(embeds).sum(axis=-1, keepdims=True))
+
+    def embed(self, prompts):
+        """
+        Embed a list of prompts.
+
+        :param prompts: a list of strings.
+        :return: an [N x D] float32 numpy array of normalized embeddings.
+        """
+        results = [self._lookup(p) for p in prompts]
+        missing = list(OrderedDict.fromkeys(p for (p, r) in zip(prompts, results) if r is None))
+        if missing:
+            fresh = dict(zip(missing, self._encode(missing)))
+            for (p, embed) in fresh.items():
+                self._store(p, embed)
+            results = [r if r is not None else fresh[p] for (p, r) in zip(prompts, results)]
+        return np.stack(results)
+
+    def precompute(self, prompts):
+        """
+        Make sure all `prompts` are in the on-disk store. Repeated prompts
+        are embedded once.
+
+        :return: the number of prompts that had to be encoded.
+        """
+        prompts = list(OrderedDict.fromkeys(prompts))
+        before = self.encoded
+        for i in range(0, len(prompts), self.batch_size * 16):
+            self.embed(prompts[i:i + self.batch_size * 16])
+        return self.encoded - before
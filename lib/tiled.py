@@ -0,0 +1,140 @@
+"""
+Tiled model evaluation, for sampling canvases larger than the model's
+training resolution.
+
+The UNet's attention layers attend globally, so their memory grows with the
+square of the canvas area, and the model was only trained at one size. A
+TiledModel instead runs the model on overlapping tiles of the training size,
+a few tiles per batch, and blends the predictions where tiles overlap with
+weights that fall smoothly to zero towards each tile's inner edges, so that
+no seams show. Memory is that of one batch of tiles, whatever the canvas
+size.
+"""
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+
+
+def tile_offsets(size, tile_size, overlap):
+    """
+    Offsets of tiles covering `size` positions, evenly spaced so that
+    neighbours overlap by at least `overlap`.
+    """
+    if size <= tile_size:
+        return [0]
+    count = -(-(size - overlap) // (tile_size - overlap))
+    return [round(i * (size - tile_size) / (count - 1)) for i in range(count)]
+
+
+def tile_weights(size, tile_size, offsets):
+    """
+    One weight vector per tile offset: 1 in the middle, and a raised cosine
+    ramp over each overlap with a neighbouring tile. Ramps never reach zero,
+    so every position has some weight.
+    """
+    weights = []
+    for (i, offset) in enumerate(offsets):
+        w = np.ones([tile_size], np.float32)
+        if i > 0:
+            ramp = offsets[i - 1] + tile_size - offset
+            w[:ramp] = 0.5 - 0.5 * np.cos(np.pi * (np.arange(ramp) + 0.5) / ramp)
+        if i + 1 < len(offsets):
+            ramp = offset + tile_size - offsets[i + 1]
+            w[tile_size - ramp:] = np.minimum(
+                w[tile_size - ramp:], 0.5 + 0.5 * np.cos(np.pi * (np.arange(ramp) + 0.5) / ramp))
+        weights.append(w)
+    return weights
+
+
+class TiledModel(object):
+    """
+    Evaluates a model on overlapping tiles of a larger input and blends the
+    outputs, which must be the spatial size of the inputs (as for the UNet's
+    eps and variance predictions).
+
+    :param tile_size: the size of the square tiles, normally the model's
+                      image_size. Along a side of the canvas shorter than
+                      this, tiles are cut to the canvas, so they span it.
+    :param overlap: the least overlap between neighbouring tiles.
+    :param batch_size: how many tiles of each image go through the model at
+                       once. The model's batch is this times the input's.
+    """
+
+    def __init__(self, tile_size=512, overlap=128, batch_size=2):
+        assert 0 <= overlap < tile_size
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.batch_size = batch_size
+
+    def tile_shape(self, height, width):
+        """The (height, width) of the tiles for a canvas."""
+        return min(self.tile_size, height), min(self.tile_size, width)
+
+    def plan(self, height, width):
+        """
+        The tiles for a canvas: (offsets, an [K x 2] array of tile corners,
+        weights, a [K x tile height x tile width] array of blending weights,
+        normalizer, a [height x width] array of the summed weights). K is a
+        multiple of the batch size; padding tiles have zero weight.
+        """
+        (th, tw) = self.tile_shape(height, width)
+        (ys, xs) = [tile_offsets(size, tile, self.overlap) for (size, tile) in ((height, th), (width, tw))]
+        (wys, wxs) = [tile_weights(size, tile, offsets)
+                      for (size, tile, offsets) in ((height, th, ys), (width, tw, xs))]
+        offsets = [(y, x) for y in ys for x in xs]
+        weights = [np.outer(wy, wx) for wy in wys for wx in wxs]
+        normalizer = np.zeros([height, width], np.float32)
+        for ((y, x), w) in zip(offsets, weights):
+            normalizer[y:y + th, x:x + tw] += w
+        while len(offsets) % self.batch_size:
+            offsets.append(offsets[-1])
+            weights.append(np.zeros_like(weights[-1]))
+        return np.array(offsets, np.int32), np.stack(weights), normalizer
+
+    def __call__(self, fn, x, timesteps, **kwargs):
+        """
+        Apply `fn` as fn(x, timesteps, **kwargs) tile by tile. Array keyword
+        arguments with a leading batch axis (such as class labels) go with
+        each tile. Differentiable, with each batch of tiles rematerialized
+        in the backward pass.
+
+        :param x: an [N x C x H x W] Tensor.
+        :param timesteps: a 1-D batch of timesteps.
+        :return: the blended [N x C' x H x W] output.
+        """
+        (n, c, height, width) = x.shape
+        (th, tw) = self.tile_shape(height, width)
+        if (th, tw) == (height, width):
+            return fn(x, timesteps, **kwargs)
+        (offsets, weights, normalizer) = self.plan(height, width)
+        batch = self.batch_size
+
+        def repeat(a):
+            if getattr(a, 'ndim', 0) and a.shape[0] == n:
+                return jnp.concatenate([a] * batch)
+            return a
+        kwargs = jax.tree_util.tree_map(repeat, kwargs)
+        timesteps = repeat(timesteps)
+
+        def run(offsets):
+            tiles = [jax.lax.dynamic_slice(x, (0, 0, top, left), (n, c, th, tw))
+                     for (top, left) in offsets]
+            out = fn(jnp.concatenate(tiles), timesteps, **kwargs)
+            return out.reshape(batch, n, *out.shape[1:])
+
+        @jax.checkpoint
+        def step(acc, group):
+            (offsets, weights) = group
+            out = run(offsets)
+            for k in range(batch):
+                corner = (0, 0, offsets[k, 0], offsets[k, 1])
+                window = jax.lax.dynamic_slice(acc, corner, out.shape[1:])
+                acc = jax.lax.dynamic_update_slice(acc, window + out[k] * weights[k], corner)
+            return acc, None
+
+        out_shape = jax.eval_shape(run, offsets[:batch]).shape
+        acc = jnp.zeros([n, out_shape[2], height, width], jnp.float32)
+        groups = (offsets.reshape(-1, batch, 2), weights.reshape(-1, batch, th, tw))
+        (acc, _) = jax.lax.scan(step, acc, groups)
+        return (acc / normalizer).astype(x.dtype)
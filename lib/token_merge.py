@@ -0,0 +1,96 @@
+"""
+Token merging for attention layers, by bipartite soft matching, as in ToMe
+(Bolya et al., 2022) and its adaptation to diffusion UNets (Bolya and
+Hoffman, 2023).
+
+Before attention, the tokens (spatial positions) are split into
+destinations, one per 2x2 window, and sources, the rest. Each source is
+matched to its most similar destination by cosine similarity, and the r
+best matched sources are averaged into their destinations. Attention then
+runs on the T - r remaining tokens, and afterwards every merged source takes
+its destination's output. As attention is quadratic in T, merging half of
+the tokens cuts its cost by about three quarters.
+
+The matching itself is not differentiated through (it is a discrete
+choice), but merging and unmerging are gathers, scatters and averages, so
+gradients flow back to every token.
+"""
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+
+
+def _partition(height, width, stride=(2, 2)):
+    """
+    The token indices of the destinations, the top left position of each
+    stride window, and of the sources, everything else.
+    """
+    (rows, cols) = np.meshgrid(np.arange(height), np.arange(width), indexing='ij')
+    is_dst = ((rows % stride[0] == 0) & (cols % stride[1] == 0)).reshape(-1)
+    return np.nonzero(is_dst)[0], np.nonzero(~is_dst)[0]
+
+
+def merge_count(height, width, ratio):
+    """The number of tokens bipartite_soft_matching() merges away."""
+    if not ratio:
+        return 0
+    return max(min(int(height * width * ratio), len(_partition(height, width)[1])), 0)
+
+
+def bipartite_soft_matching(metric, height, width, ratio):
+    """
+    Match the tokens of an image for merging.
+
+    :param metric: an [N x T x C] Tensor of the features to compare tokens
+                   by, with T = height * width in row-major order.
+    :param ratio: the fraction of tokens to merge away. At most the
+                  non-destination tokens, 3/4 of them, can be merged.
+    :return: (merge, unmerge): merge maps an [N x T x C'] Tensor to
+             [N x T' x C'], averaging each merged token into its
+             destination; unmerge maps [N x T' x C'] back to [N x T x C'],
+             copying each destination's features to the tokens merged into
+             it.
+    """
+    (dst_idx, src_idx) = _partition(height, width)
+    r = merge_count(height, width, ratio)
+    if r <= 0:
+        return (lambda x: x), (lambda x: x)
+    (batch, length, _) = metric.shape
+    num_dst = len(dst_idx)
+
+    metric = jax.lax.stop_gradient(metric).astype(jnp.float32)
+    metric = metric / jnp.linalg.norm(metric, axis=-1, keepdims=True).clip(1e-6)
+    scores = jnp.einsum('bsc,bdc->bsd', metric[:, src_idx], metric[:, dst_idx])
+    # Each source's best destination; the sources with the best matches merge.
+    node_max = scores.max(axis=-1)
+    node_idx = scores.argmax(axis=-1)
+    edge_idx = jnp.argsort(-node_max, axis=-1)
+    unm_idx = edge_idx[:, r:]
+    merged_idx = edge_idx[:, :r]
+    target_idx = jnp.take_along_axis(node_idx, merged_idx, axis=-1)
+    # How many tokens each destination averages, itself included.
+    counts = jax.vmap(lambda t: jnp.ones([num_dst]).at[t].add(1.0))(target_idx)
+
+    def merge(x):
+        src = x[:, src_idx]
+        dst = x[:, dst_idx].astype(jnp.float32)
+        unm = jnp.take_along_axis(src, unm_idx[..., None], axis=1)
+        merged = jnp.take_along_axis(src, merged_idx[..., None], axis=1)
+        dst = jax.vmap(lambda d, t, m: d.at[t].add(m.astype(jnp.float32)))(dst, target_idx, merged)
+        dst = dst / counts[..., None]
+        return jnp.concatenate([unm, dst.astype(x.dtype)], axis=1)
+
+    def unmerge(x):
+        unm = x[:, :length - num_dst - r]
+        dst = x[:, length - num_dst - r:]
+        merged = jnp.take_along_axis(dst, target_idx[..., None], axis=1)
+        src_positions = jnp.asarray(src_idx)
+        out = jnp.zeros((batch, length, x.shape[-1]), x.dtype)
+        out = out.at[:, dst_idx].set(dst)
+        def place(out, unm_idx, unm, merged_idx, merged):
+            out = out.at[src_positions[unm_idx]].set(unm)
+            return out.at[src_positions[merged_idx]].set(merged)
+        return jax.vmap(place)(out, unm_idx, unm, merged_idx, merged)
+
+    return merge, unmerge
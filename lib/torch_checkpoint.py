@@ -0,0 +1,143 @@
+"""
+Streaming access to PyTorch checkpoints.
+
+torch.load(mmap=True) maps the tensor storages of a zip-format checkpoint
+instead of reading them, so tensor names, shapes and dtypes are available
+immediately and tensor data is only paged in when it is converted. This lets
+checkpoints be converted or loaded one tensor at a time, with peak memory
+bounded by the largest single tensor.
+"""
+
+import os
+
+import numpy as np
+
+from .tensor_archive import TensorArchiveWriter, dtype_from_name, dtype_name, write_shard_index
+
+DTYPES = {
+    None: None,
+    'fp32': 'float32',
+    'fp16': 'float16',
+    'bf16': 'bfloat16',
+}
+
+
+def open_torch_checkpoint(path):
+    """
+    Open a .pt state dict without reading its tensor data.
+
+    Falls back to a regular (fully materialized) load for checkpoints or
+    torch versions that do not support mmap.
+    """
+    import torch
+    try:
+        return torch.load(path, map_location=torch.device('cpu'), mmap=True, weights_only=True)
+    except (TypeError, RuntimeError) as e:
+        print(f'Cannot mmap {path} ({e}), loading it into memory instead.')
+        return torch.load(path, map_location=torch.device('cpu'))
+
+
+def tensor_to_numpy(tensor, dtype=None):
+    """
+    Convert one torch tensor to numpy, optionally casting to `dtype`
+    ('float32', 'float16' or 'bfloat16'). Without a cast, this is a view of
+    the mapped storage.
+    """
+    import torch
+    tensor = tensor.detach()
+    if dtype is not None and tensor.is_floating_point():
+        tensor = tensor.to({'float32': torch.float32,
+                            'float16': torch.float16,
+                            'bfloat16': torch.bfloat16}[dtype])
+    if tensor.dtype == torch.bfloat16:
+        # numpy has no native bfloat16; reinterpret the bits.
+        return tensor.contiguous().view(torch.int16).numpy().view(dtype_from_name('bfloat16'))
+    return tensor.contiguous().numpy()
+
+
+class TorchStateDict(object):
+    """
+    A lazy mapping from names to numpy arrays over a mmap'd torch state dict.
+
+    :param path: a .pt checkpoint.
+    :param dtype: if given, floating tensors are cast to this dtype.
+    """
+
+    def __init__(self, path, dtype=None):
+        self.path = path
+        self.dtype = dtype
+        self.state_dict = open_torch_checkpoint(path)
+
+    def __len__(self):
+        return len(self.state_dict)
+
+    def __iter__(self):
+        return iter(self.state_dict)
+
+    def __contains__(self, name):
+        return name in self.state_dict
+
+    def keys(self):
+        return self.state_dict.keys()
+
+    def items(self):
+        return ((name, self[name]) for name in self.state_dict)
+
+    def describe(self, name):
+        tensor = self.state_dict[name]
+        dtype = self.dtype if (self.dtype is not None and tensor.is_floating_point()) else str(tensor.dtype).replace('torch.', '')
+        return tuple(tensor.shape), dtype_from_name(dtype)
+
+    def __getitem__(self, name):
+        return tensor_to_numpy(self.state_dict[name], self.dtype)
+
+
+def shard_specs(specs, shard_size):
+    """Split a list of (name, dtype, shape) into shards of at most shard_size bytes."""
+    shards = [[]]
+    size = 0
+    for spec in specs:
+        (name, dtype, shape) = spec
+        nbytes = int(np.prod(shape, dtype=np.int64)) * dtype_from_name(dtype).itemsize
+        if shard_size is not None and shards[-1] and size + nbytes > shard_size:
+            shards.append([])
+            size = 0
+        shards[-1].append(spec)
+        size += nbytes
+    return shards
+
+
+def convert_state_dict(state_dict, output, shard_size=None, metadata=None):
+    """
+    Stream a lazy state dict into one or more tensor archives.
+
+    Tensors are read, converted and written one at a time.
+
+    :param state_dict: a mapping with describe(), such as TorchStateDict.
+    :param output: the output path, ending in .tensors.
+    :param shard_size: if given, split the output into archives of at most
+                       this many bytes, plus an index (see ShardedTensorArchive).
+    :return: the list of written archive paths.
+    """
+    specs = []
+    for name in state_dict.keys():
+        (shape, dtype) = state_dict.describe(name)
+        specs.append((name, dtype_name(dtype), shape))
+    shards = shard_specs(specs, shard_size)
+    if len(shards) == 1:
+        paths = [output]
+    else:
+        stem = output[:-len('.tensors')] if output.endswith('.tensors') else output
+        paths = [f'{stem}-{i+1:05}-of-{len(shards):05}.tensors' for i in range(len(shards))]
+
+    for (path, shard) in zip(paths, shards):
+        with TensorArchiveWriter(path, shard, metadata=metadata) as writer:
+            for (name, _, _) in shard:
+                writer.write(name, state_dict[name])
+        print(f'Wrote {path}')
+
+    if len(paths) > 1:
+        write_shard_index(output + '.json', {name: os.path.basename(path)
+                                             for (path, shard) in zip(paths, shards)
+                                             for (name, _, _) in shard})
+    return paths
@@ -6,7 +6,72 @@ import jax
 import jax.numpy as jnp
 import jaxtorch
 import jaxtorch.nn as nn
-from jaxtorch.core import Module
+from jaxtorch import init
+from jaxtorch.core import Module, Context, ParamState
+
+from .fp16_util import convert_module_to_f16, HALF_DTYPES
+from .fused_norm import group_norm_silu
+from .quantize import QuantizedParamState
+from .token_merge import bipartite_soft_matching, merge_count
+from .attention import (ATTENTION_BACKENDS, QKVAttention, QKVAttentionLegacy,
+                        permute_qkv, select_attention_backend)
+
+CHECKPOINT_MODES = (False, True, 'everything', 'attention', 'save_matmuls')
+
+def checkpoint_options(use_checkpoint):
+    """
+    The checkpointing arguments of ResBlocks and of AttentionBlocks for a
+    model's use_checkpoint mode (see UNetModel).
+
+    :return: a (ResBlock kwargs, AttentionBlock kwargs) tuple.
+    """
+    if use_checkpoint not in CHECKPOINT_MODES:
+        raise ValueError(f'unknown use_checkpoint mode {use_checkpoint!r}, expected one of {CHECKPOINT_MODES}')
+    res_checkpoint = dict(use_checkpoint=use_checkpoint in (True, 'everything', 'save_matmuls'),
+                          checkpoint_policy=(jax.checkpoint_policies.dots_saveable
+                                             if use_checkpoint == 'save_matmuls' else None))
+    attn_checkpoint = dict(res_checkpoint, use_checkpoint=bool(use_checkpoint))
+    return res_checkpoint, attn_checkpoint
+
+# 'NCHW': channels before the spatial axes, as in the torch checkpoints.
+# 'NHWC': channels last, which XLA's convolutions generally prefer.
+LAYOUTS = ('NCHW', 'NHWC')
+
+def channel_axis(layout):
+    return 1 if layout == 'NCHW' else -1
+
+# The parameter holding the timesteps of precomputed embedding tables.
+TIMESTEP_TABLE = 'timestep_table.timesteps'
+
+def checkpoint(func, cx, inputs, params, flag, policy=None):
+    """
+    Evaluate a function without caching intermediate activations, allowing for
+    reduced memory at the expense of extra compute in the backward pass.
+
+    :param func: the function to evaluate, taking a Context and `inputs`.
+    :param cx: the Context to read parameters and randomness from.
+    :param inputs: the argument sequence to pass to `func`.
+    :param params: a sequence of parameters `func` depends on but does not
+                   explicitly take as arguments.
+    :param flag: if False, disable gradient checkpointing.
+    :param policy: a jax.checkpoint_policies policy naming intermediate values
+                   that may be saved anyway (default: none are).
+    """
+    if not flag:
+        return func(cx, *inputs)
+    if isinstance(cx.px, QuantizedParamState):
+        # Int8 weights go in as stored and are dequantized inside, so that the
+        # backward pass saves them and their scales, not float copies.
+        def run_quantized(px, key, *inputs):
+            return func(Context(px, key), *inputs)
+        return jax.checkpoint(run_quantized, policy=policy)(cx.px.subset(params), cx.rng.split(), *inputs)
+    values = [cx[par] for par in params]
+    def run(values, key, *inputs):
+        px = ParamState(params)
+        for (par, value) in zip(params, values):
+            px[par] = value
+        return func(Context(px, key), *inputs)
+    return jax.checkpoint(run, policy=policy)(values, cx.rng.split(), *inputs)
 
 class TimestepBlock(Module):
     """
@@ -34,33 +99,53 @@ class TimestepEmbedSequential(nn.Sequential, TimestepBlock):
                 x = layer(cx, x)
         return x
 
-class QKVAttentionLegacy(Module):
+def conv_channels_last(x, weight, bias, stride, padding):
     """
-    A module which performs QKV attention. Matches legacy QKVAttention + input/ouput heads shaping
+    Convolve a channels-last input ([N x ... x C]) with a weight laid out as
+    [... x in x out], such as HWIO.
     """
+    n = x.ndim - 2
+    if isinstance(padding, int):
+        padding = [(padding, padding)] * n
+    spatial = 'HW' if n == 2 else 'W'
+    output = jax.lax.conv_general_dilated(x, weight,
+                                          window_strides=[stride] * n,
+                                          padding=padding,
+                                          dimension_numbers=(f'N{spatial}C', f'{spatial}IO', f'N{spatial}C'))
+    if bias is not None:
+        output = output + bias
+    return output
 
-    def __init__(self, n_heads):
-        super().__init__()
-        self.n_heads = n_heads
+class Conv2d(nn.Conv2d):
+    """
+    A Conv2d that can also run channels-last. Its weight is stored OIHW, as
+    in checkpoints, and UNetModel.prepare_params() transposes it to HWIO for
+    the NHWC layout.
+    """
 
-    def forward(self, cx, qkv):
-        """
-        Apply QKV attention.
+    layout = 'NCHW'
 
-        :param qkv: an [N x (H * 3 * C) x T] tensor of Qs, Ks, and Vs.
-        :return: an [N x (H * C) x T] tensor after attention.
-        """
-        bs, width, length = qkv.shape
-        assert width % (3 * self.n_heads) == 0
-        ch = width // (3 * self.n_heads)
-        q, k, v = qkv.reshape(bs * self.n_heads, ch * 3, length).split(3, axis=1)
-        scale = 1 / np.sqrt(np.sqrt(ch))
-        weight = jnp.einsum(
-            "bct,bcs->bts", q * scale, k * scale
-        )  # More stable with f16 than dividing afterwards
-        weight = jax.nn.softmax(weight, axis=-1)
-        a = jnp.einsum("bts,bcs->bct", weight, v)
-        return a.reshape(bs, width//3, length)
+    def forward(self, cx, x):
+        if self.layout == 'NCHW':
+            return super().forward(cx, x)
+        assert self.dilation == 1 and self.groups == 1
+        return conv_channels_last(x, cx[self.weight], cx[self.bias] if self.use_bias else None,
+                                  self.stride, self.padding)
+
+class Conv1d(nn.Conv1d):
+    """
+    A Conv1d that can also run channels-last; see Conv2d. The NWC weight is
+    [W x in x out].
+    """
+
+    layout = 'NCHW'
+
+    def forward(self, cx, x):
+        if self.layout == 'NCHW':
+            return super().forward(cx, x)
+        assert self.dilation == 1 and self.groups == 1
+        return conv_channels_last(x, cx[self.weight], cx[self.bias] if self.use_bias else None,
+                                  self.stride, self.padding)
 
 class Upsample2D(Module):
     """
@@ -70,20 +155,28 @@ class Upsample2D(Module):
     :param use_conv: a bool determining if a convolution is applied.
     """
 
+    layout = 'NCHW'
+
     def __init__(self, channels, use_conv, out_channels=None):
         super().__init__()
         self.channels = channels
         self.out_channels = out_channels or channels
         self.use_conv = use_conv
         if self.use_conv:
-            self.conv = jaxtorch.nn.Conv2d(self.channels, self.out_channels, 3, padding=1)
+            self.conv = Conv2d(self.channels, self.out_channels, 3, padding=1)
 
     def forward(self, cx, x):
-        [b, c, h, w] = x.shape
+        if self.layout == 'NCHW':
+            [b, c, h, w] = x.shape
+            x = x.reshape([b, c, h, 1, w, 1])
+            x = jnp.broadcast_to(x, [b, c, h, 2, w, 2])
+            x = x.reshape([b, c, h*2, w*2])
+        else:
+            [b, h, w, c] = x.shape
+            x = x.reshape([b, h, 1, w, 1, c])
+            x = jnp.broadcast_to(x, [b, h, 2, w, 2, c])
+            x = x.reshape([b, h*2, w*2, c])
         assert c == self.channels
-        x = x.reshape([b, c, h, 1, w, 1])
-        x = jnp.broadcast_to(x, [b, c, h, 2, w, 2])
-        x = x.reshape([b, c, h*2, w*2])
         if self.use_conv:
             x = self.conv(cx, x)
         return x
@@ -96,27 +189,61 @@ class Downsample2D(Module):
     :param use_conv: a bool determining if a convolution is applied.
     """
 
+    layout = 'NCHW'
+
     def __init__(self, channels, use_conv, out_channels=None):
         super().__init__()
         self.channels = channels
         self.out_channels = out_channels or channels
         self.use_conv = use_conv
         if self.use_conv:
-            self.op = jaxtorch.nn.Conv2d(
+            self.op = Conv2d(
                 self.channels, self.out_channels, 3, stride=2, padding=1
             )
         else:
             assert self.channels == self.out_channels
 
     def forward(self, cx, x):
-        assert x.shape[1] == self.channels
+        assert x.shape[channel_axis(self.layout)] == self.channels
         if self.use_conv:
             return self.op(cx, x)
-        else:
+        elif self.layout == 'NCHW':
             [b, c, h, w] = x.shape
             x = x.reshape(b, c, h//2, 2, w//2, 2)
             x = x.mean(axis=(3, 5))
             return x
+        else:
+            [b, h, w, c] = x.shape
+            x = x.reshape(b, h//2, 2, w//2, 2, c)
+            return x.mean(axis=(2, 4))
+
+class GroupNorm32(nn.GroupNorm):
+    """
+    GroupNorm that computes its statistics in float32, whatever the input dtype.
+    """
+
+    layout = 'NCHW'
+
+    def forward(self, cx, x):
+        if self.layout == 'NCHW':
+            return super().forward(cx, x.astype(jnp.float32)).astype(x.dtype)
+        [b, *spatial, c] = x.shape
+        assert c == self.num_channels
+        h = x.astype(jnp.float32).reshape(b, -1, self.num_groups, c // self.num_groups)
+        mu = h.mean(axis=(1, 3), keepdims=True)
+        var = h.var(axis=(1, 3), keepdims=True)
+        h = ((h - mu) / jnp.sqrt(var + self.eps)).reshape(x.shape)
+        if self.affine:
+            h = h * cx[self.weight] + cx[self.bias]
+        return h.astype(x.dtype)
+
+    def silu(self, cx, x, scale=None, shift=None):
+        """
+        Normalize, modulate by (1 + scale) and shift if given, and apply SiLU,
+        as a single fused op (see lib/fused_norm.py).
+        """
+        return group_norm_silu(x, cx[self.weight], cx[self.bias], self.num_groups, self.eps,
+                               scale, shift, self.layout)
 
 def normalization(channels):
     """
@@ -125,7 +252,7 @@ def normalization(channels):
     :param channels: number of input channels.
     :return: an nn.Module for normalization.
     """
-    return nn.GroupNorm(32, channels)
+    return GroupNorm32(32, channels)
 
 class ResBlock(TimestepBlock):
     """
@@ -141,8 +268,12 @@ class ResBlock(TimestepBlock):
     :param dims: determines if the signal is 1D, 2D, or 3D.
     :param up: if True, use this block for upsampling.
     :param down: if True, use this block for downsampling.
+    :param use_checkpoint: if True, use gradient checkpointing on this module.
+    :param checkpoint_policy: what gradient checkpointing may save anyway.
     """
 
+    layout = 'NCHW'
+
     def __init__(
         self,
         channels,
@@ -152,6 +283,8 @@ class ResBlock(TimestepBlock):
         use_conv=False,
         use_scale_shift_norm=False,
         dims=2,
+        use_checkpoint=False,
+        checkpoint_policy=None,
         up=False,
         down=False,
     ):
@@ -161,6 +294,8 @@ class ResBlock(TimestepBlock):
         self.dropout = dropout
         self.out_channels = out_channels or channels
         self.use_conv = use_conv
+        self.use_checkpoint = use_checkpoint
+        self.checkpoint_policy = checkpoint_policy
         self.use_scale_shift_norm = use_scale_shift_norm
 
         assert dims == 2
@@ -168,7 +303,7 @@ class ResBlock(TimestepBlock):
         self.in_layers = nn.Sequential(
             normalization(channels),
             nn.SiLU(),
-            nn.Conv2d(channels, self.out_channels, 3, padding=1),
+            Conv2d(channels, self.out_channels, 3, padding=1),
         )
 
         self.updown = up or down
@@ -193,39 +328,73 @@ class ResBlock(TimestepBlock):
             normalization(self.out_channels),
             nn.SiLU(),
             nn.Dropout(p=dropout),
-            nn.Conv2d(self.out_channels, self.out_channels, 3, padding=1, zero_init=True)
+            Conv2d(self.out_channels, self.out_channels, 3, padding=1, zero_init=True)
         )
 
         if self.out_channels == channels:
             self.skip_connection = nn.Identity()
         elif use_conv:
-            self.skip_connection = nn.Conv2d(
+            self.skip_connection = Conv2d(
                 channels, self.out_channels, 3, padding=1
             )
         else:
-            self.skip_connection = nn.Conv2d(channels, self.out_channels, 1)
+            self.skip_connection = Conv2d(channels, self.out_channels, 1)
 
     def forward(self, cx, x, emb):
+        """
+        Apply the block to a Tensor, conditioned on a timestep embedding.
+
+        :param x: an [N x C x ...] Tensor of features.
+        :param emb: an [N x emb_channels] Tensor of timestep embeddings, or
+                    an (indices, embeddings) pair from
+                    UNetModel.embedding() for the precomputed tables (see
+                    UNetModel.precompute_timestep_tables()).
+        :return: an [N x C x ...] Tensor of outputs.
+        """
+        return checkpoint(self._forward, cx, (x, self.embedding(cx, emb)), self.parameters(),
+                          self.use_checkpoint, self.checkpoint_policy)
+
+    @property
+    def emb_table_name(self):
+        # Named after the projection it replaces, whose parameters are
+        # labelled along with the rest of the model.
+        return self.emb_layers.modules[-1].weight.name.replace('.weight', '.table')
+
+    def embedding(self, cx, emb):
+        """
+        The output of emb_layers. Given (indices, embeddings), it is looked up
+        from the table for every index that is not -1; emb_layers only runs,
+        on the embeddings, if some timestep is missing from the table.
+        """
+        if isinstance(emb, tuple):
+            (indices, emb) = emb
+            found = indices >= 0
+            looked_up = cx.px[self.emb_table_name][jnp.maximum(indices, 0)]
+            return jax.lax.cond(found.all(), lambda: looked_up,
+                                lambda: jnp.where(found[:, None], looked_up, self.emb_layers(cx, emb)))
+        return self.emb_layers(cx, emb)
+
+    def _forward(self, cx, x, emb_out):
+        # in_layers and out_layers are only containers, for parameter names:
+        # each normalization and SiLU run as one fused op.
+        (in_norm, _, in_conv) = self.in_layers.modules
+        (out_norm, _, out_dropout, out_conv) = self.out_layers.modules
+        h = in_norm.silu(cx, x)
         if self.updown:
-            in_rest = nn.Sequential(*self.in_layers.modules[:-1])
-            in_conv = self.in_layers.modules[-1]
-            h = in_rest(cx, x)
             h = self.h_upd(cx, h)
             x = self.x_upd(cx, x)
-            h = in_conv(cx, h)
-        else:
-            h = self.in_layers(cx, x)
-        emb_out = self.emb_layers(cx, emb)
-        while len(emb_out.shape) < len(h.shape):
-            emb_out = emb_out[..., None]
+        h = in_conv(cx, h)
         if self.use_scale_shift_norm:
-            out_norm, out_rest = self.out_layers.modules[0], nn.Sequential(*self.out_layers.modules[1:])
             scale, shift = jnp.split(emb_out, 2, axis=1)
-            h = out_norm(cx, h) * (1 + scale) + shift
-            h = out_rest(cx, h)
+            h = out_norm.silu(cx, h, scale, shift)
         else:
-            h = h + emb_out
-            h = self.out_layers(cx, h)
+            emb_out = emb_out.astype(h.dtype)
+            if self.layout == 'NCHW':
+                emb_out = emb_out.reshape(emb_out.shape + (1,) * (h.ndim - 2))
+            else:
+                emb_out = emb_out.reshape(emb_out.shape[:1] + (1,) * (h.ndim - 2) + emb_out.shape[1:])
+            h = out_norm.silu(cx, h + emb_out)
+        h = out_conv(cx, out_dropout(cx, h))
         return self.skip_connection(cx, x) + h
 
 class AttentionBlock(nn.Module):
@@ -234,14 +403,42 @@ class AttentionBlock(nn.Module):
 
     Originally ported from here, but adapted to the N-d case.
     https://github.com/hojonathanho/diffusion/blob/1e0dceb3b3495bbe19116a5e1b3596cd0706c543/diffusion_tf/models/unet.py#L66.
+
+    :param use_new_attention_order: the order of the qkv projection's output
+                                    channels in checkpoints: split qkv before
+                                    heads if True, split heads before qkv if
+                                    False.
+    :param attention_chunk_size: if specified, attend in blocks of this many
+                                 positions, in memory linear in the sequence
+                                 length.
+    :param attention_backend: a name from ATTENTION_BACKENDS, or 'auto' to
+                              benchmark the backends for this block's shape
+                              in select_backend(). Defaults to the backend
+                              matching use_new_attention_order.
+    :param sequence_length: the number of positions attended over, which
+                            'auto' selects the backend for.
+    :param dtype: the dtype of the activations attended over, which 'auto'
+                  also selects the backend for.
+    :param token_merge_ratio: if nonzero, the fraction of positions merged
+                              into similar ones before attention and
+                              unmerged after it (see lib/token_merge.py).
     """
 
+    layout = 'NCHW'
+
     def __init__(
         self,
         channels,
         num_heads=1,
         num_head_channels=-1,
+        use_checkpoint=False,
+        checkpoint_policy=None,
         use_new_attention_order=False,
+        attention_chunk_size=None,
+        attention_backend=None,
+        sequence_length=None,
+        dtype=jnp.float32,
+        token_merge_ratio=0.0,
     ):
         super().__init__()
         self.channels = channels
@@ -252,25 +449,101 @@ class AttentionBlock(nn.Module):
                 channels % num_head_channels == 0
             ), f"q,k,v channels {channels} is not divisible by num_head_channels {num_head_channels}"
             self.num_heads = channels // num_head_channels
+        self.use_checkpoint = use_checkpoint
+        self.checkpoint_policy = checkpoint_policy
         self.norm = normalization(channels)
-        self.qkv = nn.Conv1d(channels, channels * 3, 1)
-        if use_new_attention_order:
-            # split qkv before split heads
-            self.attention = QKVAttention(self.num_heads)
+        self.qkv = Conv1d(channels, channels * 3, 1)
+        self.weight_order = 'new' if use_new_attention_order else 'legacy'
+        if attention_backend is None:
+            attention_backend = 'new_order' if use_new_attention_order else 'legacy'
+        self.attention_backend = attention_backend
+        self.attention_chunk_size = attention_chunk_size
+        self.sequence_length = sequence_length
+        self.dtype = dtype
+        if attention_backend == 'auto':
+            if sequence_length is None:
+                raise ValueError("attention_backend='auto' needs the sequence_length to select for")
+            # Benchmarking is left to select_backend(), not done on construction.
+            self.attention = None
         else:
-            # split heads before split qkv
-            self.attention = QKVAttentionLegacy(self.num_heads)
+            self.attention = ATTENTION_BACKENDS[attention_backend](self.num_heads, chunk_size=attention_chunk_size)
+        self.token_merge_ratio = token_merge_ratio or 0.0
 
-        self.proj_out = nn.Conv1d(channels, channels, 1, zero_init=True)
+        self.proj_out = Conv1d(channels, channels, 1, zero_init=True)
+
+    def select_backend(self):
+        """
+        With attention_backend='auto', benchmark the backends for this
+        block's shape on the current device and use the fastest (see
+        select_attention_backend()). Does nothing once a backend is set.
+        """
+        if self.attention is None:
+            name = select_attention_backend(self.sequence_length, self.channels, self.num_heads,
+                                            chunk_size=self.attention_chunk_size, dtype=self.dtype)
+            self.attention = ATTENTION_BACKENDS[name](self.num_heads, chunk_size=self.attention_chunk_size)
+
+    def prepare_params(self, px):
+        """
+        Select the attention backend if it is 'auto', then permute the qkv
+        projection, in place, from the checkpoint's channel order to the one
+        the backend expects. Returns `px`.
+        """
+        self.select_backend()
+
+        def permute(tensor):
+            return permute_qkv(tensor, self.num_heads, self.weight_order, self.attention.order)
+        if self.attention.order != self.weight_order:
+            for par in (self.qkv.weight, self.qkv.bias):
+                if hasattr(px, 'transform'):
+                    # Transform int8 weights and their scales alike.
+                    px.transform(par, permute)
+                else:
+                    px[par] = permute(px[par])
+        return px
 
     def forward(self, cx, x):
+        return checkpoint(self._forward, cx, (x,), self.parameters(),
+                          self.use_checkpoint, self.checkpoint_policy)
+
+    def _forward(self, cx, x):
+        if self.attention is None:
+            raise ValueError("attention_backend='auto' is selected by prepare_params(); call it first")
+        spatial = x.shape[1:-1] if self.layout == 'NHWC' else x.shape[2:]
+        (height, width) = spatial if len(spatial) == 2 else (1, int(np.prod(spatial)))
+        if self.layout == 'NHWC':
+            # Attention backends take [N x C x T]; only qkv and the attention
+            # output are transposed, the convolutions run channels-last.
+            shape = x.shape
+            x = x.reshape(shape[0], -1, shape[-1])
+            h = self.norm(cx, x)
+            (merge, unmerge) = self.token_merging(h, height, width)
+            qkv = self.qkv(cx, merge(h))
+            h = self.attention(cx, qkv.transpose(0, 2, 1)).transpose(0, 2, 1)
+            h = unmerge(self.proj_out(cx, h))
+            return (x + h).reshape(shape)
         b, c, *spatial = x.shape
         x = x.reshape(b, c, -1)
-        qkv = self.qkv(cx, self.norm(cx, x))
+        h = self.norm(cx, x)
+        if self.token_merge_ratio:
+            # Merging works on [N x T x C] tokens.
+            (merge, unmerge) = self.token_merging(h.transpose(0, 2, 1), height, width)
+            h = merge(h.transpose(0, 2, 1)).transpose(0, 2, 1)
+        qkv = self.qkv(cx, h)
         h = self.attention(cx, qkv)
         h = self.proj_out(cx, h)
+        if self.token_merge_ratio:
+            h = unmerge(h.transpose(0, 2, 1)).transpose(0, 2, 1)
         return (x + h).reshape(b, c, *spatial)
 
+    def token_merging(self, tokens, height, width):
+        """
+        (merge, unmerge) functions for [N x T x C] tokens, identities
+        unless token merging is enabled.
+        """
+        if not self.token_merge_ratio:
+            return (lambda t: t), (lambda t: t)
+        return bipartite_soft_matching(tokens, height, width, self.token_merge_ratio)
+
 def timestep_embedding(timesteps, dim, max_period=10000):
     """
     Create sinusoidal timestep embeddings.
@@ -310,6 +583,11 @@ class UNetModel(nn.Module):
     :param dims: determines if the signal is 1D, 2D, or 3D.
     :param num_classes: if specified (as an int), then this model will be
         class-conditional with `num_classes` classes.
+    :param use_checkpoint: use gradient checkpointing to reduce memory usage.
+        True or 'everything' rematerializes every ResBlock and AttentionBlock
+        from its inputs, 'attention' only the AttentionBlocks, and
+        'save_matmuls' every block but keeps convolution and matmul outputs,
+        recomputing only normalizations and activations.
     :param num_heads: the number of attention heads in each attention layer.
     :param num_heads_channels: if specified, ignore num_heads and instead use
                                a fixed channel width per attention head.
@@ -319,6 +597,28 @@ class UNetModel(nn.Module):
     :param resblock_updown: use residual blocks for up/downsampling.
     :param use_new_attention_order: use a different attention pattern for potentially
                                     increased efficiency.
+    :param attention_chunk_size: if specified, attention layers attend in
+        blocks of this many positions. May be an int, or a dict from
+        downsample rates to ints (or None) to choose per resolution.
+    :param attention_backend: the attention implementation, a name from
+        ATTENTION_BACKENDS, 'auto' to benchmark the backends for each
+        attention layer's shape on the current device and take the fastest,
+        or a dict from downsample rates to either. Checkpoint parameters must
+        be converted with prepare_params(), which also runs the 'auto'
+        benchmarks (cached, see lib/attention.py).
+    :param token_merge_ratio: if specified, the fraction of positions that
+        attention layers merge away before attending (see
+        lib/token_merge.py). May be a float, or a dict from downsample
+        rates to floats to choose per resolution.
+    :param use_fp16: run the torso of the model in half precision. GroupNorm
+                     statistics, softmax and the timestep embedding stay in
+                     float32. Parameters must be converted once with
+                     convert_to_fp16().
+    :param fp16_dtype: the half precision dtype, 'bfloat16' or 'float16'.
+    :param layout: the layout activations are computed in, 'NCHW' or 'NHWC'.
+                   Inputs and outputs are NCHW either way. For 'NHWC',
+                   convolution weights must be transposed once with
+                   prepare_params().
     """
 
     def __init__(
@@ -340,9 +640,13 @@ class UNetModel(nn.Module):
         use_scale_shift_norm=False,
         resblock_updown=False,
         use_new_attention_order=False,
-            # ignored
-            use_checkpoint=None,
-            use_fp16=None
+        attention_chunk_size=None,
+        attention_backend=None,
+        token_merge_ratio=None,
+        use_checkpoint=False,
+        use_fp16=False,
+        fp16_dtype="bfloat16",
+        layout="NCHW",
     ):
         super().__init__()
 
@@ -359,9 +663,38 @@ class UNetModel(nn.Module):
         self.channel_mult = channel_mult
         self.conv_resample = conv_resample
         self.num_classes = num_classes
+        self.use_checkpoint = use_checkpoint
         self.num_heads = num_heads
         self.num_head_channels = num_head_channels
         self.num_heads_upsample = num_heads_upsample
+        self.attention_chunk_size = attention_chunk_size
+        self.attention_backend = attention_backend
+        self.token_merge_ratio = token_merge_ratio
+        self.use_fp16 = use_fp16
+        self.dtype = HALF_DTYPES[fp16_dtype] if use_fp16 else jnp.float32
+        if layout not in LAYOUTS:
+            raise ValueError(f'unknown layout {layout!r}, expected one of {LAYOUTS}')
+        self.layout = layout
+
+        (res_checkpoint, attn_checkpoint) = checkpoint_options(use_checkpoint)
+
+        def chunk_size(ds):
+            if isinstance(attention_chunk_size, dict):
+                return attention_chunk_size.get(ds)
+            return attention_chunk_size
+
+        def merge_ratio(ds):
+            if isinstance(token_merge_ratio, dict):
+                return token_merge_ratio.get(ds)
+            return token_merge_ratio
+
+        def backend(ds):
+            name = attention_backend.get(ds) if isinstance(attention_backend, dict) else attention_backend
+            # The number of tokens attention runs on, after token merging.
+            side = image_size // ds
+            return dict(attention_backend=name,
+                        sequence_length=side ** 2 - merge_count(side, side, merge_ratio(ds)),
+                        dtype=self.dtype)
 
         time_embed_dim = model_channels * 4
         self.time_embed = nn.Sequential(
@@ -375,7 +708,7 @@ class UNetModel(nn.Module):
 
         ch = input_ch = int(channel_mult[0] * model_channels)
         self.input_blocks = nn.ModuleList(
-            [TimestepEmbedSequential(nn.Conv2d(in_channels, ch, 3, padding=1))]
+            [TimestepEmbedSequential(Conv2d(in_channels, ch, 3, padding=1))]
         )
         self._feature_size = ch
         input_block_chans = [ch]
@@ -390,6 +723,7 @@ class UNetModel(nn.Module):
                         out_channels=int(mult * model_channels),
                         dims=dims,
                         use_scale_shift_norm=use_scale_shift_norm,
+                        **res_checkpoint,
                     )
                 ]
                 ch = int(mult * model_channels)
@@ -400,6 +734,10 @@ class UNetModel(nn.Module):
                             num_heads=num_heads,
                             num_head_channels=num_head_channels,
                             use_new_attention_order=use_new_attention_order,
+                            attention_chunk_size=chunk_size(ds),
+                            **backend(ds),
+                            token_merge_ratio=merge_ratio(ds),
+                            **attn_checkpoint,
                         )
                     )
                 self.input_blocks.append(TimestepEmbedSequential(*layers))
@@ -416,6 +754,7 @@ class UNetModel(nn.Module):
                             out_channels=out_ch,
                             dims=dims,
                             use_scale_shift_norm=use_scale_shift_norm,
+                            **res_checkpoint,
                             down=True,
                         )
                         if resblock_updown
@@ -436,12 +775,17 @@ class UNetModel(nn.Module):
                 dropout,
                 dims=dims,
                 use_scale_shift_norm=use_scale_shift_norm,
+                **res_checkpoint,
             ),
             AttentionBlock(
                 ch,
                 num_heads=num_heads,
                 num_head_channels=num_head_channels,
                 use_new_attention_order=use_new_attention_order,
+                attention_chunk_size=chunk_size(ds),
+                **backend(ds),
+                token_merge_ratio=merge_ratio(ds),
+                **attn_checkpoint,
             ),
             ResBlock(
                 ch,
@@ -449,6 +793,7 @@ class UNetModel(nn.Module):
                 dropout,
                 dims=dims,
                 use_scale_shift_norm=use_scale_shift_norm,
+                **res_checkpoint,
             ),
         )
         self._feature_size += ch
@@ -465,6 +810,7 @@ class UNetModel(nn.Module):
                         out_channels=int(model_channels * mult),
                         dims=dims,
                         use_scale_shift_norm=use_scale_shift_norm,
+                        **res_checkpoint,
                     )
                 ]
                 ch = int(model_channels * mult)
@@ -475,6 +821,10 @@ class UNetModel(nn.Module):
                             num_heads=num_heads_upsample,
                             num_head_channels=num_head_channels,
                             use_new_attention_order=use_new_attention_order,
+                            attention_chunk_size=chunk_size(ds),
+                            **backend(ds),
+                            token_merge_ratio=merge_ratio(ds),
+                            **attn_checkpoint,
                         )
                     )
                 if level and i == num_res_blocks:
@@ -487,6 +837,7 @@ class UNetModel(nn.Module):
                             out_channels=out_ch,
                             dims=dims,
                             use_scale_shift_norm=use_scale_shift_norm,
+                            **res_checkpoint,
                             up=True,
                         )
                         if resblock_updown
@@ -499,9 +850,105 @@ class UNetModel(nn.Module):
         self.out = nn.Sequential(
             normalization(ch),
             nn.SiLU(),
-            nn.Conv2d(input_ch, out_channels, 3, padding=1, zero_init=True),
+            Conv2d(input_ch, out_channels, 3, padding=1, zero_init=True),
         )
 
+        for (_, module) in self.named_modules():
+            if hasattr(module, 'layout'):
+                module.layout = layout
+
+    def prepare_params(self, px):
+        """
+        Convert checkpoint parameters, in place, into the form this model runs
+        with: qkv projections in each attention backend's channel order and,
+        with use_fp16, the torso in half precision; with the NHWC layout,
+        convolution weights channels-last. Returns `px`. Prepared parameters
+        are not a checkpoint and should not be saved as one.
+        """
+        for (_, module) in self.named_modules():
+            if isinstance(module, AttentionBlock):
+                module.prepare_params(px)
+        if self.layout == 'NHWC':
+            self.convert_to_channels_last(px)
+        if self.use_fp16:
+            self.convert_to_fp16(px)
+        return px
+
+    def embed_timesteps(self, cx, timesteps, y=None):
+        """The [N x time_embed_dim] embedding of `timesteps` and labels `y`."""
+        emb = self.time_embed(cx, timestep_embedding(timesteps, self.model_channels))
+        if self.num_classes is not None:
+            emb = emb + self.label_emb(cx, y)
+        return emb
+
+    def embedding(self, cx, timesteps, y=None):
+        """
+        The embedding passed to each block. With the tables from
+        precompute_timestep_tables(), an (indices, embeddings) pair: the
+        index of each timestep in the tables, or -1 if it is not in them,
+        and the embeddings that blocks fall back on for those. Embeddings are
+        only computed if some timestep is missing, else they are zeros.
+        """
+        if TIMESTEP_TABLE in cx.px:
+            match = timesteps[:, None] == cx.px[TIMESTEP_TABLE][None, :]
+            found = match.any(axis=1)
+            indices = jnp.where(found, match.argmax(axis=1), -1)
+            time_embed_dim = self.time_embed.modules[-1].weight.shape[0]
+            emb = jax.lax.cond(found.all(),
+                               lambda: jnp.zeros([timesteps.shape[0], time_embed_dim], jnp.float32),
+                               lambda: self.embed_timesteps(cx, timesteps, y).astype(jnp.float32))
+            return (indices, emb)
+        return self.embed_timesteps(cx, timesteps, y)
+
+    def precompute_timestep_tables(self, px, timesteps):
+        """
+        Precompute, in place, the timestep embedding projection of every
+        ResBlock for each of `timesteps`. Returns `px`.
+
+        forward() then looks up each block's projection from its table rather
+        than running the time_embed MLP and each block's emb_layers, for
+        timesteps equal to one of `timesteps`; any other timestep is embedded
+        as without tables, at the usual cost. Call this after
+        prepare_params(), with every timestep the model will be run at, such
+        as diffusion.model_timesteps(). The tables hold
+        len(timesteps) x (2 x) out_channels values per block.
+
+        :param timesteps: a 1-D sequence of timesteps, as passed to forward().
+        """
+        if self.num_classes is not None:
+            raise ValueError('timestep tables cannot be used with a class-conditional model')
+        timesteps = jnp.asarray(timesteps, dtype=jnp.float32)
+        cx = Context(px, jax.random.PRNGKey(0))
+        emb = self.embed_timesteps(cx, timesteps)
+        for (_, module) in self.named_modules():
+            if isinstance(module, ResBlock):
+                px[module.emb_table_name] = module.emb_layers(cx, emb)
+        px[TIMESTEP_TABLE] = timesteps
+        return px
+
+    def convert_to_channels_last(self, px):
+        """
+        Transpose convolution weights, in place, from OIHW to HWIO (and OIW to
+        WIO). Returns `px`.
+        """
+        for (_, module) in self.named_modules():
+            if isinstance(module, (Conv1d, Conv2d)):
+                axes = tuple(range(2, len(module.weight.shape))) + (1, 0)
+                if hasattr(px, 'transpose'):
+                    # Quantized weights keep track of their scale axis.
+                    px.transpose(module.weight, axes)
+                else:
+                    px[module.weight] = px[module.weight].transpose(axes)
+        return px
+
+    def convert_to_fp16(self, px):
+        """
+        Convert the torso of the model to self.dtype, in place. Returns `px`.
+        """
+        for blocks in (self.input_blocks, self.middle_block, self.output_blocks):
+            convert_module_to_f16(blocks, px, self.dtype)
+        return px
+
     def forward(self, cx, x, timesteps, y=None):
         """
         Apply the model to an input batch.
@@ -511,23 +958,320 @@ class UNetModel(nn.Module):
         :param y: an [N] Tensor of labels, if class-conditional.
         :return: an [N x C x ...] Tensor of outputs.
         """
+        return self.forward_cached(cx, x, timesteps, y)[0]
+
+    def forward_cached(self, cx, x, timesteps, y=None, depth=None, deep=None):
+        """
+        Apply the model, returning or reusing its deep features, for reuse
+        across sampling steps as in DeepCache (see lib/deep_cache.py).
+
+        The first `depth` input blocks and the last `depth` output blocks are
+        shallow; the deep features are the activations entering the first of
+        those output blocks, which depend on every other block.
+
+        :param depth: the number of shallow blocks at each end, or None to
+                      run the whole model without returning features.
+        :param deep: if specified, deep features from an earlier call with
+                     the same depth; only the shallow blocks are run, and
+                     these are used in place of the rest.
+        :return: (an [N x C x ...] Tensor of outputs, the deep features, or
+                 None if depth is None).
+        """
         assert (y is not None) == (
             self.num_classes is not None
         ), "must specify y if and only if the model is class-conditional"
 
-        hs = []
-        emb = self.time_embed(cx, timestep_embedding(timesteps, self.model_channels))
-
         if self.num_classes is not None:
             assert y.shape == (x.shape[0],)
-            emb = emb + self.label_emb(cx, y)
 
-        h = x
-        for module in self.input_blocks:
+        input_blocks = list(self.input_blocks)
+        output_blocks = list(self.output_blocks)
+        split = len(output_blocks) if depth is None else len(output_blocks) - depth
+
+        hs = []
+        emb = self.embedding(cx, timesteps, y)
+
+        h = x.astype(self.dtype)
+        if self.layout == 'NHWC':
+            h = h.transpose(0, 2, 3, 1)
+        for module in (input_blocks if deep is None else input_blocks[:depth]):
             h = module(cx, h, emb)
             hs.append(h)
-        h = self.middle_block(cx, h, emb)
-        for module in self.output_blocks:
-            h = jnp.concatenate([h, hs.pop()], axis=1)
+        if deep is None:
+            h = self.middle_block(cx, h, emb)
+            for module in output_blocks[:split]:
+                h = jnp.concatenate([h, hs.pop()], axis=channel_axis(self.layout))
+                h = module(cx, h, emb)
+            deep = h if depth is not None else None
+        else:
+            h = deep
+        for module in output_blocks[split:]:
+            h = jnp.concatenate([h, hs.pop()], axis=channel_axis(self.layout))
             h = module(cx, h, emb)
-        return self.out(cx, h)
+        (out_norm, _, out_conv) = self.out.modules
+        h = out_conv(cx, out_norm.silu(cx, h.astype(x.dtype)))
+        if self.layout == 'NHWC':
+            h = h.transpose(0, 3, 1, 2)
+        return h, deep
+
+class AttentionPool2d(Module):
+    """
+    Adapted from CLIP: https://github.com/openai/CLIP/blob/main/clip/model.py
+    """
+
+    def __init__(self, spacial_dim, embed_dim, num_heads_channels, output_dim=None):
+        super().__init__()
+        self.positional_embedding = init.normal(embed_dim, spacial_dim ** 2 + 1, stddev=embed_dim ** -0.5)
+        self.qkv_proj = Conv1d(embed_dim, 3 * embed_dim, 1)
+        self.c_proj = Conv1d(embed_dim, output_dim or embed_dim, 1)
+        self.num_heads = embed_dim // num_heads_channels
+        self.attention = QKVAttention(self.num_heads)
+
+    def forward(self, cx, x):
+        b, c, *_spatial = x.shape
+        x = x.reshape(b, c, -1)  # NC(HW)
+        x = jnp.concatenate([x.mean(axis=-1, keepdims=True), x], axis=-1)  # NC(HW+1)
+        x = x + cx[self.positional_embedding][None, :, :].astype(x.dtype)  # NC(HW+1)
+        x = self.qkv_proj(cx, x)
+        x = self.attention(cx, x)
+        x = self.c_proj(cx, x)
+        return x[:, :, 0]
+
+class AdaptiveAvgPool2D(Module):
+    """Average over the spatial dimensions, keeping them (as size 1)."""
+
+    def forward(self, cx, x):
+        return x.mean(axis=(2, 3), keepdims=True)
+
+class Flatten(Module):
+    def forward(self, cx, x):
+        return x.reshape(x.shape[0], -1)
+
+class EncoderUNetModel(Module):
+    """
+    The half UNet model with attention and timestep embedding, as used by
+    the noisy ImageNet classifiers for classifier guidance.
+
+    For usage, see UNetModel, including its use_checkpoint modes. Only the
+    NCHW layout is supported.
+
+    :param pool: how the final features are reduced to outputs: 'adaptive'
+                 (averaged, then a 1x1 convolution), 'attention' (attention
+                 pooling, as in CLIP), 'spatial' or 'spatial_v2' (an MLP on
+                 the spatially averaged output of every block).
+    """
+
+    def __init__(
+        self,
+        image_size,
+        in_channels,
+        model_channels,
+        out_channels,
+        num_res_blocks,
+        attention_resolutions,
+        dropout=0,
+        channel_mult=(1, 2, 4, 8),
+        conv_resample=True,
+        dims=2,
+        use_checkpoint=False,
+        use_fp16=False,
+        fp16_dtype="bfloat16",
+        num_heads=1,
+        num_head_channels=-1,
+        num_heads_upsample=-1,
+        use_scale_shift_norm=False,
+        resblock_updown=False,
+        use_new_attention_order=False,
+        pool="adaptive",
+    ):
+        super().__init__()
+
+        if num_heads_upsample == -1:
+            num_heads_upsample = num_heads
+
+        self.in_channels = in_channels
+        self.model_channels = model_channels
+        self.out_channels = out_channels
+        self.num_res_blocks = num_res_blocks
+        self.attention_resolutions = attention_resolutions
+        self.dropout = dropout
+        self.channel_mult = channel_mult
+        self.conv_resample = conv_resample
+        self.use_checkpoint = use_checkpoint
+        self.use_fp16 = use_fp16
+        self.dtype = HALF_DTYPES[fp16_dtype] if use_fp16 else jnp.float32
+        self.num_heads = num_heads
+        self.num_head_channels = num_head_channels
+        self.num_heads_upsample = num_heads_upsample
+        (res_checkpoint, attn_checkpoint) = checkpoint_options(use_checkpoint)
+
+        time_embed_dim = model_channels * 4
+        self.time_embed = nn.Sequential(
+            nn.Linear(model_channels, time_embed_dim),
+            nn.SiLU(),
+            nn.Linear(time_embed_dim, time_embed_dim),
+        )
+
+        ch = int(channel_mult[0] * model_channels)
+        self.input_blocks = nn.ModuleList(
+            [TimestepEmbedSequential(Conv2d(in_channels, ch, 3, padding=1))]
+        )
+        self._feature_size = ch
+        input_block_chans = [ch]
+        ds = 1
+        for level, mult in enumerate(channel_mult):
+            for _ in range(num_res_blocks):
+                layers = [
+                    ResBlock(
+                        ch,
+                        time_embed_dim,
+                        dropout,
+                        out_channels=int(mult * model_channels),
+                        dims=dims,
+                        **res_checkpoint,
+                        use_scale_shift_norm=use_scale_shift_norm,
+                    )
+                ]
+                ch = int(mult * model_channels)
+                if ds in attention_resolutions:
+                    layers.append(
+                        AttentionBlock(
+                            ch,
+                            **attn_checkpoint,
+                            num_heads=num_heads,
+                            num_head_channels=num_head_channels,
+                            use_new_attention_order=use_new_attention_order,
+                        )
+                    )
+                self.input_blocks.append(TimestepEmbedSequential(*layers))
+                self._feature_size += ch
+                input_block_chans.append(ch)
+            if level != len(channel_mult) - 1:
+                out_ch = ch
+                self.input_blocks.append(
+                    TimestepEmbedSequential(
+                        ResBlock(
+                            ch,
+                            time_embed_dim,
+                            dropout,
+                            out_channels=out_ch,
+                            dims=dims,
+                            **res_checkpoint,
+                            use_scale_shift_norm=use_scale_shift_norm,
+                            down=True,
+                        )
+                        if resblock_updown
+                        else Downsample2D(
+                            ch, conv_resample, out_channels=out_ch
+                        )
+                    )
+                )
+                ch = out_ch
+                input_block_chans.append(ch)
+                ds *= 2
+                self._feature_size += ch
+
+        self.middle_block = TimestepEmbedSequential(
+            ResBlock(
+                ch,
+                time_embed_dim,
+                dropout,
+                dims=dims,
+                **res_checkpoint,
+                use_scale_shift_norm=use_scale_shift_norm,
+            ),
+            AttentionBlock(
+                ch,
+                **attn_checkpoint,
+                num_heads=num_heads,
+                num_head_channels=num_head_channels,
+                use_new_attention_order=use_new_attention_order,
+            ),
+            ResBlock(
+                ch,
+                time_embed_dim,
+                dropout,
+                dims=dims,
+                **res_checkpoint,
+                use_scale_shift_norm=use_scale_shift_norm,
+            ),
+        )
+        self._feature_size += ch
+        self.pool = pool
+        if pool == "adaptive":
+            self.out = nn.Sequential(
+                normalization(ch),
+                nn.SiLU(),
+                AdaptiveAvgPool2D(),
+                Conv2d(ch, out_channels, 1, zero_init=True),
+                Flatten(),
+            )
+        elif pool == "attention":
+            assert num_head_channels != -1
+            self.out = nn.Sequential(
+                normalization(ch),
+                nn.SiLU(),
+                AttentionPool2d(
+                    (image_size // ds), ch, num_head_channels, out_channels
+                ),
+            )
+        elif pool == "spatial":
+            self.out = nn.Sequential(
+                nn.Linear(self._feature_size, 2048),
+                nn.ReLU(),
+                nn.Linear(2048, self.out_channels),
+            )
+        elif pool == "spatial_v2":
+            self.out = nn.Sequential(
+                nn.Linear(self._feature_size, 2048),
+                normalization(2048),
+                nn.SiLU(),
+                nn.Linear(2048, self.out_channels),
+            )
+        else:
+            raise NotImplementedError(f"Unexpected {pool} pooling")
+
+    def prepare_params(self, px):
+        """
+        Convert checkpoint parameters, in place, into the form this model runs
+        with, as UNetModel.prepare_params(). Returns `px`.
+        """
+        for (_, module) in self.named_modules():
+            if isinstance(module, AttentionBlock):
+                module.prepare_params(px)
+        if self.use_fp16:
+            self.convert_to_fp16(px)
+        return px
+
+    def convert_to_fp16(self, px):
+        """
+        Convert the torso of the model to self.dtype, in place. Returns `px`.
+        """
+        for blocks in (self.input_blocks, self.middle_block):
+            convert_module_to_f16(blocks, px, self.dtype)
+        return px
+
+    def forward(self, cx, x, timesteps):
+        """
+        Apply the model to an input batch.
+
+        :param x: an [N x C x ...] Tensor of inputs.
+        :param timesteps: a 1-D batch of timesteps.
+        :return: an [N x K] Tensor of outputs.
+        """
+        emb = self.time_embed(cx, timestep_embedding(timesteps, self.model_channels))
+
+        results = []
+        h = x.astype(self.dtype)
+        for module in self.input_blocks:
+            h = module(cx, h, emb)
+            if self.pool.startswith("spatial"):
+                results.append(h.astype(x.dtype).mean(axis=(2, 3)))
+        h = self.middle_block(cx, h, emb)
+        if self.pool.startswith("spatial"):
+            results.append(h.astype(x.dtype).mean(axis=(2, 3)))
+            h = jnp.concatenate(results, axis=-1)
+            return self.out(cx, h)
+        else:
+            h = h.astype(x.dtype)
+            return self.out(cx, h)
@@ -0,0 +1,98 @@
+"""
+Report the accuracy of the mixed precision UNet against float32.
+
+Usage: python precision_report.py <checkpoint> [options]
+
+Runs the float32 model and the use_fp16 model (see UNetModel) on the same
+random inputs and compares the model outputs, the predicted x_0 used for
+CLIP guidance, and the gradient through the model that guidance
+backpropagates (as in base_cond_fn in execute.py).
+"""
+
+import argparse
+import functools
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+from jaxtorch import Context
+
+from lib.script_util import create_model_and_diffusion, model_and_diffusion_defaults
+from lib.checkpoint import load_params
+from lib.tensor_archive import open_archive
+from lib.torch_checkpoint import TorchStateDict
+
+def rel_rms(a, b):
+    return np.sqrt(np.mean((np.asarray(a) - np.asarray(b))**2) / np.mean(np.asarray(b)**2))
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the mixed precision UNet with float32.')
+    parser.add_argument('checkpoint')
+    parser.add_argument('--image_size', type=int, default=512, choices=[256, 512],
+                        help='selects the model config')
+    parser.add_argument('--fp16_dtype', default='bfloat16', choices=['bfloat16', 'float16'])
+    parser.add_argument('--test_size', type=int, default=64, help='resolution of the test inputs')
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--timesteps', default='999,750,500,250,0')
+    args = parser.parse_args()
+
+    models = {}
+    for use_fp16 in (False, True):
+        model_config = model_and_diffusion_defaults()
+        model_config.update({
+            'attention_resolutions': '32, 16, 8',
+            'class_cond': False,
+            'diffusion_steps': 1000,
+            'rescale_timesteps': True,
+            'timestep_respacing': '1000',
+            'image_size': args.image_size,
+            'learn_sigma': True,
+            'noise_schedule': 'linear',
+            'num_channels': 256,
+            'num_head_channels': 64,
+            'num_res_blocks': 2,
+            'resblock_updown': True,
+            'use_fp16': use_fp16,
+            'fp16_dtype': args.fp16_dtype,
+            'use_scale_shift_norm': True,
+        })
+        models[use_fp16] = create_model_and_diffusion(**model_config)
+    (model, diffusion) = models[False]
+    (half_model, _) = models[True]
+
+    if args.checkpoint.endswith('.pt'):
+        state_dict = TorchStateDict(args.checkpoint)
+    else:
+        state_dict = open_archive(args.checkpoint)
+    params = load_params(model, state_dict)
+    half_params = half_model.prepare_params(load_params(half_model, state_dict))
+
+    def exec_model(model, model_params, x, timesteps, y=None):
+        cx = Context(model_params, jax.random.PRNGKey(0))
+        return model(cx, x, timesteps, y=y)
+
+    @functools.partial(jax.jit, static_argnums=0)
+    def evaluate(use_fp16, model_params, x, t, direction):
+        run_model = functools.partial(exec_model, models[use_fp16][0], model_params)
+        def pred_xstart(x):
+            return diffusion.p_mean_variance(run_model, x, t, clip_denoised=False)['pred_xstart']
+        output = run_model(x, diffusion._scale_timesteps(t))
+        (xstart, backward) = jax.vjp(pred_xstart, x)
+        return output, xstart, backward(direction)[0]
+
+    rng = jax.random.PRNGKey(0)
+    x = jax.random.normal(jax.random.fold_in(rng, 0), [args.batch_size, 3, args.test_size, args.test_size])
+    # A fixed random cotangent stands in for the CLIP loss gradient.
+    direction = jax.random.normal(jax.random.fold_in(rng, 1), x.shape)
+
+    print(f'{args.fp16_dtype} vs float32, relative rms error:')
+    print('  timestep  model output     pred_xstart  guidance grad')
+    for t in [int(t) for t in args.timesteps.split(',')]:
+        t = jnp.full([args.batch_size], t, dtype=jnp.int32)
+        reference = evaluate(False, params, x, t, direction)
+        result = evaluate(True, half_params, x, t, direction)
+        errors = [rel_rms(a, b) for (a, b) in zip(result, reference)]
+        print(f'  {int(t[0]):8}  {errors[0]:12.2e}  {errors[1]:14.2e}  {errors[2]:13.2e}')
+
+if __name__ == '__main__':
+    main()
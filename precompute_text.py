@@ -0,0 +1,35 @@
+"""
+Precompute CLIP text embeddings for a list of prompts.
+
+Usage: python precompute_text.py prompts.txt [clip model]
+
+prompts.txt holds one prompt per line. Embeddings are written to the same
+on-disk store that execute.py reads from, so later runs with these prompts
+never touch the text encoder.
+"""
+
+import sys
+sys.path.append('./CLIP_JAX')
+import clip_jax
+
+from lib.text_embed import TextEmbedder
+
+def main():
+    prompts_file = sys.argv[1]
+    model_name = sys.argv[2] if len(sys.argv) > 2 else 'ViT-B/32'
+
+    with open(prompts_file, 'r') as fp:
+        lines = [line.strip() for line in fp if line.strip()]
+    # Each distinct prompt is counted, and embedded, once.
+    prompts = list(dict.fromkeys(lines))
+
+    print('Loading CLIP model...')
+    image_fn, text_fn, clip_params, _ = clip_jax.load(model_name)
+    embedder = TextEmbedder(text_fn, clip_params, clip_jax.tokenize, model_name, batch_size=64)
+
+    encoded = embedder.precompute(prompts)
+    print(f'{len(prompts)} distinct prompts ({len(lines) - len(prompts)} duplicates), '
+          f'{encoded} encoded, {len(prompts) - encoded} already cached')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Quantize a UNet checkpoint to int8 and report the error against float32.
+
+Usage: python quantize_checkpoint.py <checkpoint> <output .tensors> [options]
+
+The checkpoint may be a .tensors archive (or shard index) or a .pt file.
+Conv and linear weights are quantized per output channel (see
+lib/quantize.py). The report compares the quantized and float32 models on
+the same random inputs at several timesteps. execute.py loads the output
+like any other .tensors checkpoint.
+"""
+
+import os
+import argparse
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+from jaxtorch import Context
+
+from lib.script_util import create_model_and_diffusion, model_and_diffusion_defaults
+from lib.checkpoint import load_params
+from lib.tensor_archive import open_archive
+from lib.torch_checkpoint import TorchStateDict
+from lib.quantize import quantized_names, save_quantized, load_quantized
+
+def main():
+    parser = argparse.ArgumentParser(description='Quantize a UNet checkpoint to int8.')
+    parser.add_argument('checkpoint')
+    parser.add_argument('output')
+    parser.add_argument('--image_size', type=int, default=512, choices=[256, 512],
+                        help='selects the model config')
+    parser.add_argument('--test_size', type=int, default=64, help='resolution of the error report inputs')
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--timesteps', default='999,750,500,250,0')
+    args = parser.parse_args()
+
+    model_config = model_and_diffusion_defaults()
+    model_config.update({
+        'attention_resolutions': '32, 16, 8',
+        'class_cond': False,
+        'diffusion_steps': 1000,
+        'rescale_timesteps': True,
+        'timestep_respacing': '1000',
+        'image_size': args.image_size,
+        'learn_sigma': True,
+        'noise_schedule': 'linear',
+        'num_channels': 256,
+        'num_head_channels': 64,
+        'num_res_blocks': 2,
+        'resblock_updown': True,
+        'use_scale_shift_norm': True,
+    })
+    model, diffusion = create_model_and_diffusion(**model_config)
+
+    if args.checkpoint.endswith('.pt'):
+        state_dict = TorchStateDict(args.checkpoint)
+    else:
+        state_dict = open_archive(args.checkpoint)
+
+    print('Quantizing...')
+    save_quantized(model, state_dict, args.output,
+                   metadata={'source': os.path.basename(args.checkpoint)})
+    print(f'Wrote {args.output}')
+
+    names = quantized_names(model)
+    fp32_params = load_params(model, state_dict)
+    int8_params = load_quantized(model, open_archive(args.output))
+    fp32_bytes = sum(fp32_params[name].nbytes for (name, _) in model.named_parameters())
+    int8_bytes = int8_params.nbytes()
+    print(f'Weights: {fp32_bytes / 2**20:.1f} MiB fp32, {int8_bytes / 2**20:.1f} MiB int8 '
+          f'({fp32_bytes / int8_bytes:.2f}x smaller, {len(names)} tensors quantized)')
+
+    weight_errors = []
+    for name in sorted(names):
+        w = np.asarray(fp32_params[name])
+        dw = np.asarray(int8_params[name]) - w
+        weight_errors.append((np.sqrt(np.mean(dw**2) / max(np.mean(w**2), 1e-30)), name))
+    weight_errors.sort(reverse=True)
+    print('Largest relative weight errors (rms):')
+    for (err, name) in weight_errors[:5]:
+        print(f'  {err:.2e}  {name}')
+
+    @jax.jit
+    def exec_model(params, x, timesteps):
+        cx = Context(params, jax.random.PRNGKey(0))
+        return model(cx, x, diffusion._scale_timesteps(timesteps))
+
+    x = jax.random.normal(jax.random.PRNGKey(0), [args.batch_size, 3, args.test_size, args.test_size])
+    print('Model output error, int8 vs fp32:')
+    print('  timestep  rel rms (eps)  max abs (eps)  rel rms (var)')
+    for t in [int(t) for t in args.timesteps.split(',')]:
+        timesteps = jnp.full([args.batch_size], t, dtype=jnp.int32)
+        ref = np.asarray(exec_model(fp32_params, x, timesteps))
+        out = np.asarray(exec_model(int8_params, x, timesteps))
+        (ref_eps, ref_var) = np.split(ref, 2, axis=1)
+        (out_eps, out_var) = np.split(out, 2, axis=1)
+        rel = lambda a, b: np.sqrt(np.mean((a - b)**2) / np.mean(b**2))
+        print(f'  {t:8}  {rel(out_eps, ref_eps):13.2e}  {np.abs(out_eps - ref_eps).max():13.2e}'
+              f'  {rel(out_var, ref_var):13.2e}')
+
+if __name__ == '__main__':
+    main()
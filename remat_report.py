@@ -0,0 +1,125 @@
+"""
+Report the memory/time tradeoff of the use_checkpoint modes of UNetModel.
+
+Usage: python remat_report.py [options]
+
+For each mode, compiles the backward pass used by CLIP guidance (the vjp of
+pred_xstart with respect to x, as in base_cond_fn in execute.py) or by
+training (the gradient of the loss with respect to the parameters, as in
+train.py), and reports the size of the activations saved for the backward
+pass, XLA's temporary buffer size and the time per call. With --int8, the
+parameters are int8 quantized as by quantize_checkpoint.py, and residuals
+include the int8 weights and scales rather than float copies.
+Parameters are random; only shapes matter here.
+"""
+
+import time
+import argparse
+import functools
+
+import jax
+import jax.numpy as jnp
+from jaxtorch import PRNG, Context, ParamState
+
+from lib.script_util import create_model_and_diffusion, model_and_diffusion_defaults
+from lib.unet import CHECKPOINT_MODES
+from lib.quantize import QuantizedParamState, quantize_weight, quantized_names
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare use_checkpoint modes.')
+    parser.add_argument('--image_size', type=int, default=512, choices=[256, 512],
+                        help='selects the model config')
+    parser.add_argument('--test_size', type=int, default=None, help='input resolution (default: image_size)')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--backward', default='guidance', choices=['guidance', 'train'])
+    parser.add_argument('--modes', default=','.join(str(m) for m in CHECKPOINT_MODES[1:]),
+                        help='comma separated use_checkpoint modes to compare with False')
+    parser.add_argument('--iterations', type=int, default=3)
+    parser.add_argument('--int8', action='store_true', help='quantize the weights to int8')
+    args = parser.parse_args()
+    if args.int8 and args.backward != 'guidance':
+        parser.error('int8 weights are not trained; --int8 needs --backward guidance')
+    test_size = args.test_size or args.image_size
+
+    modes = [False] + [True if m == 'True' else m for m in args.modes.split(',')]
+    print(f'{args.backward} backward, batch {args.batch_size}, {test_size}x{test_size}'
+          f'{", int8 weights" if args.int8 else ""}')
+    print('  use_checkpoint  residuals (MiB)  temp memory (MiB)  time (s)')
+    params = None
+    for mode in modes:
+        model_config = model_and_diffusion_defaults()
+        model_config.update({
+            'attention_resolutions': '32, 16, 8',
+            'class_cond': False,
+            'diffusion_steps': 1000,
+            'rescale_timesteps': True,
+            'timestep_respacing': '1000',
+            'image_size': args.image_size,
+            'learn_sigma': True,
+            'noise_schedule': 'linear',
+            'num_channels': 256,
+            'num_head_channels': 64,
+            'num_res_blocks': 2,
+            'resblock_updown': True,
+            'use_checkpoint': mode,
+            'use_scale_shift_norm': True,
+        })
+        model, diffusion = create_model_and_diffusion(**model_config)
+        if params is None:
+            # Parameter names do not depend on the mode, so one set serves all.
+            params = ParamState(model.labeled_parameters_())
+            params.initialize(jax.random.PRNGKey(0))
+            if args.int8:
+                names = quantized_names(model)
+                values = {}
+                scales = {}
+                for (name, _) in model.named_parameters():
+                    if name in names:
+                        (values[name], scales[name]) = map(jnp.asarray, quantize_weight(params[name]))
+                    else:
+                        values[name] = params[name]
+                params = QuantizedParamState(values, scales)
+        else:
+            model.labeled_parameters_()
+
+        def exec_model(model_params, x, timesteps, y=None):
+            cx = Context(model_params, jax.random.PRNGKey(0))
+            return model(cx, x, timesteps, y=y)
+
+        if args.backward == 'guidance':
+            def differentiated(model_params, x, t):
+                def pred_xstart(x):
+                    return diffusion.p_mean_variance(functools.partial(exec_model, model_params),
+                                                     x, t, clip_denoised=False)['pred_xstart']
+                return pred_xstart, x
+        else:
+            def differentiated(model_params, x, t):
+                def loss(model_params):
+                    run_model = functools.partial(exec_model, model_params)
+                    return diffusion.training_losses(run_model, x, t, PRNG(jax.random.PRNGKey(1)))['loss'].mean()
+                return loss, model_params
+
+        def backward(model_params, x, t):
+            (out, vjp) = jax.vjp(*differentiated(model_params, x, t))
+            return vjp(jnp.ones_like(out))
+
+        def residuals(model_params, x, t):
+            # Everything the backward pass keeps from the forward pass,
+            # including the parameters themselves.
+            return jax.tree_util.tree_leaves(jax.vjp(*differentiated(model_params, x, t))[1])
+
+        x = jax.random.normal(jax.random.PRNGKey(2), [args.batch_size, 3, test_size, test_size])
+        t = jnp.full([args.batch_size], 500, dtype=jnp.int32)
+        saved = sum(r.size * r.dtype.itemsize for r in jax.eval_shape(residuals, params, x, t))
+        compiled = jax.jit(backward).lower(params, x, t).compile()
+        memory = compiled.memory_analysis()
+        temp = f'{memory.temp_size_in_bytes / 2**20:17.1f}' if memory is not None else f'{"n/a":>17}'
+        jax.block_until_ready(compiled(params, x, t))
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            jax.block_until_ready(compiled(params, x, t))
+        elapsed = (time.perf_counter() - start) / args.iterations
+        print(f'  {str(mode):>14}  {saved / 2**20:15.1f}  {temp}  {elapsed:8.3f}')
+
+if __name__ == '__main__':
+    main()
@@ -20,6 +20,9 @@ from einops import rearrange
 import jax.experimental.optimizers
 
 from lib.script_util import create_model_and_diffusion, model_and_diffusion_defaults
+from lib.checkpoint import load_params
+from lib.torch_checkpoint import TorchStateDict
+from lib.fp16_util import INITIAL_LG_LOSS_SCALE, uses_loss_scaling, unscale_grads, update_lg_loss_scale
 
 def pil_to_tensor(pil_image):
   img = np.array(pil_image).astype('float32')
@@ -48,11 +51,8 @@ def make_cutout(image, key):
 
 
 def load_torch(checkpoint):
-    import torch
-    with torch.no_grad():
-        state_dict = torch.load(checkpoint, map_location=torch.device('cpu'))
-        jax_state_dict = {name : par.cpu().numpy() for (name, par) in state_dict.items()}
-        return jax_state_dict
+    # Lazily mapped: load_params() pulls one tensor at a time to the device.
+    return TorchStateDict(checkpoint)
 
 
 # Model settings
@@ -71,6 +71,8 @@ model_config.update({
     'num_head_channels': 64,
     'num_res_blocks': 2,
     'resblock_updown': True,
+    # Rematerialize block activations in the backward pass to fit 512px.
+    'use_checkpoint': True,
     # 'use_fp16': True,
     'use_scale_shift_norm': True,
 })
@@ -85,10 +87,13 @@ def exec_model(model_params, x, timesteps, y=None, key=None):
     return model(cx, x, timesteps, y=y)
 # exec_model_jit = functools.partial(jax.jit(exec_model), model_params)
 
-def exec_loss(model_params, x, t, key):
+def exec_loss(model_params, x, t, key, lg_loss_scale=0.0):
     rng = PRNG(key)
+    # The optimizer updates float32 master weights in checkpoint form; they
+    # are converted for execution (e.g. cast to half precision) once per step.
+    model_params = model.prepare_params(jax.tree_util.tree_map(lambda p: p, model_params))
     run_model = partial(exec_model, model_params, key=rng.split())
-    return diffusion.training_losses(run_model, x, t, rng)['loss'].mean()
+    return diffusion.training_losses(run_model, x, t, rng)['loss'].mean() * 2 ** lg_loss_scale
 exec_loss_jit = jax.jit(exec_loss)
 exec_grad_jit = jax.jit(jax.value_and_grad(exec_loss))
 
@@ -113,14 +118,12 @@ def get_batch(bs=1):
     return jnp.concatenate(batch, axis=0)
 
 def main():
-    model_params = ParamState(model.labeled_parameters_())
-    model_params.initialize(jax.random.PRNGKey(0))
-
     print('Loading state dict...')
     jax_state_dict = load_torch('512x512_diffusion_uncond_finetune_008100.pt')
     # with open('512x512_diffusion_uncond_finetune_008100.cbor', 'rb') as fp:
     #     jax_state_dict = jaxtorch.cbor.load(fp)
-    model.load_state_dict(model_params, jax_state_dict)
+    model_params = load_params(model, jax_state_dict)
+    del jax_state_dict
 
     rng = PRNG(jax.random.PRNGKey(0))
 
@@ -130,11 +133,21 @@ def main():
     # opt_init, opt_update, opt_params = jax.experimental.optimizers.adam(1e-4, b1=0.9, b2=0.999, eps=1e-08)
     # opt = opt_init(model_params)
 
+    # float16 needs dynamic loss scaling to keep gradients from underflowing.
+    lg_loss_scale = INITIAL_LG_LOSS_SCALE if uses_loss_scaling(model) else 0.0
+
     counter = 1
     while True:
         batch = get_batch(1)
         t = jax.random.randint(rng.split(), [batch.shape[0]], 0, diffusion.num_timesteps)
-        loss, grad = exec_grad_jit(model_params, batch, t, rng.split())
+        loss, grad = exec_grad_jit(model_params, batch, t, rng.split(), lg_loss_scale)
+        if lg_loss_scale:
+            loss = loss * 2 ** -lg_loss_scale
+            grad, finite = unscale_grads(grad, lg_loss_scale)
+            lg_loss_scale = update_lg_loss_scale(lg_loss_scale, bool(finite))
+            if not finite:
+                print(counter, 'gradients overflowed, skipping step')
+                continue
         model_params = jax.tree_util.tree_map(lambda x, g: x - lr*g, model_params, grad)
         # opt = opt_update(counter, grad, opt)
         # model_params = opt_params(opt)
@@ -0,0 +1,196 @@
+"""
+Report the speed and quality of two-stage rendering (first_stage in
+execute.py) against sampling at full resolution directly.
+
+Usage: python two_stage_report.py <checkpoint> <first stage checkpoint> [options]
+
+For every prompt and seed, samples once at --image_size from noise, and once
+by sampling at --first_size, upsampling the result and refining it at
+--image_size over the last steps only, as execute.py does with first_stage.
+Both paths start from the same seed and are guided towards the prompt by the
+same CLIP cutout loss as execute.py's (without its style, tv and saturation
+terms). Reports each path's time per sample, with compilation excluded, and
+the CLIP similarity of its samples to their prompts, as execute.py prints
+per batch.
+"""
+
+import argparse
+import functools
+import sys
+import time
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+from jaxtorch import Context, PRNG
+
+sys.path.append('./CLIP_JAX')
+import clip_jax
+
+from lib.script_util import create_model_and_diffusion, model_and_diffusion_defaults
+from lib.checkpoint import load_params
+from lib.tensor_archive import open_archive
+from lib.torch_checkpoint import TorchStateDict
+from lib import util
+
+CLIP_SIZE = 224
+CLIP_MEAN = jnp.array([0.48145466, 0.4578275, 0.40821073]).reshape(3, 1, 1)
+CLIP_STD = jnp.array([0.26862954, 0.26130258, 0.27577711]).reshape(3, 1, 1)
+
+def norm1(x):
+    return x / jnp.sqrt(jnp.square(x).sum(axis=-1, keepdims=True))
+
+def spherical_dist_loss(x, y):
+    return 2 * jnp.square(jnp.arcsin(jnp.sqrt(jnp.square(norm1(x) - norm1(y)).sum(axis=-1)) / 2))
+
+def load_model(checkpoint, image_size, steps):
+    model_config = model_and_diffusion_defaults()
+    model_config.update({
+        'attention_resolutions': '32, 16, 8',
+        'class_cond': False,
+        'diffusion_steps': 1000,
+        'rescale_timesteps': True,
+        'timestep_respacing': steps,
+        'image_size': image_size,
+        'learn_sigma': True,
+        'noise_schedule': 'linear',
+        'num_channels': 256,
+        'num_head_channels': 64,
+        'num_res_blocks': 2,
+        'resblock_updown': True,
+        'use_scale_shift_norm': True,
+    })
+    (model, diffusion) = create_model_and_diffusion(**model_config)
+    if checkpoint.endswith('.pt'):
+        state_dict = TorchStateDict(checkpoint)
+    else:
+        state_dict = open_archive(checkpoint)
+    params = model.prepare_params(load_params(model, state_dict))
+    params = model.precompute_timestep_tables(params, diffusion.model_timesteps())
+    return model, diffusion, params
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two-stage rendering with direct sampling.')
+    parser.add_argument('checkpoint')
+    parser.add_argument('first_checkpoint')
+    parser.add_argument('--image_size', type=int, default=512, choices=[256, 512])
+    parser.add_argument('--first_size', type=int, default=256, choices=[256, 512])
+    parser.add_argument('--steps', default='100', help='timestep_respacing of both models')
+    parser.add_argument('--skip_timesteps', type=int, default=70,
+                        help='steps of the final stage skipped after the first stage')
+    parser.add_argument('--prompts', default='sigil of the knight of time. trending on ArtStation',
+                        help='prompts separated by |')
+    parser.add_argument('--seeds', default='0,1')
+    parser.add_argument('--clip_model', default='ViT-B/32')
+    parser.add_argument('--clip_guidance_scale', type=float, default=2000)
+    parser.add_argument('--cutn', type=int, default=16)
+    parser.add_argument('--cut_pow', type=float, default=0.5)
+    args = parser.parse_args()
+
+    print('Loading models...')
+    stages = {'final': load_model(args.checkpoint, args.image_size, args.steps),
+              'first': load_model(args.first_checkpoint, args.first_size, args.steps)}
+    image_fn, text_fn, clip_params, _ = clip_jax.load(args.clip_model)
+
+    def exec_model(model, model_params, x, timesteps):
+        return model(Context(model_params, jax.random.PRNGKey(0)), x, timesteps)
+    model_fns = {stage: jax.jit(functools.partial(exec_model, model, params))
+                 for (stage, (model, _, params)) in stages.items()}
+
+    def clip_embed(images):
+        """Normalized CLIP embeddings of [N x 3 x 224 x 224] images in [0, 1]."""
+        return norm1(image_fn(clip_params, (images - CLIP_MEAN) / CLIP_STD))
+
+    @functools.partial(jax.jit, static_argnums=0)
+    def guidance(stage, params, x, cur_t, key, text_embed):
+        (model, diffusion, _) = stages[stage]
+        n = x.shape[0]
+        run_model = functools.partial(exec_model, model, params)
+
+        def denoise(x):
+            out = diffusion.p_mean_variance(run_model, x, jnp.full([n], cur_t, jnp.int32), clip_denoised=False)
+            fac = diffusion.sqrt_one_minus_alphas_cumprod[cur_t]
+            return out['pred_xstart'] * fac + x * (1 - fac)
+        (x_in, backward) = jax.vjp(denoise, x)
+
+        def clip_loss(x_in):
+            # Random cutouts, as MakeCutouts in execute.py.
+            size = x_in.shape[-1]
+            rng = PRNG(key)
+            cut_us = jax.random.uniform(rng.split(), [args.cutn]) ** args.cut_pow
+            min_size = min(size, CLIP_SIZE)
+            sizes = (min_size + cut_us * (size - min_size + 1)).astype(jnp.int32).clip(min_size, size)
+            offsets_x = jax.random.randint(rng.split(), [args.cutn], 0, size - sizes + 1)
+            offsets_y = jax.random.randint(rng.split(), [args.cutn], 0, size - sizes + 1)
+            cutouts = util.cutouts_images((x_in + 1) / 2, offsets_x, offsets_y, sizes)
+            cutouts = cutouts.transpose(1, 0, 2, 3, 4).reshape(args.cutn * n, 3, CLIP_SIZE, CLIP_SIZE)
+            embeds = clip_embed(cutouts).reshape(args.cutn, n, -1)
+            return spherical_dist_loss(embeds, text_embed).mean(0).sum() * args.clip_guidance_scale
+        grad = -backward(jax.grad(clip_loss)(x_in))[0]
+        magnitude = jnp.sqrt(jnp.square(grad).mean())
+        return grad / magnitude * jnp.minimum(magnitude, 0.1)
+
+    @jax.jit
+    def clip_score(images, text_embed):
+        (n, c, _, _) = images.shape
+        images = jax.image.resize((images + 1) / 2, [n, c, CLIP_SIZE, CLIP_SIZE], method='linear')
+        return (clip_embed(images) * text_embed).sum(axis=-1)
+
+    def sample(stage, rng, text_embed, size, skip_timesteps=0, init_image=None):
+        (_, diffusion, params) = stages[stage]
+        cur_t = diffusion.num_timesteps - skip_timesteps - 1
+
+        def cond_fn(x, t):
+            return guidance(stage, params, x, jnp.array(cur_t), rng.split(), text_embed)
+        for out in diffusion.p_sample_loop_progressive(model_fns[stage], (1, 3, size, size), rng=rng,
+                                                       clip_denoised=False, cond_fn=cond_fn,
+                                                       model_kwargs={},
+                                                       skip_timesteps=skip_timesteps,
+                                                       init_image=init_image):
+            cur_t -= 1
+        return jax.block_until_ready(out['pred_xstart'])
+
+    def direct(rng, text_embed):
+        return sample('final', rng, text_embed, args.image_size)
+
+    def two_stage(rng, text_embed):
+        low = sample('first', rng, text_embed, args.first_size)
+        init = jax.image.resize(low, (1, 3, args.image_size, args.image_size), method='lanczos3').clip(-1, 1)
+        return sample('final', rng, text_embed, args.image_size, args.skip_timesteps, init)
+
+    prompts = args.prompts.split('|')
+    text_embeds = norm1(jnp.asarray(text_fn(clip_params, clip_jax.tokenize(prompts))))
+    seeds = [int(s) for s in args.seeds.split(',')]
+
+    # Run each path once untimed, so that compiling the jitted functions and
+    # the sampler's eager ops is kept out of the timing.
+    for path in (direct, two_stage):
+        jax.block_until_ready(clip_score(path(PRNG(jax.random.PRNGKey(0)), text_embeds[0]), text_embeds[0]))
+
+    results = {}
+    for (name, path) in (('direct', direct), ('two-stage', two_stage)):
+        times = []
+        scores = []
+        for (prompt, text_embed) in zip(prompts, text_embeds):
+            for seed in seeds:
+                rng = PRNG(jax.random.PRNGKey(seed))
+                start = time.perf_counter()
+                image = path(rng, text_embed)
+                times.append(time.perf_counter() - start)
+                scores.append(float(clip_score(image, text_embed)[0]))
+                print(f'  {name:9}  seed {seed}  {times[-1]:7.1f} s  CLIP {scores[-1]:.4f}  {prompt}')
+        results[name] = (times, scores)
+
+    (_, final_diffusion, _) = stages['final']
+    (_, first_diffusion, _) = stages['first']
+    print(f'{len(prompts)} prompts x {len(seeds)} seeds; direct: {final_diffusion.num_timesteps} steps at '
+          f'{args.image_size}; two-stage: {first_diffusion.num_timesteps} at {args.first_size} + '
+          f'{final_diffusion.num_timesteps - args.skip_timesteps} at {args.image_size}')
+    print('  path       s/sample  speedup  CLIP similarity (mean +- std)')
+    direct_time = np.mean(results['direct'][0])
+    for (name, (times, scores)) in results.items():
+        print(f'  {name:9}  {np.mean(times):8.1f}  {direct_time / np.mean(times):6.2f}x'
+              f'  {np.mean(scores):.4f} +- {np.std(scores):.4f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Run several sampler processes that share one copy of the weights.
+
+Usage: python worker_pool.py <num workers> [checkpoint] [clip model] [--image_size 256|512]
+
+The parent loads the UNet checkpoint and the CLIP parameters once, writes
+them to shared memory, and starts `num_workers` copies of execute.py. Each
+worker is told the checkpoint and its model config through the environment,
+maps the shared weights read-only (zero-copy on the CPU backend, see
+lib/shared_params.py) and renders every num_workers-th batch. Workers never
+load weights themselves.
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+import tempfile
+
+sys.path.append('./CLIP_JAX')
+import clip_jax
+
+from lib.tensor_archive import open_archive
+from lib.shared_params import SHARED_DIR, share_state_dict, share_tree, remove_shared
+
+def main():
+    parser = argparse.ArgumentParser(description='Run sampler workers sharing one copy of the weights.')
+    parser.add_argument('num_workers', type=int)
+    parser.add_argument('checkpoint', nargs='?', default='512x512_diffusion_uncond_finetune_008100.tensors')
+    parser.add_argument('clip_model', nargs='?', default='ViT-B/32')
+    parser.add_argument('--image_size', type=int, default=512, choices=[256, 512],
+                        help='selects the model config for the checkpoint')
+    args = parser.parse_args()
+    num_workers = args.num_workers
+    checkpoint = args.checkpoint
+    clip_model_name = args.clip_model
+
+    shared_dir = tempfile.mkdtemp(prefix='jgd_shared_', dir=SHARED_DIR)
+    model_path = os.path.join(shared_dir, 'model.tensors')
+    clip_path = os.path.join(shared_dir, 'clip.tensors')
+    try:
+        print('Sharing state dict...')
+        share_state_dict(open_archive(checkpoint), model_path)
+
+        print('Sharing CLIP model...')
+        _, _, clip_params, _ = clip_jax.load(clip_model_name)
+        share_tree(clip_params, clip_path)
+        del clip_params
+
+        workers = []
+        for i in range(num_workers):
+            env = dict(os.environ,
+                       SHARED_PARAMS=shared_dir,
+                       CHECKPOINT=checkpoint,
+                       # Overrides of execute.py's model_config.
+                       MODEL_CONFIG=json.dumps({'image_size': args.image_size}),
+                       CLIP_MODEL=clip_model_name,
+                       WORKER_INDEX=str(i),
+                       NUM_WORKERS=str(num_workers))
+            workers.append(subprocess.Popen([sys.executable, 'execute.py'], env=env))
+        failed = [i for (i, w) in enumerate(workers) if w.wait() != 0]
+        if failed:
+            raise SystemExit(f'workers {failed} failed')
+    finally:
+        remove_shared(model_path, clip_path)
+        os.rmdir(shared_dir)
+
+if __name__ == '__main__':
+    main()